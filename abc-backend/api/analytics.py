@@ -0,0 +1,349 @@
+import ast
+import functools
+import math
+from contextlib import contextmanager
+from django.conf import settings
+from .expressions import ExpressionCompiler, ExpressionError, MAX_EXPONENT, BINARY_OPERATORS, UNARY_OPERATORS, COMPARISON_OPERATORS
+from .utils import get_compiled_pattern, get_products, question_domain, run_render
+
+# NumPy is only needed for analytics, so the rest of the app still works without it (analytics then answer with a 501)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Price envelopes: what a pattern's BOM costs across every valid set of answers.
+# Instead of building a BOM per combination of answers, every expression is evaluated once over
+# the whole grid of answers (one array per question), then the quantities are priced all at once.
+
+def truthy(values):
+    """Element-wise bool() of an array (or a single value)"""
+    values = np.asarray(values)
+    if values.dtype.kind in "US":
+        return values != ""
+    if values.dtype.kind == "O":
+        return np.frompyfunc(bool, 1, 1)(values).astype(bool)
+    return values.astype(bool)
+
+class Grid(dict):
+    """
+    Every combination of answers, as one array per question (like the answers dict expressions normally get).
+    Also tracks which combinations would have raised an error if they were evaluated one at a time.
+    """
+    def __init__(self, columns: dict, size: int):
+        super().__init__(columns)
+        self.size = size
+        self.errors = np.zeros(size, dtype=bool)
+        # Combinations the current (sub)expression would actually be evaluated for, see only()
+        self.active = np.ones(size, dtype=bool)
+        # Set while evaluating quantities, where the exact type matters (True or 2.0 aren't valid quantities, 1 and 2 are)
+        self.strict = False
+
+    def fail(self, mask):
+        """Marks combinations that would have raised an error"""
+        self.errors |= self.active & mask
+
+    def merge(self, *values):
+        """
+        Checks values that are about to be merged into one array (like both sides of an if / else) are the same kind.
+        numpy would quietly turn bools into ints or ints into floats, hiding whether Python's result would be a valid quantity.
+        """
+        if self.strict and len({_kind(value) for value in values}) > 1:
+            raise ExpressionError("Can't vectorize values of different types")
+
+    @contextmanager
+    def only(self, mask):
+        """Narrows down the active combinations, like the branches Python wouldn't evaluate for the others"""
+        previous = self.active
+        self.active = previous & mask
+        try:
+            yield
+        finally:
+            self.active = previous
+
+def _kind(value):
+    kind = np.asarray(value).dtype.kind
+    return "i" if kind == "u" else kind
+
+def _contains(value, elements):
+    return functools.reduce(np.logical_or, [value == element for element in elements], np.False_)
+
+def _fold(function):
+    # max(a, b, c) -> maximum(maximum(a, b), c). Python's max of an iterable isn't supported
+    def fold(*args):
+        if len(args) < 2:
+            raise ExpressionError(f"{function.__name__} needs at least 2 arguments")
+        return functools.reduce(function, args)
+    return fold
+
+def _round(value, digits=None):
+    # round(x) gives an int in Python, round(x, n) a float. Both round half to even, same as numpy
+    return np.rint(value).astype(np.int64) if digits is None else np.round(value, digits)
+
+class VectorExpressionCompiler(ExpressionCompiler):
+    """
+    Compiles expressions into functions of a Grid that evaluate every combination at once.
+    Anything that can't be vectorized raises (ExpressionError at compile time, or whatever numpy raises),
+    and the caller falls back to evaluating combinations one by one.
+    """
+    binary_operators = BINARY_OPERATORS
+    unary_operators = {
+        **UNARY_OPERATORS,
+        ast.Not: lambda value: np.logical_not(truthy(value)),
+    }
+    comparison_operators = COMPARISON_OPERATORS
+    functions = {
+        # abs(True) is 1 in Python
+        "abs": lambda value: np.abs(np.asarray(value) * 1),
+        "bool": truthy,
+        "float": lambda value: np.asarray(value, dtype=float),
+        "int": lambda value: np.trunc(value).astype(np.int64),
+        "max": _fold(np.maximum),
+        "min": _fold(np.minimum),
+        "round": _round,
+    }
+
+    def compile_BoolOp(self, node):
+        values = [self.visit(value) for value in node.values]
+        is_and = isinstance(node.op, ast.And)
+        def evaluate(grid):
+            result = values[0](grid)
+            # Combinations where the result isn't decided yet, the only ones the next value is evaluated for
+            pending = truthy(result) if is_and else ~truthy(result)
+            for value in values[1:]:
+                with grid.only(pending):
+                    other = value(grid)
+                grid.merge(result, other)
+                result = np.where(pending, other, result)
+                pending = pending & (truthy(other) if is_and else ~truthy(other))
+            return result
+        return evaluate
+
+    def compile_BinOp(self, node):
+        op_type = type(node.op)
+        if op_type not in (ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow):
+            return super().compile_BinOp(node)
+        op = self._operator(self.binary_operators, node.op)
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        def evaluate(grid):
+            a, b = np.asarray(left(grid)), np.asarray(right(grid))
+            # numpy works these out one Python object at a time, without the size checks * and ** have for single values
+            if op_type in (ast.Mult, ast.Pow) and "O" in (_kind(a), _kind(b)):
+                raise ExpressionError("Can't vectorize * or ** of mixed types")
+            if op_type is ast.Mult:
+                return op(a, b)
+            if op_type is ast.Pow:
+                too_large = np.abs(b) > MAX_EXPONENT
+                grid.fail(too_large)
+                # Python gives a float for an integer to a negative power, numpy refuses to
+                if _kind(a) in "bi" and _kind(b) in "bi" and np.any(grid.active & (b < 0)):
+                    raise ExpressionError("Can't vectorize negative integer powers")
+                # Inactive (or failed) combinations don't matter, as long as they don't raise
+                return np.power(a, np.where(too_large | (b < 0), 0, b))
+            # Python raises ZeroDivisionError, numpy gives inf (or 0 for integers)
+            grid.fail(b == 0)
+            return op(a, np.where(b == 0, 1, b))
+        return evaluate
+
+    def compile_Compare(self, node):
+        left = self.visit(node.left)
+        comparisons = []
+        for op, comparator in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                if not isinstance(comparator, (ast.List, ast.Tuple)):
+                    raise ExpressionError("Only lists can be used with 'in'")
+                elements = [self.visit(element) for element in comparator.elts]
+                contains = _contains if isinstance(op, ast.In) else lambda value, elements: ~_contains(value, elements)
+                comparisons.append((contains, lambda grid, elements=elements: [element(grid) for element in elements]))
+            else:
+                comparisons.append((self._operator(self.comparison_operators, op), self.visit(comparator)))
+        def evaluate(grid):
+            a = left(grid)
+            result = np.True_
+            for op, comparator in comparisons:
+                # Chained comparisons stop at the first false one
+                with grid.only(result):
+                    b = comparator(grid)
+                result = result & truthy(op(a, b))
+                a = b
+            return result
+        return evaluate
+
+    def compile_Call(self, node):
+        evaluate = super().compile_Call(node)
+        if node.func.id not in ("max", "min"):
+            return evaluate
+        args = [self.visit(arg) for arg in node.args]
+        def evaluate_checked(grid):
+            # max(True, 0) is True in Python, but numpy would give 1
+            grid.merge(*[arg(grid) for arg in args])
+            return evaluate(grid)
+        return evaluate_checked
+
+    def compile_IfExp(self, node):
+        test = self.visit(node.test)
+        body = self.visit(node.body)
+        orelse = self.visit(node.orelse)
+        def evaluate(grid):
+            condition = truthy(test(grid))
+            with grid.only(condition):
+                a = body(grid)
+            with grid.only(~condition):
+                b = orelse(grid)
+            grid.merge(a, b)
+            return np.where(condition, a, b)
+        return evaluate
+
+_vector_compiler = VectorExpressionCompiler() if np is not None else None
+
+def _column(values: list):
+    """Turns a question's possible answers into an array, without numpy coercing mixed types into strings"""
+    types = {type(value) for value in values}
+    if types == {bool}:
+        return np.array(values, dtype=bool)
+    if types == {int}:
+        return np.array(values, dtype=np.int64)
+    if types <= {int, float}:
+        return np.array(values, dtype=float)
+    if types == {str}:
+        return np.array(values, dtype=str)
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+def _evaluate_vectorized(grid: Grid, rule, condition_source, quantity_source):
+    included = np.ones(grid.size, dtype=bool)
+    if condition_source:
+        included = np.broadcast_to(truthy(_vector_compiler.compile(condition_source)(grid)), (grid.size,))
+    with grid.only(included):
+        if isinstance(quantity_source, str):
+            grid.strict = True
+            try:
+                quantity = _vector_compiler.compile(quantity_source)(grid)
+            finally:
+                grid.strict = False
+        else:
+            quantity = rule.quantity
+        quantity = np.broadcast_to(np.asarray(quantity), (grid.size,))
+        # Quantities must be integers, like in collect_parts
+        if quantity.dtype.kind in "iu":
+            valid = np.ones(grid.size, dtype=bool)
+        elif quantity.dtype.kind == "O":
+            valid = np.frompyfunc(lambda value: type(value) is int, 1, 1)(quantity).astype(bool)
+        else:
+            valid = np.zeros(grid.size, dtype=bool)
+        grid.fail(~valid)
+    return included, np.where(included & valid, quantity, 0).astype(np.int64)
+
+def _evaluate_each(grid: Grid, rule, rows: list):
+    # Fallback for expressions that can't be vectorized: one combination at a time, the same way collect_parts does
+    included = np.zeros(grid.size, dtype=bool)
+    quantities = np.zeros(grid.size, dtype=np.int64)
+    for index, context in enumerate(rows):
+        try:
+            if rule.condition and not rule.condition(context):
+                continue
+            quantity = rule.quantity(context) if callable(rule.quantity) else rule.quantity
+            if type(quantity) is not int:
+                raise ValueError("Quantities must be integers")
+        except Exception:
+            grid.errors[index] = True
+            continue
+        included[index] = True
+        quantities[index] = quantity
+    return included, quantities
+
+def price_envelope(yaml_text: str, pattern_id=None, bins: int = 10) -> dict:
+    """
+    Works out the subtotal of the pattern's BOM for every valid combination of answers.
+    Returns how many combinations there are, the cheapest and most expensive (and the answers that give them),
+    the mean, median and percentiles, and a histogram of the subtotals.
+    The prices are looked up here, the combinations (up to BOM_ANALYTICS_MAX_COMBINATIONS) are worked out in the
+    render pool like a PDF (see run_render), so they don't hold up or take memory from the web worker.
+    """
+    if np is None:
+        raise ImportError("NumPy is required for pattern analytics")
+    compiled = get_compiled_pattern(yaml_text, pattern_id)
+    parts = list(dict.fromkeys(rule.part for rule in compiled.rules if not rule.raw))
+    products = get_products(parts)
+    # In whole cents (customer prices have two decimal places), so subtotals add up exactly, like a BOM's Decimals
+    prices = {part: int(products[part]["customer_price"] * 100) for part in parts}
+    max_size = getattr(settings, "BOM_ANALYTICS_MAX_COMBINATIONS", 100_000)
+    return run_render(_price_envelope, [(yaml_text, prices, bins, max_size)])[0]
+
+def _dollars(cents) -> float:
+    # The closest float to the exact amount, so it formats the same as the BOM's Decimal
+    return int(cents) / 100
+
+def _price_envelope(yaml_text: str, prices: dict, bins: int, max_size: int) -> dict:
+    """Runs in the render pool. price_envelope, given each part's customer price in cents"""
+    compiled = get_compiled_pattern(yaml_text)
+
+    # Every combination of answers
+    names, domains = [], []
+    for question in compiled.schema.get("questions") or []:
+        values = question_domain(question)
+        if values is None:
+            raise ValueError(f"Question '{question.get('name')}' doesn't have a fixed set of answers (integers need a min and max)")
+        names.append(question.get("name"))
+        domains.append(values)
+    size = math.prod(len(values) for values in domains)
+    if size > max_size:
+        raise ValueError(f"Too many combinations of answers ({size:,}, max: {max_size:,})")
+    if size == 0:
+        raise ValueError("Pattern has no valid answers")
+    columns = [column.ravel() for column in np.meshgrid(*[_column(list(values)) for values in domains], indexing="ij")]
+    grid = Grid(dict(zip(names, columns)), size)
+    # The same combinations as plain Python values (for the fallback and for reporting answers), only built when needed
+    rows = None
+
+    # Subtotal of every combination in cents, added up part by part as the rules are evaluated
+    subtotals = np.zeros(size, dtype=np.int64)
+    in_bom = np.zeros(size, dtype=bool)
+    with np.errstate(all="ignore"):
+        for rule in compiled.rules:
+            if rule.raw:
+                in_bom[:] = True
+                continue
+            source = compiled.schema["products"][rule.index]
+            try:
+                included, quantity = _evaluate_vectorized(grid, rule, source.get("condition"), source["add"].get("quantity"))
+            except Exception:
+                if rows is None:
+                    rows = [dict(zip(names, values)) for values in zip(*[column.tolist() for column in columns])] if names else [{}]
+                included, quantity = _evaluate_each(grid, rule, rows)
+            in_bom |= included
+            subtotals += quantity * prices[rule.part]
+    # Empty BOMs can't be generated
+    valid = ~grid.errors & in_bom
+    if not valid.any():
+        raise ValueError("No combination of answers gives a valid BOM")
+
+    indexes = np.flatnonzero(valid)
+    valid_subtotals = subtotals[indexes]
+    def answers(index):
+        return {name: column[index].item() if hasattr(column[index], "item") else column[index] for name, column in zip(names, columns)}
+    def extreme(position):
+        index = indexes[position]
+        return {"subtotal": _dollars(subtotals[index]), "answers": answers(index)}
+    # The mean, median and percentiles are rounded to the nearest cent (halves up)
+    total = sum(valid_subtotals.tolist())
+    mean, remainder = divmod(total, len(indexes))
+    counts, edges = np.histogram(valid_subtotals, bins=bins)
+    return {
+        "combinations": size,
+        "valid": len(indexes),
+        "min": extreme(int(np.argmin(valid_subtotals))),
+        "max": extreme(int(np.argmax(valid_subtotals))),
+        "mean": _dollars(mean + (2 * remainder >= len(indexes))),
+        "median": _dollars(np.floor(np.median(valid_subtotals) + 0.5)),
+        "percentiles": {
+            str(percentile): _dollars(np.floor(value + 0.5))
+            for percentile, value in zip((5, 25, 75, 95), np.percentile(valid_subtotals, (5, 25, 75, 95)))
+        },
+        "histogram": {
+            "edges": [_dollars(np.floor(edge + 0.5)) for edge in edges],
+            "counts": counts.tolist(),
+        },
+    }
@@ -0,0 +1,199 @@
+import asyncio
+import functools
+import logging
+import weakref
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse, Http404
+from django.shortcuts import aget_object_or_404
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotAuthenticated, AuthenticationFailed, PermissionDenied, NotFound
+from rest_framework.permissions import AllowAny, IsAdminUser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.views import exception_handler
+from . import views
+from .filters import *
+from .models import Pattern, Product, BomJob
+from .pagination import apaginated_data
+from .product_export import astream_products, EXPORT_FORMATS
+from .response_cache import acached_data, PATTERN_LIST_SCOPE, PATTERN_SCOPE, PRODUCT_SCOPE
+from .serializers import PatternSerializer, PatternSummarySerializer, ProductSerializer, BomJobSerializer
+from .utils import BOM_CONTENT_TYPES, RenderUnavailable
+
+# Async versions of the BOM, pattern and product read endpoints, used instead of the ones in views.py when
+# BOM_ASYNC_VIEWS is on (see urls.py), i.e. when running the ASGI app (uvicorn workers).
+# Lookups use the async ORM and at most BOM_ASYNC_RENDER_THREADS requests render at a time, so clients slow to send
+# their request or read the response, and requests waiting for a render, are just suspended coroutines.
+# Writes (and anything else) still go through the sync views.
+
+logger = logging.getLogger(__name__)
+
+def json_response(data, status_code: int = status.HTTP_200_OK, headers: dict = None) -> HttpResponse:
+    """Renders data the same way DRF's Response does"""
+    return HttpResponse(JSONRenderer().render(data), status=status_code, headers=headers, content_type="application/json")
+
+def _check_permissions(request: Request, permission_classes: tuple):
+    """Authenticates the request (if a permission needs the user) and checks its permissions like a DRF view does"""
+    for permission in permission_classes:
+        if not permission().has_permission(request, None):
+            if request.authenticators and not request.successful_authenticator:
+                raise NotAuthenticated()
+            raise PermissionDenied()
+
+def _exception_response(request: Request, exc: Exception) -> HttpResponse:
+    """The response a DRF view gives for an exception (see APIView.handle_exception). Anything else is raised"""
+    if isinstance(exc, (NotAuthenticated, AuthenticationFailed)):
+        auth_header = request.authenticators[0].authenticate_header(request) if request.authenticators else None
+        if auth_header:
+            exc.auth_header = auth_header
+        else:
+            exc.status_code = status.HTTP_403_FORBIDDEN
+    response = exception_handler(exc, {"request": request})
+    if response is None:
+        raise exc
+    # Like WWW-Authenticate
+    headers = {name: value for name, value in response.items() if name.lower() != "content-type"}
+    return json_response(response.data, response.status_code, headers)
+
+def async_api_view(methods: tuple, sync_view, permission_classes: tuple = (AllowAny,)):
+    """
+    Turns an async function into a view handling methods, like DRF's api_view: the function gets a DRF request
+    (request.data, request.query_params, request.user) and permission_classes are checked first.
+    API exceptions become the same error responses. Any other method goes to sync_view (the views.py version).
+    """
+    def decorator(function):
+        @csrf_exempt
+        @functools.wraps(function)
+        async def view(request, *args, **kwargs):
+            if request.method not in methods:
+                return await sync_to_async(sync_view)(request, *args, **kwargs)
+            request = Request(
+                request,
+                parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES],
+                authenticators=[authenticator() for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES],
+            )
+            try:
+                # AllowAny doesn't look at the user, so there's nothing to authenticate (and no query)
+                if any(permission is not AllowAny for permission in permission_classes):
+                    await sync_to_async(_check_permissions)(request, permission_classes)
+                return await function(request, *args, **kwargs)
+            except (APIException, Http404) as e:
+                return _exception_response(request, e)
+        return view
+    return decorator
+
+# Rendering slots, per event loop (asyncio primitives belong to the loop they're first used in)
+_render_slots = weakref.WeakKeyDictionary()
+
+def _get_render_slots() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    slots = _render_slots.get(loop)
+    if slots is None:
+        slots = _render_slots[loop] = asyncio.Semaphore(getattr(settings, "BOM_ASYNC_RENDER_THREADS", 4))
+    return slots
+
+async def run_blocking(function, *args):
+    """
+    Runs a blocking (CPU bound or sync ORM) function on the request's thread (see sync_to_async), waiting for
+    one of BOM_ASYNC_RENDER_THREADS slots first, so only that many requests per process render at once.
+    """
+    async with _get_render_slots():
+        return await sync_to_async(function)(*args)
+
+def stream_file(response: FileResponse) -> FileResponse:
+    """
+    Django reads a file response all into memory before sending it from an async view, since its file can only be
+    read synchronously. Instead, this reads it a block at a time in a thread, so large files stream out as they're read.
+    """
+    file = response.file_to_stream
+    async def blocks():
+        while block := await asyncio.to_thread(file.read, response.block_size):
+            yield block
+    # The response still closes the file when it's done
+    response.streaming_content = blocks()
+    return response
+
+# Generate BOM
+@async_api_view(("POST",), views.download_bom)
+async def download_bom(request, id):
+    pattern = await aget_object_or_404(Pattern.objects.select_related('group'), id=id)
+    answers = request.data.get("answers", {})
+    email = request.data.get("email", None)
+    bom_format = request.data.get("format", "pdf")
+
+    if not isinstance(answers, dict):
+        return json_response({"error": "Missing or invalid answers"}, status.HTTP_400_BAD_REQUEST)
+    if bom_format not in BOM_CONTENT_TYPES:
+        return json_response({"error": f"Format must be one of {', '.join(BOM_CONTENT_TYPES)}"}, status.HTTP_400_BAD_REQUEST)
+
+    # Job mode: queue it up for the BOM worker and let the client poll for the result
+    if request.data.get("async"):
+        if email:
+            return json_response({"error": "Emailed BOMs can't be generated asynchronously"}, status.HTTP_400_BAD_REQUEST)
+        job = await BomJob.objects.acreate(pattern=pattern, answers=answers, format=bom_format)
+        return json_response(BomJobSerializer(job).data, status.HTTP_202_ACCEPTED)
+
+    try:
+        response = await run_blocking(views.render_bom_response, pattern, answers, bom_format, email)
+    except RenderUnavailable as e:
+        return json_response({"error": str(e)}, status.HTTP_503_SERVICE_UNAVAILABLE, {"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        logger.warning("Failed during download BOM: %s", e)
+        return json_response({"error": str(e)}, status.HTTP_400_BAD_REQUEST)
+    if response is None:
+        return json_response({"message": "Email queued for delivery."}, status.HTTP_202_ACCEPTED)
+    if isinstance(response, FileResponse):
+        return stream_file(response)
+    return response
+
+@async_api_view(("GET", "HEAD"), views.pattern_list_create)
+async def pattern_list_create(request):
+    # Fetch the groups in the same query, and skip the (potentially large) YAML we won't send back
+    patterns = Pattern.objects.select_related('group').defer('yaml', 'questions', 'answer_table')
+    patterns = filter_patterns(patterns, request.query_params)
+    ordering = get_ordering(request.query_params, PATTERN_ORDERING_FIELDS, 'id')
+    # Shares its cached responses with the sync views (see response_cache.py)
+    build = lambda: apaginated_data(request, patterns, PatternSummarySerializer, ordering)
+    return json_response(await acached_data(request, "pattern-list", [PATTERN_LIST_SCOPE], build))
+
+@async_api_view(("GET", "HEAD"), views.get_edit_pattern)
+async def get_edit_pattern(request, id):
+    async def build():
+        try:
+            pattern = await Pattern.objects.select_related('group').defer('answer_table').aget(id=id)
+        except Pattern.DoesNotExist:
+            raise NotFound("Pattern not found")
+        return PatternSerializer(pattern).data
+    return json_response(await acached_data(request, "pattern", [PATTERN_SCOPE.format(id=id)], build))
+
+# Only allow logged in users (admins) to get product data
+@async_api_view(("GET", "HEAD"), views.product_list_create, permission_classes=(IsAdminUser,))
+async def product_list_create(request):
+    products = filter_products(Product.objects.all(), request.query_params)
+    ordering = get_ordering(request.query_params, PRODUCT_ORDERING_FIELDS, 'part')
+    return json_response(await apaginated_data(request, products, ProductSerializer, ordering))
+
+@async_api_view(("GET", "HEAD"), views.single_product)
+async def single_product(request, pk):
+    async def build():
+        return ProductSerializer(await Product.objects.aget(pk=pk)).data
+    try:
+        return json_response(await acached_data(request, "product", [PRODUCT_SCOPE.format(pk=pk)], build))
+    except Product.DoesNotExist:
+        return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+
+@async_api_view(("GET",), views.product_export, permission_classes=(IsAdminUser,))
+async def product_export(request):
+    export_format = request.query_params.get("type", "csv")
+    if export_format not in EXPORT_FORMATS:
+        return json_response({"error": f"Type must be one of {', '.join(EXPORT_FORMATS)}"}, status.HTTP_400_BAD_REQUEST)
+    products = filter_products(Product.objects.all(), request.query_params)
+    ordering = get_ordering(request.query_params, PRODUCT_ORDERING_FIELDS, 'part')
+    return StreamingHttpResponse(
+        astream_products(products.order_by(*ordering), export_format),
+        content_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment; filename=\"products.{export_format}\""},
+    )
@@ -0,0 +1,180 @@
+import gc
+import platform
+import statistics
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import django
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from openpyxl import Workbook
+from rest_framework.test import APIClient
+from .cache import pattern_cache, bom_result_cache
+from .models import Pattern, Product
+from .serializers import PatternSerializer, PatternSummarySerializer, ProductSerializer
+from .synthetic import SYNTHETIC_ANSWERS, SYNTHETIC_PREFIX
+from .utils import build_bom, excel_to_pdf, generate_bom_from_yaml
+
+# Benchmarks for the BOM engine, serializers and API views (see the bom_benchmark command).
+# Each case is timed a few times (median wall time), then run once more to count queries and once
+# under tracemalloc for the peak memory allocated by Python, since tracing slows everything down.
+
+def measure(function, repeat: int) -> dict:
+    # Warm up (imports, caches that are meant to be warm, etc.)
+    function()
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    # The query log is capped (and everything is logged when DEBUG is on), so make room first
+    connection.queries_log.clear()
+    with CaptureQueriesContext(connection) as queries:
+        function()
+    # Count them now, the next request clears the log
+    query_count = len(queries)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "wall_ms": round(statistics.median(timings) * 1000, 3),
+        "min_ms": round(min(timings) * 1000, 3),
+        "queries": query_count,
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+def benchmark_cases() -> dict:
+    """
+    The benchmark cases, by name. Expects a synthetic catalog (see generate_catalog) in the database.
+    Cases are functions without arguments, anything they need is set up here.
+    """
+    pattern = Pattern.objects.select_related("group").filter(group__name__startswith=f"{SYNTHETIC_PREFIX.lower()}.pattern-").order_by("id").first()
+    if pattern is None:
+        raise ValueError("No synthetic patterns found, run generate_catalog first")
+    rows = build_bom(pattern.yaml, SYNTHETIC_ANSWERS, True)
+    workbook = Workbook()
+    for row in rows:
+        workbook.active.append(row)
+
+    client = APIClient()
+    # Never saved, so benchmarking a real database doesn't leave an admin account behind
+    client.force_authenticate(User(username="benchmark", is_staff=True, is_superuser=True))
+    bom_url = f"/api/pattern/{pattern.id}/bom"
+
+    def uncached(function):
+        # Rendered BOMs would be served from the result cache after the first run
+        def run():
+            bom_result_cache.clear()
+            return function()
+        return run
+
+    def cold(function):
+        def run():
+            pattern_cache.clear()
+            return function()
+        return run
+
+    return {
+        # Engine
+        "engine.generate_bom_from_yaml.cold": cold(lambda: generate_bom_from_yaml("bench", pattern.yaml, SYNTHETIC_ANSWERS, True, pattern_id=pattern.id)),
+        "engine.generate_bom_from_yaml.warm": lambda: generate_bom_from_yaml("bench", pattern.yaml, SYNTHETIC_ANSWERS, True, pattern_id=pattern.id),
+        "engine.build_bom.warm": lambda: build_bom(pattern.yaml, SYNTHETIC_ANSWERS, True, pattern_id=pattern.id),
+        "engine.excel_to_pdf": lambda: excel_to_pdf(workbook),
+        "model.pattern_clean": lambda: pattern.clean(),
+        # Serializers
+        "serializer.pattern": lambda: PatternSerializer(Pattern.objects.select_related("group").defer("answer_table"), many=True).data,
+        "serializer.pattern_summary": lambda: PatternSummarySerializer(Pattern.objects.select_related("group").defer("yaml", "questions", "answer_table"), many=True).data,
+        "serializer.product": lambda: ProductSerializer(Product.objects.all(), many=True).data,
+        # Views
+        "view.pattern_list": lambda: client.get("/api/pattern"),
+        "view.pattern_detail": lambda: client.get(f"/api/pattern/{pattern.id}"),
+        "view.product_list": lambda: client.get("/api/product"),
+        "view.product_list.page": lambda: client.get("/api/product?page_size=100"),
+        "view.bom_pdf": uncached(lambda: client.post(bom_url, {"answers": SYNTHETIC_ANSWERS}, format="json")),
+        "view.bom_pdf.cached": lambda: client.post(bom_url, {"answers": SYNTHETIC_ANSWERS}, format="json"),
+        "view.bom_xlsx": lambda: b"".join(client.post(bom_url, {"answers": SYNTHETIC_ANSWERS, "format": "xlsx"}, format="json").streaming_content),
+        "view.bom_batch": lambda: client.post(f"{bom_url}/batch", {"answers": [SYNTHETIC_ANSWERS] * 10}, format="json"),
+    }
+
+def run_benchmarks(repeat: int = 5, only: str = "", log=None) -> dict:
+    """Runs every case (whose name contains only) and returns the results, ready to be saved as a baseline"""
+    results = {}
+    for name, function in benchmark_cases().items():
+        if only and only not in name:
+            continue
+        results[name] = measure(function, repeat)
+        if log:
+            log(name, results[name])
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "products": Product.objects.count(),
+            "patterns": Pattern.objects.count(),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+def compare(current: dict, baseline: dict, tolerance: float = 0.25) -> list:
+    """
+    Compares results against a baseline. Returns (case, metric, baseline value, current value) for every regression:
+    wall time or peak memory more than tolerance (25% by default) higher, or any extra query.
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        for metric in ("wall_ms", "peak_kib"):
+            if result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append((name, metric, previous[metric], result[metric]))
+        if result["queries"] > previous["queries"]:
+            regressions.append((name, "queries", previous["queries"], result["queries"]))
+    return regressions
+
+def _percentile(ordered: list, percent: float) -> float:
+    """Nearest-rank percentile of a sorted list"""
+    return ordered[max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))]
+
+def load_test(url: str, requests: int = 200, concurrency: int = 10, method: str = "GET", body: bytes = None, headers: dict = None, timeout: float = 60) -> dict:
+    """
+    Sends requests to a running server (see the loadtest command), concurrency at a time, and returns
+    the throughput and latency percentiles in milliseconds. Responses that aren't 2xx count as errors.
+    """
+    headers = {"Content-Type": "application/json", **(headers or {})} if body else headers or {}
+
+    def send(_):
+        request = urllib.request.Request(url, data=body, headers=headers, method=method)
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                response.read()
+                ok = True
+        except (urllib.error.URLError, OSError):
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(send, range(requests)))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": sum(not ok for _, ok in results),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(requests / elapsed, 1),
+        **{f"p{percent}_ms": round(_percentile(latencies, percent) * 1000, 1) for percent in (50, 95, 99)},
+        "max_ms": round(latencies[-1] * 1000, 1),
+    }
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+class LRUCache:
+    """
+    Thread-safe, in-process LRU cache bounded by both entry count and (approximate) byte size.
+    Every gunicorn worker gets its own copy, so only store things that are cheap to rebuild.
+    """
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # key -> (value, size)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size: int = 0):
+        # Don't bother storing something that would evict everything else
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            # Evict least recently used entries until we're back under both limits
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def discard(self, predicate):
+        """Removes every entry whose key matches the predicate"""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                _, size = self._entries.pop(key)
+                self._size -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+# Parsed + compiled patterns, keyed by (pattern id, sha256 of the YAML)
+pattern_cache = LRUCache(
+    getattr(settings, "BOM_PATTERN_CACHE_MAX_ENTRIES", 128),
+    getattr(settings, "BOM_PATTERN_CACHE_MAX_BYTES", 16 * 1024 * 1024),
+)
+
+def invalidate_pattern(pattern_id):
+    """Drops every compiled version of a pattern (called when a pattern is saved or deleted)"""
+    pattern_cache.discard(lambda key: key[0] == pattern_id)
+
+# Product catalog cache
+# This one lives in a Django cache backend (see BOM_PRODUCT_CACHE) rather than in-process,
+# so invalidations are visible to every worker sharing that backend.
+CATALOG_VERSION_KEY = "bom:catalog-version"
+
+def _product_cache():
+    alias = getattr(settings, "BOM_PRODUCT_CACHE", None)
+    return caches[alias] if alias else None
+
+def catalog_version(cache) -> str:
+    """Returns a token that changes whenever cached catalog data must be thrown away"""
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # Either never set or evicted. A fresh token orphans everything cached under the old one
+        version = uuid.uuid4().hex
+        cache.add(CATALOG_VERSION_KEY, version, timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY, version)
+    return version
+
+def bump_catalog_version():
+    """Starts the whole product cache over, right away and again once the current transaction commits (see invalidate_product)"""
+    cache = _product_cache()
+    if cache:
+        cache.set(CATALOG_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        transaction.on_commit(lambda: cache.set(CATALOG_VERSION_KEY, uuid.uuid4().hex, timeout=None))
+
+def _product_key(version: str, part: str) -> str:
+    # Hash the part number since they can contain characters some backends don't allow in keys
+    # (v2: entries include the customer price)
+    return f"bom:product:v2:{version}:{hashlib.md5(str(part).encode()).hexdigest()}"
+
+def get_cached_products(parts) -> dict:
+    """Returns whichever of the requested products are cached, keyed by part number"""
+    cache = _product_cache()
+    if not cache:
+        return {}
+    version = catalog_version(cache)
+    keys = {_product_key(version, part): part for part in parts}
+    return {keys[key]: product for key, product in cache.get_many(keys).items()}
+
+def cache_products(products: dict):
+    cache = _product_cache()
+    if not cache or not products:
+        return
+    version = catalog_version(cache)
+    timeout = getattr(settings, "BOM_PRODUCT_CACHE_TIMEOUT", 300)
+    cache.set_many({_product_key(version, part): product for part, product in products.items()}, timeout=timeout)
+
+def invalidate_product(part: str):
+    """
+    Drops a product from the cache, right away and again once the current transaction commits, in case another
+    request read the old row in between and cached it again
+    """
+    cache = _product_cache()
+    if cache:
+        cache.delete(_product_key(catalog_version(cache), part))
+        transaction.on_commit(lambda: cache.delete(_product_key(catalog_version(cache), part)))
+
+# Versioned data
+# Anything keyed by one of these versions is never served again once the version is bumped.
+# Each worker keeps the versions it read for BOM_VERSION_CACHE_TTL seconds, so a cached BOM doesn't cost a query.
+# A bump is seen right away by the worker that made it, and by the others once their copy runs out
+_versions = {} # name -> (version, monotonic time it was read)
+
+def get_version(name: str) -> int:
+    cached = _versions.get(name)
+    if cached is not None and time.monotonic() - cached[1] < getattr(settings, "BOM_VERSION_CACHE_TTL", 2):
+        return cached[0]
+    from .models import CacheVersion
+    read_at = time.monotonic()
+    version = CacheVersion.objects.filter(name=name).values_list('version', flat=True).first() or 0
+    _versions[name] = (version, read_at)
+    return version
+
+def bump_version(name: str):
+    from .models import CacheVersion
+    from django.db.models import F
+    CacheVersion.objects.get_or_create(name=name)
+    CacheVersion.objects.filter(name=name).update(version=F('version') + 1)
+    # And again once it's committed, in case a request read the old version in between
+    _versions.pop(name, None)
+    transaction.on_commit(lambda: _versions.pop(name, None))
+
+# Rendered BOMs (and price envelopes)
+# Bumped whenever a product, manufacturer or device role changes. Pattern changes don't need to, since results are
+# keyed by the pattern and a hash of its YAML too
+BOM_RESULTS_VERSION = "bom-results"
+
+class ResultCache(LRUCache):
+    """
+    LRU cache of rendered BOMs that also coalesces concurrent identical requests:
+    only the first one renders, the rest wait for (and share) its result.
+    """
+    def __init__(self, max_entries: int, max_bytes: int):
+        super().__init__(max_entries, max_bytes)
+        self._inflight = {} # key -> Future of the render in progress
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            # Raises the same error if the render failed
+            return future.result()
+        try:
+            result = render()
+            self.set(key, result, len(result))
+            future.set_result(result)
+            return result
+        except Exception as e:
+            # Errors aren't cached, the next request will try again
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+bom_result_cache = ResultCache(
+    getattr(settings, "BOM_RESULT_CACHE_MAX_ENTRIES", 256),
+    getattr(settings, "BOM_RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024),
+)
+
+def bom_result_key(pattern, answers: dict, bom_format: str) -> tuple:
+    """Identifies a rendered BOM: the exact pattern YAML, the answers (in a canonical form) and the catalog version"""
+    return (
+        pattern.id,
+        hashlib.sha256(pattern.yaml.encode()).hexdigest(),
+        json.dumps(answers, sort_keys=True, separators=(',', ':')),
+        bom_format,
+        get_version(BOM_RESULTS_VERSION),
+    )
+
+# Price envelopes (see analytics.py): expensive to work out, but only change with the pattern or the catalog.
+# Small, so only their number is limited
+analytics_cache = ResultCache(getattr(settings, "BOM_ANALYTICS_CACHE_MAX_ENTRIES", 64), float("inf"))
+
+def analytics_key(pattern, bins: int) -> tuple:
+    """Identifies a price envelope: the exact pattern YAML, the number of histogram bins and the catalog version"""
+    return (
+        pattern.id,
+        hashlib.sha256(pattern.yaml.encode()).hexdigest(),
+        bins,
+        get_version(BOM_RESULTS_VERSION),
+    )
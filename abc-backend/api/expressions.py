@@ -0,0 +1,220 @@
+import ast
+import operator
+
+# Compiles the condition / quantity expressions used in patterns (like "num_racks > 2" or "num_racks * 2")
+# into plain Python closures. Only a small, whitelisted subset of Python is accepted, so patterns
+# can't reach anything outside of the answers they're evaluated against.
+
+class ExpressionError(ValueError):
+    """Raised when an expression isn't valid or uses something outside of the supported grammar"""
+
+# Limits on what an expression can build, so something like "((10 ** 99) ** 99) ** 99" or "'a' * 10 ** 9" can't hang
+# a worker or run it out of memory. Only * and ** can grow values faster than the expression gets longer, so those
+# (and constants) are what's checked
+# Largest exponent allowed with **
+MAX_EXPONENT = 100
+# Largest integer (in bits, about 38 digits) a constant or the result of * or ** can be
+MAX_INT_BITS = 128
+# Longest string, list or tuple * can repeat into
+MAX_SEQUENCE_LENGTH = 10_000
+
+SEQUENCE_TYPES = (str, list, tuple)
+
+def _check_int(value):
+    if isinstance(value, int) and value.bit_length() > MAX_INT_BITS:
+        raise ValueError(f"Number is too large (max: {MAX_INT_BITS} bits)")
+    return value
+
+def _multiply(a, b):
+    if isinstance(a, SEQUENCE_TYPES) or isinstance(b, SEQUENCE_TYPES):
+        sequence, times = (a, b) if isinstance(a, SEQUENCE_TYPES) else (b, a)
+        if isinstance(times, int) and len(sequence) * times > MAX_SEQUENCE_LENGTH:
+            raise ValueError(f"Repeated sequence is too long (max: {MAX_SEQUENCE_LENGTH} items)")
+        return a * b
+    # Both at most MAX_INT_BITS, so this is quick, and the result is checked before anything builds on it
+    return _check_int(a * b)
+
+def _power(base, exponent):
+    if abs(exponent) > MAX_EXPONENT:
+        raise ValueError(f"Exponent is too large (max: {MAX_EXPONENT})")
+    # The result has at least (bits - 1) * exponent bits, so huge ones are refused before they're worked out
+    if isinstance(base, int) and isinstance(exponent, int) and (abs(base).bit_length() - 1) * exponent > MAX_INT_BITS:
+        raise ValueError(f"Number is too large (max: {MAX_INT_BITS} bits)")
+    try:
+        return _check_int(base ** exponent)
+    except OverflowError as e:
+        # Floats
+        raise ValueError(f"Number is too large ({e.args[1] if len(e.args) > 1 else e})") from None
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: _multiply,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: _power,
+}
+
+UNARY_OPERATORS = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+COMPARISON_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
+# Functions expressions are allowed to call
+FUNCTIONS = {
+    "abs": abs,
+    "bool": bool,
+    "float": float,
+    "int": int,
+    "len": len,
+    "max": max,
+    "min": min,
+    "round": round,
+    "sum": sum,
+}
+
+class ExpressionCompiler:
+    """
+    Turns an expression's AST into a closure taking the answers (a dict) and returning the result.
+    Each supported node type has its own compile_<NodeType> method; anything else is rejected.
+    """
+    binary_operators = BINARY_OPERATORS
+    unary_operators = UNARY_OPERATORS
+    comparison_operators = COMPARISON_OPERATORS
+    functions = FUNCTIONS
+
+    def compile(self, source: str):
+        if not isinstance(source, str):
+            raise ExpressionError(f"Expressions must be strings (got {type(source).__name__})")
+        try:
+            tree = ast.parse(source.strip(), mode="eval")
+        except SyntaxError as e:
+            raise ExpressionError(f"Invalid expression \"{source}\": {e.msg}")
+        return self.visit(tree.body)
+
+    def visit(self, node):
+        method = getattr(self, f"compile_{type(node).__name__}", None)
+        if method is None:
+            raise ExpressionError(f"{type(node).__name__} is not allowed in expressions")
+        return method(node)
+
+    def compile_Constant(self, node):
+        value = node.value
+        if not isinstance(value, (int, float, str)) and value is not None:
+            raise ExpressionError(f"Unsupported constant {value!r}")
+        if isinstance(value, int) and value.bit_length() > MAX_INT_BITS:
+            raise ExpressionError(f"Number is too large (max: {MAX_INT_BITS} bits)")
+        return lambda context: value
+
+    def compile_Name(self, node):
+        name = node.id
+        def load(context):
+            try:
+                return context[name]
+            except KeyError:
+                raise NameError(f"name '{name}' is not defined") from None
+        return load
+
+    def compile_List(self, node):
+        elements = [self.visit(element) for element in node.elts]
+        return lambda context: [element(context) for element in elements]
+
+    def compile_Tuple(self, node):
+        elements = [self.visit(element) for element in node.elts]
+        return lambda context: tuple(element(context) for element in elements)
+
+    def compile_BoolOp(self, node):
+        # Same short-circuiting (and return values) as Python's and / or
+        values = [self.visit(value) for value in node.values]
+        if isinstance(node.op, ast.And):
+            def evaluate(context):
+                for value in values:
+                    result = value(context)
+                    if not result:
+                        return result
+                return result
+        else:
+            def evaluate(context):
+                for value in values:
+                    result = value(context)
+                    if result:
+                        return result
+                return result
+        return evaluate
+
+    def compile_UnaryOp(self, node):
+        op = self._operator(self.unary_operators, node.op)
+        operand = self.visit(node.operand)
+        return lambda context: op(operand(context))
+
+    def compile_BinOp(self, node):
+        op = self._operator(self.binary_operators, node.op)
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        # Skip a call for the common "variable <op> number" case
+        if isinstance(node.right, ast.Constant):
+            value = node.right.value
+            return lambda context: op(left(context), value)
+        return lambda context: op(left(context), right(context))
+
+    def compile_Compare(self, node):
+        left = self.visit(node.left)
+        ops = [self._operator(self.comparison_operators, op) for op in node.ops]
+        comparators = [self.visit(comparator) for comparator in node.comparators]
+        # The common case, like "num_racks > 2"
+        if len(ops) == 1:
+            op, right = ops[0], comparators[0]
+            if isinstance(node.comparators[0], ast.Constant):
+                value = node.comparators[0].value
+                return lambda context: op(left(context), value)
+            return lambda context: op(left(context), right(context))
+        # Chained, like "0 < num_racks <= 4"
+        pairs = list(zip(ops, comparators))
+        def evaluate(context):
+            a = left(context)
+            for op, comparator in pairs:
+                b = comparator(context)
+                if not op(a, b):
+                    return False
+                a = b
+            return True
+        return evaluate
+
+    def compile_IfExp(self, node):
+        test = self.visit(node.test)
+        body = self.visit(node.body)
+        orelse = self.visit(node.orelse)
+        return lambda context: body(context) if test(context) else orelse(context)
+
+    def compile_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.func.id not in self.functions:
+            raise ExpressionError(f"Only these functions can be called: {', '.join(self.functions)}")
+        if node.keywords or any(isinstance(arg, ast.Starred) for arg in node.args):
+            raise ExpressionError("Function calls only take positional arguments")
+        function = self.functions[node.func.id]
+        args = [self.visit(arg) for arg in node.args]
+        return lambda context: function(*[arg(context) for arg in args])
+
+    def _operator(self, operators: dict, op):
+        if type(op) not in operators:
+            raise ExpressionError(f"The {type(op).__name__} operator is not allowed in expressions")
+        return operators[type(op)]
+
+_compiler = ExpressionCompiler()
+
+def compile_expression(source: str):
+    """Compiles an expression into a function that evaluates it against a dict of answers"""
+    return _compiler.compile(source)
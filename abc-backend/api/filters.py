@@ -0,0 +1,80 @@
+from decimal import Decimal, InvalidOperation
+from django.db.models import F
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+# Fields clients may order by. Keep these non-null and indexed (see the model Meta indexes),
+# cursor pagination can't page over NULLs and would otherwise sort the whole table
+PRODUCT_ORDERING_FIELDS = ('part', 'manufacturer', 'classification', 'customer_price')
+PATTERN_ORDERING_FIELDS = ('id', 'version', 'group')
+
+def get_ordering(params, allowed: tuple, tiebreaker: str) -> tuple:
+    """Reads the 'ordering' query param (e.g. ?ordering=-manufacturer), always ending with a unique field"""
+    ordering = params.get('ordering', tiebreaker)
+    if ordering.lstrip('-') not in allowed:
+        raise ValidationError({'ordering': f"Can only order by {', '.join(allowed)}"})
+    if ordering.lstrip('-') == tiebreaker:
+        return (ordering,)
+    # Break ties in the same direction so the cursor stays consistent
+    return (ordering, f"{'-' if ordering.startswith('-') else ''}{tiebreaker}")
+
+def _parse_bool(name, value):
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    raise ValidationError({name: "Must be true or false"})
+
+def _parse_when(name, value):
+    parsed = parse_datetime(value) or parse_date(value)
+    if parsed is None:
+        raise ValidationError({name: "Must be a date (YYYY-MM-DD) or datetime"})
+    return parsed
+
+def _parse_price(name, value):
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise ValidationError({name: "Must be a number"})
+    if not price.is_finite():
+        raise ValidationError({name: "Must be a number"})
+    return price
+
+def filter_products(queryset, params):
+    """
+    Supported filters:
+    manufacturer, classification, device_role: one or more (comma separated) names
+    end_of_support_after, end_of_support_before: date range (inclusive)
+    customer_price_min, customer_price_max: price range (inclusive)
+    """
+    for field in ('manufacturer', 'classification', 'device_role'):
+        if params.get(field):
+            queryset = queryset.filter(**{f"{field}__in": params[field].split(',')})
+    if params.get('end_of_support_after'):
+        queryset = queryset.filter(end_of_support__gte=_parse_when('end_of_support_after', params['end_of_support_after']))
+    if params.get('end_of_support_before'):
+        queryset = queryset.filter(end_of_support__lte=_parse_when('end_of_support_before', params['end_of_support_before']))
+    if params.get('customer_price_min'):
+        queryset = queryset.filter(customer_price__gte=_parse_price('customer_price_min', params['customer_price_min']))
+    if params.get('customer_price_max'):
+        queryset = queryset.filter(customer_price__lte=_parse_price('customer_price_max', params['customer_price_max']))
+    return queryset
+
+def filter_patterns(queryset, params):
+    """
+    Supported filters:
+    group: one or more (comma separated) pattern group names
+    deprecated: true or false
+    latest: true for only each group's latest non-deprecated version (false for every other version)
+    """
+    if params.get('group'):
+        queryset = queryset.filter(group__in=params['group'].split(','))
+    if params.get('deprecated'):
+        queryset = queryset.filter(deprecated=_parse_bool('deprecated', params['deprecated']))
+    if params.get('latest'):
+        # Uses the group's latest pointer, so it's part of the join with the group rather than a per-group search
+        if _parse_bool('latest', params['latest']):
+            queryset = queryset.filter(group__latest=F('pk'))
+        else:
+            queryset = queryset.exclude(group__latest=F('pk'))
+    return queryset
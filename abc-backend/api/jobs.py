@@ -0,0 +1,106 @@
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import BomJob
+from .utils import build_bom, render_bom_pdf, render_bom_xlsx
+
+def _lease_expiry():
+    return timezone.now() + timedelta(seconds=getattr(settings, "BOM_JOB_LEASE", 60))
+
+def claim_job():
+    """
+    Marks the oldest pending job as running (leased to this worker, see renew_lease) and returns it,
+    or None if there's nothing to do. Safe to call from any number of workers at once.
+    """
+    if connection.features.has_select_for_update_skip_locked:
+        # Postgres: rows locked by other workers are skipped instead of waited on
+        with transaction.atomic():
+            job = BomJob.objects.select_for_update(skip_locked=True).filter(status=BomJob.Status.PENDING).order_by('created_at').first()
+            if job is None:
+                return None
+            job.status = BomJob.Status.RUNNING
+            job.started_at = timezone.now()
+            job.lease_expires_at = _lease_expiry()
+            job.attempts += 1
+            job.save(update_fields=['status', 'started_at', 'lease_expires_at', 'attempts'])
+            return job
+    # SQLite: no row locks, so claim with a conditional update and move on to the next job if someone beat us to it
+    for job_id in BomJob.objects.filter(status=BomJob.Status.PENDING).order_by('created_at').values_list('id', flat=True)[:10]:
+        claimed = BomJob.objects.filter(id=job_id, status=BomJob.Status.PENDING).update(
+            status=BomJob.Status.RUNNING, started_at=timezone.now(), lease_expires_at=_lease_expiry(), attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return BomJob.objects.get(id=job_id)
+    return None
+
+def renew_lease(job: BomJob) -> bool:
+    """Extends the worker's hold on a running job. False if it's lost it (the job was queued again)"""
+    return BomJob.objects.filter(id=job.id, status=BomJob.Status.RUNNING, attempts=job.attempts).update(lease_expires_at=_lease_expiry()) > 0
+
+@contextmanager
+def lease_renewed(job: BomJob):
+    """Renews the job's lease in the background (every third of BOM_JOB_LEASE) until the block is done"""
+    done = threading.Event()
+    def renew():
+        try:
+            while not done.wait(getattr(settings, "BOM_JOB_LEASE", 60) / 3):
+                if not renew_lease(job):
+                    return
+        finally:
+            # Its own DB connection
+            connection.close()
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
+
+def run_job(job: BomJob):
+    """
+    Renders the job's BOM and stores the result (or the error) on the job, unless the worker lost it in the meantime
+    (its lease ran out and it was queued again)
+    """
+    pattern = job.pattern
+    try:
+        rows = build_bom(pattern.yaml, job.answers, True, pattern_id=pattern.id, answer_table=pattern.answer_table)
+        if job.format == "xlsx":
+            with render_bom_xlsx(pattern.group.name, rows) as xlsx_file:
+                job.result = xlsx_file.read()
+        else:
+            job.result = render_bom_pdf(rows)
+        job.status = BomJob.Status.DONE
+    except Exception as e:
+        job.error = str(e)
+        job.status = BomJob.Status.FAILED
+    job.finished_at = timezone.now()
+    job.lease_expires_at = None
+    BomJob.objects.filter(id=job.id, status=BomJob.Status.RUNNING, attempts=job.attempts).update(
+        result=job.result, error=job.error, status=job.status, finished_at=job.finished_at, lease_expires_at=None,
+    )
+
+def requeue_expired_jobs() -> tuple:
+    """
+    Queues running jobs whose lease ran out (their worker crashed or was killed) again, or fails them once they've
+    been tried BOM_JOB_MAX_ATTEMPTS times (so a job that takes its worker down doesn't take down every other one).
+    Returns how many were queued again and how many failed
+    """
+    now = timezone.now()
+    expired = BomJob.objects.filter(status=BomJob.Status.RUNNING, lease_expires_at__lt=now)
+    max_attempts = getattr(settings, "BOM_JOB_MAX_ATTEMPTS", 3)
+    failed = expired.filter(attempts__gte=max_attempts).update(
+        status=BomJob.Status.FAILED, error="The worker rendering it stopped", finished_at=now, lease_expires_at=None,
+    )
+    requeued = expired.filter(attempts__lt=max_attempts).update(status=BomJob.Status.PENDING, started_at=None, lease_expires_at=None)
+    return requeued, failed
+
+def purge_expired_jobs() -> int:
+    """Deletes finished jobs (and their files) older than BOM_JOB_TTL seconds. Returns how many were deleted"""
+    cutoff = timezone.now() - timedelta(seconds=settings.BOM_JOB_TTL)
+    deleted, _ = BomJob.objects.filter(status__in=[BomJob.Status.DONE, BomJob.Status.FAILED], finished_at__lt=cutoff).delete()
+    return deleted
@@ -0,0 +1,63 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from api.benchmarks import run_benchmarks, compare
+from api.synthetic import generate_catalog
+
+class Command(BaseCommand):
+    help = "Benchmarks the BOM engine, serializers and API views (wall time, queries and peak memory), optionally against a saved baseline"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=1000, help="Products in the synthetic catalog")
+        parser.add_argument("--patterns", type=int, default=10, help="Pattern groups in the synthetic catalog")
+        parser.add_argument("--versions", type=int, default=5, help="Versions per pattern group")
+        parser.add_argument("--rules", type=int, default=200, help="Product rules per pattern")
+        parser.add_argument("--repeat", type=int, default=5, help="Timed runs per case")
+        parser.add_argument("--only", default="", help="Only run cases whose name contains this")
+        parser.add_argument("--save", metavar="PATH", help="Save the results as a JSON baseline")
+        parser.add_argument("--baseline", metavar="PATH", help="Compare the results against a saved baseline")
+        parser.add_argument("--tolerance", type=float, default=0.25, help="How much slower / bigger than the baseline counts as a regression")
+        parser.add_argument("--fail-on-regression", action="store_true", help="Exit with an error if anything regressed")
+        parser.add_argument("--use-current-db", action="store_true",
+                            help="Benchmark the configured database (run generate_catalog first) instead of a throwaway test database")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as file:
+                baseline = json.load(file)
+        
+        # Same as the test runner: allows the test client's host and keeps emails in memory
+        setup_test_environment()
+        old_name = None
+        try:
+            if not options["use_current_db"]:
+                old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+                generate_catalog(options["products"], options["patterns"], options["versions"], options["rules"])
+            self.stdout.write(f"{'case':<40}{'wall ms':>12}{'min ms':>12}{'queries':>9}{'peak KiB':>12}{'vs baseline':>13}")
+            results = run_benchmarks(options["repeat"], options["only"], log=lambda name, result: self.log(name, result, baseline))
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        
+        if options["save"]:
+            with open(options["save"], "w") as file:
+                json.dump(results, file, indent=2)
+            self.stdout.write(f"Saved baseline to {options['save']}")
+        if baseline is not None:
+            regressions = compare(results, baseline, options["tolerance"])
+            for name, metric, previous, current in regressions:
+                self.stdout.write(self.style.ERROR(f"Regression in {name}: {metric} went from {previous} to {current}"))
+            if not regressions:
+                self.stdout.write(self.style.SUCCESS("No regressions"))
+            elif options["fail_on_regression"]:
+                raise CommandError(f"{len(regressions)} regression(s)")
+
+    def log(self, name, result, baseline):
+        previous = (baseline or {}).get("results", {}).get(name)
+        change = f"{result['wall_ms'] / previous['wall_ms'] - 1:+.0%}" if previous and previous["wall_ms"] else ""
+        self.stdout.write(f"{name:<40}{result['wall_ms']:>12.1f}{result['min_ms']:>12.1f}{result['queries']:>9}{result['peak_kib']:>12.1f}{change:>13}")
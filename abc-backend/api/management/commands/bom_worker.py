@@ -0,0 +1,106 @@
+import multiprocessing
+import signal
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection, connections
+from api.jobs import claim_job, run_job, lease_renewed, requeue_expired_jobs, purge_expired_jobs
+from api.metrics import flush, retire
+
+class Command(BaseCommand):
+    help = "Renders queued BOM jobs (see the 'async' option of the BOM endpoint)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=settings.BOM_WORKER_CONCURRENCY, help="Number of jobs rendered at once (each in a process of its own)")
+        parser.add_argument("--poll-interval", type=float, default=settings.BOM_WORKER_POLL_INTERVAL, help="Seconds to wait when the queue is empty")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty instead of waiting for more jobs")
+
+    def handle(self, *args, **options):
+        # Rendering is pure Python and holds the GIL, so each job gets a process, forked from this one (see start_process)
+        context = multiprocessing.get_context("fork")
+        # Tells the processes to stop claiming jobs
+        self.stop = context.Event()
+        # SIGTERM (docker stop) or Ctrl-C: stop claiming jobs, let the ones running finish, then exit.
+        # The handler only sets a flag, the event's lock could be held by the code it interrupted
+        self.stopping = False
+        def stop(*_):
+            self.stopping = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        start = lambda: self.start_process(context, options["poll_interval"], options["once"])
+        processes = [start() for _ in range(options["concurrency"])]
+        self.stdout.write(f"Started {len(processes)} BOM worker process(es)")
+
+        last_maintenance = float('-inf')
+        while not self.stopping:
+            if options["once"] and not any(process.is_alive() for process in processes):
+                break
+            for index, process in enumerate(processes):
+                if not options["once"] and not process.is_alive() and not self.stopping:
+                    # Its job (if any) is queued again once its lease runs out
+                    self.stderr.write(f"BOM worker process {process.pid} exited ({process.exitcode}), restarting it")
+                    self.retire(process)
+                    processes[index] = start()
+            # Put jobs whose worker died back in the queue, and clean up expired results
+            if time.monotonic() - last_maintenance >= min(60, settings.BOM_JOB_LEASE / 2):
+                close_old_connections()
+                requeued, failed = requeue_expired_jobs()
+                if requeued or failed:
+                    self.stdout.write(f"Queued {requeued} abandoned job(s) again, failed {failed}")
+                deleted = purge_expired_jobs()
+                if deleted:
+                    self.stdout.write(f"Deleted {deleted} expired job(s)")
+                last_maintenance = time.monotonic()
+            time.sleep(1)
+
+        self.stop.set()
+        if any(process.is_alive() for process in processes):
+            self.stdout.write("Waiting for running jobs to finish")
+        for process in processes:
+            process.join()
+            self.retire(process)
+        connection.close()
+
+    def retire(self, process):
+        # Forked processes exit without running atexit (see api.metrics), so their metrics are kept from here
+        if settings.BOM_METRICS_DIR:
+            retire(settings.BOM_METRICS_DIR, process.pid)
+
+    def start_process(self, context, poll_interval, once):
+        # Forked while this process has no database connections (its maintenance queries leave one open), or the
+        # child would share the socket with it. It has no other threads, so the connections stay closed until forked
+        connections.close_all()
+        process = context.Process(target=self.work, args=(poll_interval, once))
+        process.start()
+        return process
+
+    def work(self, poll_interval, once):
+        # Ctrl-C reaches every process of the group, and the main one tells the others when to stop. A SIGTERM sent
+        # to this process alone (or to the whole group) lets its job finish too
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.terminated = False
+        def terminate(*_):
+            self.terminated = True
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            self.process_jobs(poll_interval, once)
+        finally:
+            # The last jobs' metrics, if they came within BOM_METRICS_FLUSH_INTERVAL of the one before
+            flush(True)
+            connection.close()
+
+    def process_jobs(self, poll_interval, once):
+        while not self.stop.is_set() and not self.terminated:
+            close_old_connections()
+            job = claim_job()
+            if job is None:
+                if once:
+                    return
+                self.stop.wait(poll_interval)
+                continue
+            started = time.monotonic()
+            with lease_renewed(job):
+                run_job(job)
+            self.stdout.write(f"Job {job.id} {job.status} in {time.monotonic() - started:.2f}s")
+            # Share the phase timings with /api/metrics (see BOM_METRICS_DIR)
+            flush()
@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+from api.synthetic import generate_catalog, delete_catalog
+
+class Command(BaseCommand):
+    help = "Generates a synthetic catalog (products, manufacturers, roles, classifications and patterns) for load testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=1000, help="Number of products (e.g. 1000, 10000, 100000)")
+        parser.add_argument("--patterns", type=int, default=10, help="Number of pattern groups")
+        parser.add_argument("--versions", type=int, default=5, help="Versions per pattern group")
+        parser.add_argument("--rules", type=int, default=200, help="Product rules per pattern")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed, so runs are reproducible")
+        parser.add_argument("--delete", action="store_true", help="Delete the synthetic catalog instead")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        if options["delete"]:
+            deleted = delete_catalog()
+            self.stdout.write(f"Deleted {deleted['products']:,} product(s) and {deleted['patterns']:,} pattern row(s)")
+            return
+        created = generate_catalog(options["products"], options["patterns"], options["versions"], options["rules"], options["seed"])
+        self.stdout.write(
+            f"Created {created['products']:,} product(s) and {created['patterns']:,} pattern(s) in {time.monotonic() - started:.1f}s"
+        )
@@ -0,0 +1,35 @@
+import json
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api.product_import import import_products, format_from_filename, IMPORT_FORMATS
+
+class Command(BaseCommand):
+    help = "Creates or updates products in bulk from a CSV or XLSX price list, reporting the rows it couldn't import"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or XLSX file. The first row names the columns (part, manufacturer and classification are required)")
+        parser.add_argument("--format", choices=IMPORT_FORMATS, help="File format (defaults to the file's extension)")
+        parser.add_argument("--batch-size", type=int, default=settings.PRODUCT_IMPORT_BATCH_SIZE, help="Products upserted per query")
+        parser.add_argument("--dry-run", action="store_true", help="Check and import everything, then roll back")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        try:
+            with open(options["path"], "rb") as file:
+                report = import_products(file, options["format"] or format_from_filename(options["path"]),
+                                         batch_size=options["batch_size"], dry_run=options["dry_run"])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for error in report["errors"]:
+            messages = "; ".join(f"{column}: {' '.join(details)}" for column, details in error["errors"].items())
+            self.stderr.write(f"Row {error['row']} ({error['part'] or 'no part'}): {messages}")
+        self.stdout.write(
+            f"{report['rows']:,} row(s) in {time.monotonic() - started:.2f}s: {report['created']:,} created, "
+            f"{report['updated']:,} updated, {len(report['errors']):,} skipped" + (" (dry run, nothing saved)" if options["dry_run"] else "")
+        )
@@ -0,0 +1,39 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from api.benchmarks import load_test
+
+class Command(BaseCommand):
+    help = "Sends concurrent requests to a running server and reports throughput and latency percentiles, to compare server profiles"
+
+    def add_arguments(self, parser):
+        parser.add_argument("url", help="Full URL, like http://localhost:8000/api/pattern/<id>/bom")
+        parser.add_argument("--requests", type=int, default=200, help="Requests to send")
+        parser.add_argument("--concurrency", type=int, default=10, help="Requests in flight at once")
+        parser.add_argument("--method", default=None, help="HTTP method (POST if there's a body, GET otherwise)")
+        parser.add_argument("--body", metavar="JSON", help="Request body, or @path to read it from a file")
+        parser.add_argument("--header", action="append", default=[], metavar="NAME:VALUE", help="Extra request header (repeatable)")
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        body = options["body"]
+        if body and body.startswith("@"):
+            with open(body[1:], "rb") as file:
+                body = file.read()
+        elif body:
+            body = body.encode()
+        try:
+            headers = dict((name.strip(), value.strip()) for name, value in (header.split(":", 1) for header in options["header"]))
+        except ValueError:
+            raise CommandError("Headers must look like NAME:VALUE")
+        if options["requests"] < 1 or options["concurrency"] < 1:
+            raise CommandError("--requests and --concurrency must be at least 1")
+
+        results = load_test(options["url"], options["requests"], options["concurrency"], options["method"] or ("POST" if body else "GET"), body, headers)
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(
+            f"{results['requests']} requests, {results['concurrency']} at a time, in {results['seconds']:.2f}s "
+            f"({results['requests_per_second']} req/s, {results['errors']} errors)\n"
+            f"p50 {results['p50_ms']} ms, p95 {results['p95_ms']} ms, p99 {results['p99_ms']} ms, max {results['max_ms']} ms"
+        )
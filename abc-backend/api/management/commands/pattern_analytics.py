@@ -0,0 +1,39 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from api.analytics import price_envelope
+from api.models import Pattern
+from api.utils import format_currency
+
+class Command(BaseCommand):
+    help = "Shows what a pattern's BOM costs across every valid combination of answers (needs NumPy)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("pattern_id", type=int)
+        parser.add_argument("--bins", type=int, default=10, help="Number of histogram bins")
+        parser.add_argument("--json", action="store_true", help="Print the raw result as JSON")
+
+    def handle(self, *args, **options):
+        try:
+            pattern = Pattern.objects.select_related("group").get(id=options["pattern_id"])
+        except Pattern.DoesNotExist:
+            raise CommandError(f"Pattern {options['pattern_id']} does not exist")
+        try:
+            envelope = price_envelope(pattern.yaml, pattern_id=pattern.id, bins=options["bins"])
+        except (ImportError, ValueError) as e:
+            raise CommandError(str(e))
+        
+        if options["json"]:
+            self.stdout.write(json.dumps(envelope, indent=2))
+            return
+        self.stdout.write(f"{pattern}: {envelope['combinations']:,} combinations of answers, {envelope['valid']:,} valid")
+        for label in ("min", "max"):
+            self.stdout.write(f"  {label:<8}{format_currency(envelope[label]['subtotal']):>16}  {json.dumps(envelope[label]['answers'])}")
+        self.stdout.write(f"  {'mean':<8}{format_currency(envelope['mean']):>16}")
+        self.stdout.write(f"  {'median':<8}{format_currency(envelope['median']):>16}")
+        for percentile, value in envelope["percentiles"].items():
+            self.stdout.write(f"  {'p' + percentile:<8}{format_currency(value):>16}")
+        # Text histogram, scaled to the largest bin
+        histogram = envelope["histogram"]
+        largest = max(histogram["counts"]) or 1
+        for low, high, count in zip(histogram["edges"], histogram["edges"][1:], histogram["counts"]):
+            self.stdout.write(f"  {format_currency(low):>14} - {format_currency(high):<14} {'#' * round(40 * count / largest)} {count:,}")
@@ -0,0 +1,35 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from api.metrics import flush
+from api.outbox import deliver_pending
+
+class Command(BaseCommand):
+    help = "Delivers queued emails (like emailed BOMs) in batches over a single SMTP connection"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=settings.EMAIL_OUTBOX_BATCH_SIZE, help="Emails sent per SMTP connection")
+        parser.add_argument("--poll-interval", type=float, default=settings.EMAIL_OUTBOX_POLL_INTERVAL, help="Seconds to wait when nothing is due")
+        parser.add_argument("--once", action="store_true", help="Exit once nothing is due instead of waiting for more emails")
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                close_old_connections()
+                started = time.monotonic()
+                try:
+                    handled = deliver_pending(options["batch_size"])
+                except Exception as e:
+                    self.stderr.write(f"Failed to deliver batch: {e}")
+                    handled = 0
+                if handled:
+                    # Share the SMTP timings with /api/metrics (see BOM_METRICS_DIR)
+                    flush()
+                    self.stdout.write(f"Handled {handled} email(s) in {time.monotonic() - started:.2f}s")
+                    continue
+                if options["once"]:
+                    return
+                time.sleep(options["poll_interval"])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,353 @@
+import atexit
+import bisect
+import contextvars
+import fcntl
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connection
+
+# Performance metrics: how long requests and each phase of BOM generation take, how many queries they run and how big
+# the responses are. Each request's timings can go out in a Server-Timing header (see ServerTimingMiddleware), and
+# everything is aggregated into histograms served in the Prometheus text format by /api/metrics, along with a few
+# counters (like the response cache's hits and misses).
+#
+# Metrics live in memory, so every gunicorn worker has its own. Set BOM_METRICS_DIR to a directory shared by the
+# workers: each one then writes its metrics to a file there (at most every BOM_METRICS_FLUSH_INTERVAL seconds),
+# and /api/metrics adds up every worker's file. When a worker exits (or is killed, see retire) its file is added to
+# an aggregate one, so the totals never go down as workers come and go.
+
+# Upper bounds of the histogram buckets (+Inf is implied)
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+class Histogram:
+    """A Prometheus style histogram, with one series per combination of label values"""
+    def __init__(self, name: str, description: str, labels: tuple, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def dump(self) -> dict:
+        with self._lock:
+            return {json.dumps(label_values): list(series) for label_values, series in self._series.items()}
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+REQUEST_DURATION = Histogram("bom_request_duration_seconds", "Time spent handling requests", ("method", "route", "status"), DURATION_BUCKETS)
+PHASE_DURATION = Histogram("bom_phase_duration_seconds", "Time spent in each phase of BOM generation", ("phase",), DURATION_BUCKETS)
+REQUEST_QUERIES = Histogram("bom_request_db_queries", "Database queries run per request", ("route",), QUERY_BUCKETS)
+REQUEST_DB_DURATION = Histogram("bom_request_db_duration_seconds", "Time spent in database queries per request", ("route",), DURATION_BUCKETS)
+RESPONSE_SIZE = Histogram("bom_response_size_bytes", "Size of response bodies (when known up front)", ("route",), SIZE_BUCKETS)
+
+HISTOGRAMS = [REQUEST_DURATION, PHASE_DURATION, REQUEST_QUERIES, REQUEST_DB_DURATION, RESPONSE_SIZE]
+
+class Counter:
+    """A Prometheus style counter, with one series per combination of label values"""
+    def __init__(self, name: str, description: str, labels: tuple):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        # label values -> [value] (a list, so it's added up across workers like a histogram's series)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            series = self._series.setdefault(label_values, [0])
+            series[0] += amount
+
+    def dump(self) -> dict:
+        with self._lock:
+            return {json.dumps(label_values): list(series) for label_values, series in self._series.items()}
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+RESPONSE_CACHE_HITS = Counter("bom_response_cache_hits_total", "Responses served from the response cache", ("endpoint",))
+RESPONSE_CACHE_MISSES = Counter("bom_response_cache_misses_total", "Responses that weren't cached (or were out of date) and had to be built", ("endpoint",))
+RESPONSE_CACHE_EVICTIONS = Counter("bom_response_cache_evictions_total", "Misses on responses the cache backend dropped before they expired (to make room)", ("endpoint",))
+
+COUNTERS = [RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES, RESPONSE_CACHE_EVICTIONS]
+
+class RequestTimings:
+    """What's been measured during the current request"""
+    def __init__(self):
+        # phase -> total seconds (a phase can run more than once, like rendering a batch)
+        self.phases = {}
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def record_query(self, execute, sql, params, many, context):
+        """Database execute wrapper (see connection.execute_wrapper)"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_seconds += time.perf_counter() - started
+            self.queries += 1
+
+    def server_timing(self, total: float) -> str:
+        """The Server-Timing header value, with durations in milliseconds"""
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phases.items()]
+        entries.append(f"db;dur={self.query_seconds * 1000:.1f};desc=\"{self.queries} queries\"")
+        entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+_current = contextvars.ContextVar("request_timings", default=None)
+
+@contextmanager
+def phase(name: str):
+    """
+    Times a block as one phase of BOM generation (like "yaml" or "pdf"). Shows up in the request's
+    Server-Timing header (when there is a request) and in the bom_phase_duration_seconds histogram.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        PHASE_DURATION.observe(elapsed, name)
+        timings = _current.get()
+        if timings is not None:
+            timings.phases[name] = timings.phases.get(name, 0.0) + elapsed
+
+@contextmanager
+def track_request():
+    """Collects the phases (see phase) of everything run inside the block. Yields the RequestTimings"""
+    timings = RequestTimings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+# Multi-process aggregation
+_last_flush = 0.0
+_flush_lock = threading.Lock()
+# Whether this process has written its file yet
+_flushed = False
+
+AGGREGATE_FILE = "aggregate.json"
+
+def _metrics_file(directory: str, pid: int = None) -> str:
+    return os.path.join(directory, f"metrics-{pid or os.getpid()}.json")
+
+@contextmanager
+def _locked(directory: str, exclusive: bool):
+    """
+    Held while exited processes' files are added to the aggregate one (exclusive) and while the files are read
+    (shared), so a scrape never sees a process's metrics in both or in neither
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _read(path: str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _add(totals: dict, data: dict):
+    """Adds one process's metrics (as dumped to its file) to totals"""
+    for name, series in data.items():
+        merged = totals.setdefault(name, {})
+        for label_values, values in series.items():
+            if label_values in merged:
+                merged[label_values] = [a + b for a, b in zip(merged[label_values], values)]
+            else:
+                merged[label_values] = values
+
+def _write(directory: str, name: str, data: dict):
+    # Write then rename, so readers never see half a file
+    fd, path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(path, os.path.join(directory, name))
+
+def retire(directory: str, pid: int):
+    """
+    Adds the metrics file of a process that has exited to the aggregate file, and deletes it (so a new process that
+    gets the same PID starts from zero without the totals going down). Called by the parent process (gunicorn's
+    child_exit hook, bom_worker) since a killed process can't do it itself.
+    """
+    path = _metrics_file(directory, pid)
+    with _locked(directory, exclusive=True):
+        data = _read(path)
+        if not data:
+            return
+        totals = _read(os.path.join(directory, AGGREGATE_FILE))
+        _add(totals, data)
+        _write(directory, AGGREGATE_FILE, totals)
+        os.remove(path)
+
+def flush(force: bool = False):
+    """
+    Writes this process's metrics to BOM_METRICS_DIR (if set) so /api/metrics can include them.
+    Skipped if the last write was less than BOM_METRICS_FLUSH_INTERVAL seconds ago, unless forced.
+    """
+    global _last_flush, _flushed
+    directory = getattr(settings, "BOM_METRICS_DIR", None)
+    if not directory:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < getattr(settings, "BOM_METRICS_FLUSH_INTERVAL", 1):
+        return
+    with _flush_lock:
+        _last_flush = now
+        if not _flushed:
+            # Left by an earlier process with the same PID that nobody retired (e.g. the whole server was killed)
+            retire(directory, os.getpid())
+            _flushed = True
+        data = {metric.name: metric.dump() for metric in HISTOGRAMS + COUNTERS}
+        os.makedirs(directory, exist_ok=True)
+        _write(directory, os.path.basename(_metrics_file(directory)), data)
+
+def _exit():
+    # Don't lose the last (up to) BOM_METRICS_FLUSH_INTERVAL seconds when a process exits cleanly
+    # Not in processes that never loaded the settings (like gunicorn's master, see gunicorn.conf.py)
+    directory = getattr(settings, "BOM_METRICS_DIR", None) if settings.configured else None
+    if directory:
+        flush(True)
+        retire(directory, os.getpid())
+
+atexit.register(_exit)
+
+def collect() -> dict:
+    """
+    Every histogram and counter, added up across every process that's written to BOM_METRICS_DIR (including exited
+    ones, see retire, so counters never go backwards). This process's own metrics are always current.
+    Returns {metric name: {label values (JSON): [count per bucket..., sum, count] or [value] for counters}}.
+    """
+    totals = {metric.name: metric.dump() for metric in HISTOGRAMS + COUNTERS}
+    directory = getattr(settings, "BOM_METRICS_DIR", None)
+    if directory:
+        own_file = _metrics_file(directory)
+        with _locked(directory, exclusive=False):
+            paths = glob.glob(os.path.join(directory, "metrics-*.json")) + [os.path.join(directory, AGGREGATE_FILE)]
+            for path in paths:
+                if path != own_file:
+                    _add(totals, _read(path))
+    return totals
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names: tuple, values: list, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_number(value) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def render_prometheus() -> str:
+    """Every histogram and counter (see collect) in the Prometheus text exposition format"""
+    totals = collect()
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.append(f"# HELP {histogram.name} {histogram.description}")
+        lines.append(f"# TYPE {histogram.name} histogram")
+        for label_values, values in sorted(totals.get(histogram.name, {}).items()):
+            label_values = json.loads(label_values)
+            # Buckets are cumulative
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), values):
+                cumulative += count
+                le = f'le="{bound if bound == "+Inf" else _format_number(bound)}"'
+                lines.append(f"{histogram.name}_bucket{_format_labels(histogram.labels, label_values, le)} {cumulative}")
+            lines.append(f"{histogram.name}_sum{_format_labels(histogram.labels, label_values)} {_format_number(values[-2])}")
+            lines.append(f"{histogram.name}_count{_format_labels(histogram.labels, label_values)} {values[-1]}")
+    for counter in COUNTERS:
+        lines.append(f"# HELP {counter.name} {counter.description}")
+        lines.append(f"# TYPE {counter.name} counter")
+        for label_values, values in sorted(totals.get(counter.name, {}).items()):
+            lines.append(f"{counter.name}{_format_labels(counter.labels, json.loads(label_values))} {_format_number(values[0])}")
+    return "\n".join(lines) + "\n"
+
+class ServerTimingMiddleware:
+    """
+    Times every request: records the request duration, query count / time and response size in the metrics
+    histograms, and adds a Server-Timing header (BOM phases, database queries and the total) if BOM_SERVER_TIMING is on.
+    Goes first in MIDDLEWARE so it covers everything else. Works with sync and async views.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        with track_request() as timings, connection.execute_wrapper(timings.record_query):
+            response = self.get_response(request)
+        self.record(request, response, timings, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with track_request() as timings:
+            # Async views run their queries on the request's thread (see sync_to_async), so the wrapper goes there
+            wrapper = await sync_to_async(_wrap_queries)(timings)
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(wrapper.__exit__)(None, None, None)
+        self.record(request, response, timings, time.perf_counter() - started)
+        return response
+
+    def record(self, request, response, timings: RequestTimings, total: float):
+        # The URL pattern rather than the path, so IDs don't each get their own series
+        match = getattr(request, "resolver_match", None)
+        route = match.route if match is not None else "unmatched"
+        REQUEST_DURATION.observe(total, request.method, route, response.status_code)
+        REQUEST_QUERIES.observe(timings.queries, route)
+        REQUEST_DB_DURATION.observe(timings.query_seconds, route)
+        if not response.streaming:
+            RESPONSE_SIZE.observe(len(response.content), route)
+        elif response.has_header("Content-Length"):
+            RESPONSE_SIZE.observe(int(response["Content-Length"]), route)
+        if getattr(settings, "BOM_SERVER_TIMING", False):
+            response["Server-Timing"] = timings.server_timing(total)
+        flush()
+
+def _wrap_queries(timings: RequestTimings):
+    """Starts recording the current thread's queries. Returns the context manager to exit when done"""
+    wrapper = connection.execute_wrapper(timings.record_query)
+    wrapper.__enter__()
+    return wrapper
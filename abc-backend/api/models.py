@@ -1,10 +1,14 @@
 import yaml
 from django.contrib import admin
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Round
+from django.utils import timezone
 from django.core.validators import RegexValidator, MinValueValidator
 import textwrap
-from .utils import generate_bom_from_yaml
+import uuid
+from .utils import load_yaml, validate_pattern, build_answer_table
 
 DEFAULT_YAML = textwrap.dedent("""# Questions to ask the product leads
 # If you don't need any input from PLs, you can delete questions
@@ -74,6 +78,27 @@ class PatternGroup(models.Model):
         ]
     )
     description = models.TextField(max_length=200)
+    # Highest version ever given out, so allocating the next one doesn't scan the group's patterns (and deleted
+    # version numbers are never reused). Kept up to date by next_version() and the pattern signals (see signals.py)
+    last_version = models.PositiveIntegerField(default=0, editable=False)
+    # Latest non-deprecated version, or null if there isn't one. Maintained by the pattern signals
+    latest = models.ForeignKey('Pattern', null=True, blank=True, on_delete=models.SET_NULL, related_name='+', editable=False)
+    
+    def next_version(self) -> int:
+        """
+        Allocates the group's next version number. Call it in the same transaction that creates the pattern:
+        the row stays locked until then, so concurrent requests can't get the same number.
+        """
+        with transaction.atomic():
+            PatternGroup.objects.filter(pk=self.pk).update(last_version=F('last_version') + 1)
+            self.last_version = PatternGroup.objects.values_list('last_version', flat=True).get(pk=self.pk)
+        return self.last_version
+    
+    @staticmethod
+    def refresh_latest(group_id):
+        """Points the group at its latest non-deprecated version (a single index lookup, see Pattern.Meta)"""
+        latest = Pattern.objects.filter(group_id=group_id, deprecated=False).order_by('-version').values('id')[:1]
+        PatternGroup.objects.filter(pk=group_id).update(latest=models.Subquery(latest))
 
 class Pattern(models.Model):
     group = models.ForeignKey(PatternGroup, on_delete=models.CASCADE)
@@ -82,18 +107,25 @@ class Pattern(models.Model):
     deprecated = models.BooleanField(default=False) # Determines whether to show / hide from PLs
     yaml = models.TextField(default=DEFAULT_YAML)
     questions = models.JSONField(default=list, blank=True) # store the questions too. Updates when YAML does
+    answer_table = models.JSONField(null=True, blank=True, editable=False) # parts for every possible set of answers, if there aren't too many (see build_answer_table)
     
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['group', 'version'], name='unique_pattern_version_per_group')
         ]
+        indexes = [
+            # Listing filtered by deprecation, paged by ID
+            models.Index(fields=['deprecated', 'id'], name='pattern_deprecated_id_idx'),
+            # A group's latest (non-deprecated) version
+            models.Index(fields=['group', 'deprecated', 'version'], name='pattern_group_depr_ver_idx'),
+        ]
     
     # This runs when you try to save a pattern (see save() below)
     # It checks to see if the YAML is good to go and is able to generate a BOM
     def clean(self):
         # Validate YAML
         try:
-            parsed = yaml.safe_load(self.yaml)
+            parsed = load_yaml(self.yaml)
         except yaml.YAMLError as e:
             raise ValidationError({'yaml': f"Invalid YAML: {str(e)}"})
         # Basic structural requires
@@ -155,13 +187,16 @@ class Pattern(models.Model):
             defaults[q.get('name')] = q.get('default')
         # Now for a more definitive test, see if BOM creation actually works
         try:
+            # Compiles the expressions, runs them against the defaults and checks every product exists, without rendering anything
             # This will throw errors if answers are malformed, not YAML
-            generate_bom_from_yaml(self.group.name, self.yaml, defaults, False) # False indicates this is a save action, not a PDF generation (meaning it won't throw a "BOM is empty" error)
+            compiled = validate_pattern(self.yaml, defaults, schema=parsed)
         except Exception as error:
             print(error)
             raise ValidationError({"error": str(error)})
         # If that didn't throw an error, we're good to save
         self.questions = questions
+        # Rebuilt on every save so it always matches the YAML
+        self.answer_table = build_answer_table(compiled, self.yaml)
     
     def save(self, *args, **kwargs):
         # Ensure clean is called before saving
@@ -238,9 +273,107 @@ class Product(models.Model):
         null=True,
         help_text="Product discount as decimal"
     )
+    # list_price * (1 - discount), worked out (and indexed) by the database whenever either changes.
+    # A missing list price or discount counts as 0, so it's never null and can be sorted / paged on
+    customer_price = models.GeneratedField(
+        expression=Round(
+            Coalesce(F("list_price"), Value(0), output_field=models.DecimalField(max_digits=10, decimal_places=2))
+            * (1 - Coalesce(F("discount"), Value(0), output_field=models.DecimalField(max_digits=5, decimal_places=4))),
+            2,
+        ),
+        output_field=models.DecimalField(max_digits=10, decimal_places=2),
+        db_persist=True,
+        help_text="List price after the discount",
+    )
+    
+    class Meta:
+        # Supports the filtered + paginated product listing. Each filter is paired with the primary key
+        # so a page is a single range scan on the index
+        indexes = [
+            models.Index(fields=['manufacturer', 'part'], name='product_mfr_part_idx'),
+            models.Index(fields=['classification', 'part'], name='product_class_part_idx'),
+            models.Index(fields=['device_role', 'part'], name='product_role_part_idx'),
+            models.Index(fields=['end_of_support', 'part'], name='product_eos_part_idx'),
+            models.Index(fields=['customer_price', 'part'], name='product_price_part_idx'),
+        ]
+    
     def __str__(self):
         return self.part
 
+# A BOM rendered in the background by the BOM worker (see jobs.py and the bom_worker command)
+class BomJob(models.Model):
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        RUNNING = "running"
+        DONE = "done"
+        FAILED = "failed"
+    
+    # Random so job IDs can't be guessed (anyone can create / download jobs, just like BOMs)
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    pattern = models.ForeignKey(Pattern, on_delete=models.CASCADE)
+    answers = models.JSONField(default=dict)
+    format = models.CharField(max_length=10, default="pdf")
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    result = models.BinaryField(null=True, editable=False) # the rendered file once done
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+    # Times the job was claimed by a worker, and until when the one rendering it has it. Workers renew the lease while
+    # they render, so a running job whose lease ran out lost its worker (see requeue_expired_jobs in jobs.py)
+    attempts = models.PositiveSmallIntegerField(default=0, editable=False)
+    lease_expires_at = models.DateTimeField(null=True, editable=False)
+    
+    class Meta:
+        indexes = [
+            # Workers claim the oldest pending job first
+            models.Index(fields=['status', 'created_at'], name='bomjob_status_created_idx'),
+            # Running jobs whose worker went away
+            models.Index(fields=['status', 'lease_expires_at'], name='bomjob_status_lease_idx'),
+        ]
+    
+    def __str__(self):
+        return f"BOM job {self.id} ({self.status})"
+
+# An email waiting to be delivered by the outbox worker (see outbox.py and the send_outbox command)
+class OutboxEmail(models.Model):
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        SENT = "sent"
+        FAILED = "failed" # gave up after EMAIL_OUTBOX_MAX_ATTEMPTS
+    
+    to = models.JSONField(default=list)
+    subject = models.CharField(max_length=200)
+    body = models.TextField(blank=True)
+    # Optional single attachment
+    attachment_name = models.CharField(max_length=200, blank=True)
+    attachment = models.BinaryField(null=True, editable=False)
+    attachment_type = models.CharField(max_length=100, blank=True)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True)
+    
+    class Meta:
+        indexes = [
+            # The worker sends whatever is due, oldest first
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_status_next_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.to)} ({self.status})"
+
+# Counters that get bumped whenever data cached from the catalog may be stale (see cache.py).
+# Kept in the DB so every worker, node and management command agrees on them
+class CacheVersion(models.Model):
+    name = models.CharField(primary_key=True, max_length=50)
+    version = models.PositiveBigIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.name} v{self.version}"
+
 # Add to admin screen
 admin.site.register(PatternGroup)
 admin.site.register(Pattern)
@@ -248,3 +381,5 @@ admin.site.register(Manufacturer)
 admin.site.register(DeviceRole)
 admin.site.register(Classification)
 admin.site.register(Product)
+admin.site.register(BomJob)
+admin.site.register(OutboxEmail)
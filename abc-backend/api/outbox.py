@@ -0,0 +1,112 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from .metrics import phase
+from .models import OutboxEmail
+
+def queue_email(to: list, subject: str, body: str, attachment_name: str = "", attachment: bytes = None, attachment_type: str = "") -> OutboxEmail:
+    """Stores an email for the outbox worker to send. Returns right away"""
+    return OutboxEmail.objects.create(
+        to=to,
+        subject=subject,
+        body=body,
+        attachment_name=attachment_name,
+        attachment=attachment,
+        attachment_type=attachment_type,
+    )
+
+def _to_message(email: OutboxEmail) -> EmailMessage:
+    message = EmailMessage(email.subject, email.body, to=email.to)
+    if email.attachment is not None:
+        message.attach(email.attachment_name, bytes(email.attachment), email.attachment_type)
+    return message
+
+def _record_failure(email: OutboxEmail, error: Exception):
+    """Schedules the next attempt, or gives up once out of attempts (the claim already counted this one)"""
+    email.last_error = str(error)
+    if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        email.status = OutboxEmail.Status.FAILED
+    else:
+        email.next_attempt_at = timezone.now() + timedelta(seconds=settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1))
+
+def _record(email: OutboxEmail):
+    # Unless another worker claimed it again in the meantime (this one took longer than its lease)
+    OutboxEmail.objects.filter(id=email.id, status=OutboxEmail.Status.PENDING, attempts=email.attempts).update(
+        status=email.status, next_attempt_at=email.next_attempt_at, last_error=email.last_error, sent_at=email.sent_at,
+    )
+
+def _lease_expiry():
+    return timezone.now() + timedelta(seconds=getattr(settings, "EMAIL_OUTBOX_LEASE", 300))
+
+def claim_emails(batch_size: int) -> list:
+    """
+    Claims up to batch_size due emails for this worker and returns them. Each one counts as an attempt, and isn't due
+    again until EMAIL_OUTBOX_LEASE seconds from now, so other workers leave it alone while it's being sent, and it's
+    sent again later if this worker dies first. Safe to call from any number of workers at once.
+    """
+    now = timezone.now()
+    due = OutboxEmail.objects.filter(status=OutboxEmail.Status.PENDING, next_attempt_at__lte=now)
+    # Emails whose worker died while sending them on their last attempt
+    due.filter(attempts__gte=settings.EMAIL_OUTBOX_MAX_ATTEMPTS).update(
+        status=OutboxEmail.Status.FAILED, last_error="The worker sending it stopped",
+    )
+    due = due.order_by('next_attempt_at')
+    if connection.features.has_select_for_update_skip_locked:
+        # Postgres: rows locked by other workers are skipped instead of waited on. Only locked while claiming
+        with transaction.atomic():
+            batch = list(due.select_for_update(skip_locked=True)[:batch_size])
+            expires = _lease_expiry()
+            for email in batch:
+                email.attempts += 1
+                email.next_attempt_at = expires
+            OutboxEmail.objects.bulk_update(batch, ['attempts', 'next_attempt_at'])
+        return batch
+    # SQLite: no row locks, so claim with conditional updates and skip emails someone else got to first
+    batch = []
+    for email in due[:batch_size]:
+        claimed = OutboxEmail.objects.filter(id=email.id, status=OutboxEmail.Status.PENDING, attempts=email.attempts).update(
+            attempts=F('attempts') + 1, next_attempt_at=_lease_expiry(),
+        )
+        if claimed:
+            email.attempts += 1
+            batch.append(email)
+    return batch
+
+def deliver_pending(batch_size: int = None) -> int:
+    """
+    Claims up to batch_size due emails (see claim_emails) and sends them over a single SMTP connection,
+    recording each result as soon as it's known. No transaction is held open while talking to the mail server.
+    Failed emails are retried with exponential backoff (EMAIL_OUTBOX_RETRY_DELAY, doubled every attempt)
+    up to EMAIL_OUTBOX_MAX_ATTEMPTS times. Returns how many emails were looked at.
+    """
+    batch = claim_emails(batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE)
+    if not batch:
+        return 0
+    
+    mail_connection = get_connection()
+    try:
+        mail_connection.open()
+    except Exception as e:
+        # Couldn't even reach the mail server, so the whole batch failed this time around
+        for email in batch:
+            _record_failure(email, e)
+            _record(email)
+        return len(batch)
+    try:
+        for email in batch:
+            try:
+                with phase("smtp"):
+                    mail_connection.send_messages([_to_message(email)])
+            except Exception as e:
+                _record_failure(email, e)
+            else:
+                email.status = OutboxEmail.Status.SENT
+                email.sent_at = timezone.now()
+                email.last_error = ""
+            _record(email)
+    finally:
+        mail_connection.close()
+    return len(batch)
@@ -0,0 +1,106 @@
+import json
+from asgiref.sync import sync_to_async
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+from rest_framework.response import Response
+from rest_framework import status
+
+def _reversed(field: str) -> str:
+    return field[1:] if field.startswith('-') else f"-{field}"
+
+class KeysetPagination(CursorPagination):
+    """
+    Keyset (cursor) pagination over an ordering that ends with a unique field (see get_ordering).
+    The cursor holds the last row's value of every ordering field, and the next page is the rows after it:
+    (field > value) OR (field = value AND pk > last pk), a range scan on the (field, pk) index.
+    So fetching page 500 costs the same as fetching page 1, and rows sharing a value are never skipped or repeated
+    (unlike DRF's CursorPagination, which only keys on the first field and OFFSETs past ties).
+    """
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+    def __init__(self, ordering):
+        self.ordering = tuple(ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        # Previous pages are read backwards from the cursor, then put back in order
+        ordering = tuple(_reversed(field) for field in self.ordering) if reverse else self.ordering
+        self.attnames = [queryset.model._meta.get_field(field.lstrip('-')).attname for field in ordering]
+        queryset = queryset.order_by(*ordering)
+        if self.cursor is not None:
+            queryset = queryset.filter(self._after(ordering, self._decode_position(self.cursor.position)))
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+        return self.page
+
+    @staticmethod
+    def _after(ordering, values) -> Q:
+        """Rows after values in the ordering: (a > x) OR (a = x AND b > y) OR ..."""
+        condition = Q()
+        equal = {}
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            condition |= Q(**equal, **{f"{name}__{'lt' if field.startswith('-') else 'gt'}": value})
+            equal[name] = value
+        return condition
+
+    def _decode_position(self, position):
+        try:
+            values = json.loads(position)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    def _link(self, obj, reverse: bool):
+        # Values are sent as strings (Decimals, dates...), the database converts them back when filtering
+        values = [str(getattr(obj, attname)) for attname in self.attnames]
+        return self.encode_cursor(Cursor(offset=0, reverse=reverse, position=json.dumps(values)))
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self._link(self.page[-1], False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self._link(self.page[0], True)
+
+def paginated_response(request, queryset, serializer_class, ordering):
+    """
+    Responds with a page of results when the client asks for one (by sending 'cursor' or 'page_size'),
+    otherwise with the full list like before so existing clients keep working.
+    """
+    if "cursor" not in request.query_params and "page_size" not in request.query_params:
+        serializer = serializer_class(queryset.order_by(*ordering), many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+    paginator = KeysetPagination(ordering)
+    page = paginator.paginate_queryset(queryset, request)
+    return paginator.get_paginated_response(serializer_class(page, many=True).data)
+
+async def apaginated_data(request, queryset, serializer_class, ordering):
+    """
+    Async version of paginated_response (for async_views.py). Returns the data rather than a response.
+    The serializer must not need anything the queryset didn't fetch, since it runs outside of sync_to_async.
+    """
+    if "cursor" not in request.query_params and "page_size" not in request.query_params:
+        objects = [obj async for obj in queryset.order_by(*ordering)]
+        return serializer_class(objects, many=True).data
+    paginator = KeysetPagination(ordering)
+    page = await sync_to_async(paginator.paginate_queryset)(queryset, request)
+    return paginator.get_paginated_response(serializer_class(page, many=True).data).data
@@ -1,3 +1,5 @@
+import hmac
+from django.conf import settings
 from rest_framework.permissions import BasePermission, SAFE_METHODS
 
 class ReadOnlyOrAdmin(BasePermission):
@@ -9,3 +11,14 @@ class ReadOnlyOrAdmin(BasePermission):
         if request.method in SAFE_METHODS: # GET, HEAD, OPTIONS
             return True
         return request.user and request.user.is_staff
+
+class HasMetricsToken(BasePermission):
+    """
+    Requires an "Authorization: Bearer <BOM_METRICS_TOKEN>" header (a static token, which Prometheus can send).
+    Denies everyone while the setting is unset.
+    """
+    def has_permission(self, request, view):
+        token = getattr(settings, "BOM_METRICS_TOKEN", None)
+        if not token:
+            return False
+        return hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode())
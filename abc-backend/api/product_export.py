@@ -0,0 +1,64 @@
+import csv
+import json
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+# Streaming product export (GET /api/product/export). Rows come straight from the database in chunks and are
+# written out as they arrive, so memory stays flat however big the catalog is.
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+# Same columns as an import (see product_import.py, which ignores the computed customer price), so an export can be
+# edited and imported back. Foreign keys are the names themselves, so .values() needs no joins
+EXPORT_COLUMNS = ("part", "description", "manufacturer", "classification", "device_role", "end_of_support", "list_price", "discount", "customer_price")
+
+class _Echo:
+    """A file-like object whose write() just returns what was written, so csv.writer can format one row at a time"""
+    def write(self, value):
+        return value
+
+def _csv_value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+def stream_products(queryset, export_format: str, chunk_size: int = None):
+    """
+    Yields the products in the queryset as CSV (with a header row) or newline-delimited JSON,
+    one chunk of chunk_size (PRODUCT_EXPORT_CHUNK_SIZE by default) rows at a time.
+    Decimals are written as strings, like the API does.
+    """
+    chunk_size = chunk_size or getattr(settings, "PRODUCT_EXPORT_CHUNK_SIZE", 2000)
+    rows = queryset.values_list(*EXPORT_COLUMNS).iterator(chunk_size=chunk_size)
+    if export_format == "csv":
+        writer = csv.writer(_Echo())
+        # Sent before the first query, so the download starts right away
+        yield writer.writerow(EXPORT_COLUMNS)
+        format_row = lambda row: writer.writerow([_csv_value(value) for value in row])
+    else:
+        encoder = DjangoJSONEncoder(separators=(",", ":"))
+        format_row = lambda row: encoder.encode(dict(zip(EXPORT_COLUMNS, row))) + "\n"
+    lines = []
+    for row in rows:
+        lines.append(format_row(row))
+        if len(lines) >= chunk_size:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+async def astream_products(queryset, export_format: str, chunk_size: int = None):
+    """
+    Async version of stream_products (for async_views.py). Django would read a sync iterator all into memory before
+    sending it from an async view, so this fetches and formats each chunk in a thread as the response is sent.
+    """
+    # Created here but only ever advanced on the request's (sync) thread, like QuerySet.aiterator() does
+    chunks = stream_products(queryset, export_format, chunk_size)
+    try:
+        while (chunk := await sync_to_async(next)(chunks, None)) is not None:
+            yield chunk
+    finally:
+        # Closes the database cursor if the client went away
+        await sync_to_async(chunks.close)()
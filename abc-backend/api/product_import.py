@@ -0,0 +1,179 @@
+import csv
+import io
+from datetime import date, datetime, time
+from django.conf import settings
+from django.db import transaction
+from django.utils.dateparse import parse_date
+from openpyxl import load_workbook
+from rest_framework import serializers
+from .cache import BOM_RESULTS_VERSION, bump_version, bump_catalog_version
+from .models import Manufacturer, Classification, DeviceRole, Product
+from .response_cache import invalidate_responses, list_scope, PRODUCT_SCOPE
+from .serializers import ProductSerializer
+
+# Bulk product import (POST /api/product/import and the import_products command). Rows are read one at a time,
+# checked without touching the database, and upserted in batches. Bad rows are reported instead of failing the import.
+
+IMPORT_FORMATS = ("csv", "xlsx")
+
+# Columns an import can have. Headers are matched ignoring case, spaces and dashes (so "Device Role" works too)
+IMPORT_COLUMNS = ("part", "description", "manufacturer", "classification", "device_role", "end_of_support", "list_price", "discount")
+REQUIRED_COLUMNS = ("part", "manufacturer", "classification")
+
+# Named product properties, by column
+PROPERTY_MODELS = {
+    "manufacturer": Manufacturer,
+    "classification": Classification,
+    "device_role": DeviceRole,
+}
+
+def _column_name(header) -> str:
+    return str(header or "").strip().lower().replace(" ", "_").replace("-", "_")
+
+def _iter_csv(file):
+    # utf-8-sig drops the byte order mark Excel likes to add
+    reader = csv.reader(io.TextIOWrapper(file, encoding="utf-8-sig", newline=""))
+    yield from reader
+
+def _iter_xlsx(file):
+    # Read-only mode streams the sheet instead of loading all of it
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def read_rows(file, file_format: str):
+    """
+    Yields (row number, {column: value}) for each non-empty row of a CSV or XLSX file (binary).
+    The first row is the header. Raises ValueError if required columns are missing.
+    """
+    if file_format not in IMPORT_FORMATS:
+        raise ValueError(f"Format must be one of {', '.join(IMPORT_FORMATS)}")
+    rows = _iter_csv(file) if file_format == "csv" else _iter_xlsx(file)
+    header = [_column_name(value) for value in next(rows, [])]
+    missing = [column for column in REQUIRED_COLUMNS if column not in header]
+    if missing:
+        raise ValueError(f"Missing column(s): {', '.join(missing)}")
+    # Unknown columns are ignored
+    columns = [(index, column) for index, column in enumerate(header) if column in IMPORT_COLUMNS]
+    for number, row in enumerate(rows, start=2):
+        values = {column: row[index] if index < len(row) else None for index, column in columns}
+        # Blank cells are empty strings in CSVs and None in spreadsheets
+        values = {column: None if isinstance(value, str) and not value.strip() else value for column, value in values.items()}
+        if any(value is not None for value in values.values()):
+            yield number, values
+
+def format_from_filename(filename: str) -> str:
+    return filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+
+class ProductRowChecker:
+    """
+    Turns a row into Product field values, using the product serializer's own field validation for plain values.
+    Foreign keys are only checked for being a valid name (missing ones get created), so nothing hits the database.
+    """
+    def __init__(self):
+        fields = ProductSerializer().fields
+        self.fields = {name: fields[name] for name in ("end_of_support", "list_price", "discount")}
+        self.part_field = serializers.CharField(max_length=Product._meta.get_field("part").max_length)
+        self.name_fields = {
+            column: serializers.CharField(max_length=model._meta.get_field("name").max_length)
+            for column, model in PROPERTY_MODELS.items()
+        }
+
+    def check(self, values: dict):
+        """Returns (field values, errors). Errors map a column to a list of messages"""
+        cleaned, errors = {}, {}
+        for column, value in values.items():
+            try:
+                if column == "part":
+                    cleaned["part"] = self.part_field.run_validation(str(value).strip() if value is not None else None)
+                elif column in self.name_fields:
+                    if value is None and column == "device_role":
+                        cleaned["device_role_id"] = None
+                        continue
+                    name = self.name_fields[column].run_validation(str(value).strip() if value is not None else None)
+                    # Same rule as the property serializers
+                    if name.lower() == "none":
+                        raise serializers.ValidationError("Value cannot be 'None'")
+                    cleaned[f"{column}_id"] = name
+                elif column == "description":
+                    cleaned["description"] = "" if value is None else str(value)
+                else:
+                    # Plain dates mean the start of the day
+                    if column == "end_of_support" and isinstance(value, str) and parse_date(value.strip()):
+                        value = parse_date(value.strip())
+                    if column == "end_of_support" and isinstance(value, date) and not isinstance(value, datetime):
+                        value = datetime.combine(value, time())
+                    cleaned[column] = None if value is None else self.fields[column].run_validation(value)
+            except serializers.ValidationError as e:
+                errors[column] = [str(detail) for detail in e.detail]
+        return cleaned, errors
+
+def _ensure_properties(batch: list, known: dict):
+    """Creates the manufacturers, classifications and device roles used by a batch that don't exist yet"""
+    for column, model in PROPERTY_MODELS.items():
+        names = {values[f"{column}_id"] for values in batch if values.get(f"{column}_id")} - known[column]
+        if names:
+            model.objects.bulk_create([model(name=name) for name in sorted(names)], ignore_conflicts=True)
+            known[column] |= names
+            # bulk_create skips the signals that drop cached responses
+            invalidate_responses(list_scope(model))
+
+def _upsert(batch: list, update_fields: list) -> int:
+    """Inserts or updates a batch of products. Returns how many of them already existed"""
+    parts = [values["part"] for values in batch]
+    existing = Product.objects.filter(part__in=parts).count()
+    Product.objects.bulk_create([Product(**values) for values in batch], update_conflicts=True, unique_fields=["part"], update_fields=update_fields)
+    invalidate_responses(*[PRODUCT_SCOPE.format(pk=part) for part in parts])
+    return existing
+
+def import_products(file, file_format: str, batch_size: int = None, dry_run: bool = False) -> dict:
+    """
+    Creates or updates products from a CSV or XLSX file (see read_rows), batch_size rows at a time
+    (PRODUCT_IMPORT_BATCH_SIZE by default) in a single transaction. Columns that aren't in the file are left
+    as they are on existing products. Missing manufacturers, classifications and device roles are created.
+    A part listed more than once keeps its last row. Rows with errors are skipped and reported.
+    Returns {"rows", "created", "updated", "errors": [{"row", "part", "errors": {column: [messages]}}]}.
+    dry_run does everything, then rolls back.
+    """
+    batch_size = batch_size or getattr(settings, "PRODUCT_IMPORT_BATCH_SIZE", 1000)
+    checker = ProductRowChecker()
+    report = {"rows": 0, "created": 0, "updated": 0, "errors": []}
+    update_fields = None
+    known = {column: set(model.objects.values_list("name", flat=True)) for column, model in PROPERTY_MODELS.items()}
+    # part -> field values. A dict, since a batch can't upsert the same row twice
+    batch = {}
+
+    def flush_batch():
+        rows = list(batch.values())
+        batch.clear()
+        _ensure_properties(rows, known)
+        updated = _upsert(rows, update_fields)
+        report["updated"] += updated
+        report["created"] += len(rows) - updated
+
+    with transaction.atomic():
+        for number, values in read_rows(file, file_format):
+            report["rows"] += 1
+            if update_fields is None:
+                # Every column in the file except the key
+                update_fields = [f"{column}_id" if column in PROPERTY_MODELS else column for column in values if column != "part"]
+            cleaned, errors = checker.check(values)
+            if errors:
+                report["errors"].append({"row": number, "part": values.get("part"), "errors": errors})
+                continue
+            # Re-inserted so the part moves to the end, keeping the batch in file order
+            batch.pop(cleaned["part"], None)
+            batch[cleaned["part"]] = cleaned
+            if len(batch) >= batch_size:
+                flush_batch()
+        if batch:
+            flush_batch()
+        if dry_run:
+            transaction.set_rollback(True)
+        elif report["created"] or report["updated"]:
+            # bulk_create skips the signals that normally throw away cached products and BOMs
+            bump_catalog_version()
+            bump_version(BOM_RESULTS_VERSION)
+    return report
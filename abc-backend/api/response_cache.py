@@ -0,0 +1,140 @@
+import functools
+import hashlib
+import time
+import uuid
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+from .cache import LRUCache
+from .metrics import RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES, RESPONSE_CACHE_EVICTIONS
+
+# Response cache for the read endpoints: pattern list / detail, product detail and the manufacturer, device role and
+# classification lists. The data of their GET responses is kept in the API_RESPONSE_CACHE backend, so with a shared
+# backend (file or db, see CACHES) every worker (and node) serves the same entries.
+#
+# Each endpoint's responses belong to scopes (like "pattern:list" or "product:<part>"), which each have a version in the
+# cache. An entry is stored with the versions of its scopes, and is only served while they're still current, so the
+# signals (see signals.py) drop the versions of exactly the scopes a change shows up in to invalidate those entries for
+# every worker at once. The entry and its scopes' versions are fetched together, so a hit is a single cache lookup.
+
+SCOPE_KEY = "api:response-scope:{}"
+ENTRY_KEY = "api:response:{}:{}"
+
+PATTERN_LIST_SCOPE = "pattern:list"
+PATTERN_SCOPE = "pattern:{id}"
+PRODUCT_SCOPE = "product:{pk}"
+
+def list_scope(model) -> str:
+    """Scope of a model's list endpoint (like "manufacturer:list")"""
+    return f"{model._meta.model_name}:list"
+
+def _response_cache():
+    alias = getattr(settings, "API_RESPONSE_CACHE", None)
+    return caches[alias] if alias else None
+
+def _hash(value: str) -> str:
+    # Part numbers and query strings can contain characters some backends don't allow in keys
+    return hashlib.md5(value.encode()).hexdigest()
+
+def _scope_versions(cache, keys: list, found: dict) -> list:
+    """
+    The current version of each scope (by key), from what get_many found.
+    Scopes without one (never used, invalidated or evicted) get a fresh one.
+    """
+    missing = {key: uuid.uuid4().hex for key in keys if key not in found}
+    if missing:
+        for key, version in missing.items():
+            cache.add(key, version, timeout=None)
+        # Another worker may have added its own version in the meantime
+        found = {**found, **missing, **cache.get_many(list(missing))}
+    return [found[key] for key in keys]
+
+# Entries this worker stored, and when they expire. A miss on one of them before then means the backend culled it.
+# Only tracks entries, not their size
+_stored = LRUCache(10000, 0)
+
+def get_cached_response(request, endpoint: str, scopes: list) -> tuple:
+    """
+    Looks up the data of a GET response in the response cache. Returns (entry, data), data being None on a miss:
+    pass the entry and the data to set_cached_response once it's built. The entry is None when the cache is off.
+    """
+    cache = _response_cache()
+    if cache is None:
+        return None, None
+    key = ENTRY_KEY.format(endpoint, _hash(request.get_full_path()))
+    scope_keys = [SCOPE_KEY.format(_hash(scope)) for scope in scopes]
+    found = cache.get_many([key, *scope_keys])
+    versions = _scope_versions(cache, scope_keys, found)
+    cached = found.get(key)
+    if cached is not None and cached[0] == versions:
+        RESPONSE_CACHE_HITS.inc(endpoint)
+        return (key, versions), cached[1]
+    RESPONSE_CACHE_MISSES.inc(endpoint)
+    expires = _stored.get(key)
+    if cached is None and expires is not None and time.monotonic() < expires:
+        RESPONSE_CACHE_EVICTIONS.inc(endpoint)
+    return (key, versions), None
+
+def set_cached_response(entry: tuple, data):
+    cache = _response_cache()
+    if cache is None or entry is None:
+        return
+    key, versions = entry
+    timeout = getattr(settings, "API_RESPONSE_CACHE_TIMEOUT", 60 * 60)
+    # Replaces any out of date version of the response
+    cache.set(key, (versions, data), timeout=timeout)
+    _stored.set(key, time.monotonic() + timeout)
+
+def cached_response(request, endpoint: str, scopes: list, view) -> Response:
+    """Responds with the cached data of a GET request, or calls view() and caches its data (if it's a 200)"""
+    entry, data = get_cached_response(request, endpoint, scopes)
+    if data is not None:
+        return Response(data, status=status.HTTP_200_OK)
+    response = view()
+    if entry is not None and response.status_code == status.HTTP_200_OK:
+        set_cached_response(entry, response.data)
+    return response
+
+async def acached_data(request, endpoint: str, scopes: list, build):
+    """Async version of cached_response (for async_views.py). build is a coroutine function returning the data"""
+    entry, data = await sync_to_async(get_cached_response)(request, endpoint, scopes)
+    if data is None:
+        data = await build()
+        await sync_to_async(set_cached_response)(entry, data)
+    return data
+
+def cache_response(endpoint: str, *scopes: str):
+    """
+    Caches a function view's GET responses under the endpoint's name until one of the scopes is invalidated.
+    Scopes can use the view's keyword arguments (like PATTERN_SCOPE). Goes under @api_view and @permission_classes,
+    so requests are still authenticated and checked first.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != "GET":
+                return view(request, *args, **kwargs)
+            return cached_response(request, endpoint, [scope.format(**kwargs) for scope in scopes], lambda: view(request, *args, **kwargs))
+        return wrapper
+    return decorator
+
+class CachedListMixin:
+    """Caches a generic list view's responses (see cache_response) until its model's list scope is invalidated"""
+    def list(self, request, *args, **kwargs):
+        model = self.get_queryset().model
+        return cached_response(request, f"{model._meta.model_name}-list", [list_scope(model)], lambda: super(CachedListMixin, self).list(request, *args, **kwargs))
+
+def invalidate_responses(*scopes: str):
+    """
+    Drops every cached response in these scopes (for every worker sharing the cache), right away and again once the
+    current transaction commits, in case a request read the old rows in between and cached them with a new version.
+    """
+    cache = _response_cache()
+    if cache is None or not scopes:
+        return
+    keys = [SCOPE_KEY.format(_hash(scope)) for scope in scopes]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
@@ -1,23 +1,30 @@
 from rest_framework import serializers
 from .models import *
+from .utils import load_yaml
 import yaml
 
+class PatternGroupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PatternGroup
+        fields = '__all__'
+        read_only_fields = ('last_version', 'latest')
+
 class PatternSerializer(serializers.ModelSerializer):
     questions = serializers.SerializerMethodField()
-    pattern_group = serializers.SerializerMethodField() # include pattern group too
+    pattern_group = PatternGroupSerializer(source='group', read_only=True) # include pattern group too
     
     class Meta:
         model = Pattern
-        exclude = ('group',)
-    
-    # Although we aren't using these getters directly, Django will look for a getter named after our local variables
-    # because we defined variables "questions" and "pattern_group". Same applies to the getter in PatternSummarySerializer
-    def get_pattern_group(self, obj):
-        return PatternGroupSerializer(obj.group).data
+        exclude = ('group', 'answer_table')
     
+    # Although we aren't using this getter directly, Django will look for a getter named after our local variable
+    # because we defined the variable "questions"
     def get_questions(self, obj):
+        # Questions are stored alongside the YAML whenever a pattern is saved, so only parse as a fallback
+        if obj.questions:
+            return obj.questions
         try:
-            parsed = yaml.safe_load(obj.yaml)
+            parsed = load_yaml(obj.yaml)
             if not isinstance(parsed, dict):
                 return []
             return parsed.get('questions', [])
@@ -25,7 +32,7 @@ class PatternSerializer(serializers.ModelSerializer):
             return []
     
     def validate_yaml(self, value):
-        parsed = yaml.safe_load(value)
+        parsed = load_yaml(value)
         if not isinstance(parsed, dict):
             raise serializers.ValidationError("YAML is malformed")
         # Ensure we don't have duplicate question names
@@ -44,24 +51,29 @@ class PatternSerializer(serializers.ModelSerializer):
         
         return value
 
-class PatternGroupSerializer(serializers.ModelSerializer):
-    patterns = PatternSerializer(many=True, read_only=True)
-    
+class PatternGroupSummarySerializer(serializers.ModelSerializer):
     class Meta:
         model = PatternGroup
-        fields = '__all__'
+        fields = ('name', 'description')
 
+# Lean representation for listing patterns. Only embeds the group's name and description,
+# so the payload stays linear in the number of versions
 class PatternSummarySerializer(serializers.ModelSerializer):
-    pattern_group = serializers.SerializerMethodField()
+    pattern_group = PatternGroupSummarySerializer(source='group', read_only=True)
     
     class Meta:
         model = Pattern
-        exclude = ('group', 'yaml', 'questions')
-    
-    def get_pattern_group(self, obj):
-        return PatternGroupSerializer(obj.group).data
+        exclude = ('group', 'yaml', 'questions', 'answer_table')
+
+class BomJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BomJob
+        exclude = ('result',)
 
 class ProductSerializer(serializers.ModelSerializer):
+    # Computed by the database (see Product.customer_price)
+    customer_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+    
     class Meta:
         model = Product
         fields = '__all__'
@@ -0,0 +1,74 @@
+from django.db.models.signals import post_save, post_delete, post_migrate
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.dispatch import receiver
+from .models import PatternGroup, Pattern, Product, Manufacturer, DeviceRole, Classification
+from .cache import invalidate_pattern, invalidate_product, bump_catalog_version, bump_version, BOM_RESULTS_VERSION
+from .response_cache import invalidate_responses, list_scope, PATTERN_LIST_SCOPE, PATTERN_SCOPE, PRODUCT_SCOPE
+
+# Drop the compiled pattern as soon as its YAML may have changed
+@receiver([post_save, post_delete], sender=Pattern)
+def pattern_changed(sender, instance, **kwargs):
+    invalidate_pattern(instance.pk)
+
+# Keep the group's version counter and latest version pointer in sync
+@receiver(post_save, sender=Pattern)
+def pattern_saved(sender, instance, **kwargs):
+    # Versions can also be set by hand (or come from before the counter existed)
+    PatternGroup.objects.filter(pk=instance.group_id, last_version__lt=instance.version).update(last_version=instance.version)
+    PatternGroup.refresh_latest(instance.group_id)
+
+@receiver(post_delete, sender=Pattern)
+def pattern_deleted(sender, instance, **kwargs):
+    PatternGroup.refresh_latest(instance.group_id)
+
+# Fills in the counters and pointers of groups that existed before them (runs on every migrate, in one statement).
+# The counter only ever goes up: it's past the numbers of deleted versions too, and those aren't given out again
+@receiver(post_migrate)
+def backfill_pattern_groups(sender, app_config, using, **kwargs):
+    if app_config.name != "api":
+        return
+    patterns = Pattern.objects.using(using).filter(group=OuterRef('pk'))
+    PatternGroup.objects.using(using).update(
+        last_version=Greatest(F('last_version'), Coalesce(Subquery(patterns.order_by('-version').values('version')[:1]), 0)),
+        latest=Subquery(patterns.filter(deprecated=False).order_by('-version').values('id')[:1]),
+    )
+
+@receiver([post_save, post_delete], sender=Product)
+def product_changed(sender, instance, **kwargs):
+    invalidate_product(instance.pk)
+
+# Cached products embed manufacturer / device role names, so start the whole product cache over
+@receiver([post_save, post_delete], sender=Manufacturer)
+@receiver([post_save, post_delete], sender=DeviceRole)
+def product_property_changed(sender, instance, **kwargs):
+    bump_catalog_version()
+
+# Anything that shows up in a BOM makes every rendered BOM stale. A pattern change only makes its own stale, and those
+# are keyed by its YAML (see bom_result_key), so it doesn't throw away every other pattern's
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Manufacturer)
+@receiver([post_save, post_delete], sender=DeviceRole)
+def bom_inputs_changed(sender, instance, **kwargs):
+    bump_version(BOM_RESULTS_VERSION)
+
+# Cached API responses (see response_cache.py): drop just the ones showing what changed
+@receiver([post_save, post_delete], sender=Pattern)
+@receiver([post_save, post_delete], sender=PatternGroup)
+def pattern_responses_changed(sender, instance, **kwargs):
+    group_id = instance.pk if sender is PatternGroup else instance.group_id
+    # Every version of the group shows the group (and its latest version pointer, which may have just moved)
+    ids = set(Pattern.objects.filter(group_id=group_id).values_list('pk', flat=True))
+    if sender is Pattern:
+        ids.add(instance.pk)
+    invalidate_responses(PATTERN_LIST_SCOPE, *[PATTERN_SCOPE.format(id=id) for id in ids])
+
+@receiver([post_save, post_delete], sender=Product)
+def product_responses_changed(sender, instance, **kwargs):
+    invalidate_responses(PRODUCT_SCOPE.format(pk=instance.pk))
+
+@receiver([post_save, post_delete], sender=Manufacturer)
+@receiver([post_save, post_delete], sender=DeviceRole)
+@receiver([post_save, post_delete], sender=Classification)
+def product_property_responses_changed(sender, instance, **kwargs):
+    invalidate_responses(list_scope(sender))
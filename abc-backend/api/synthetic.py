@@ -0,0 +1,145 @@
+import random
+import textwrap
+from datetime import timedelta
+from django.db import transaction
+from django.utils import timezone
+from .models import Manufacturer, Classification, DeviceRole, Product, PatternGroup, Pattern
+from .cache import BOM_RESULTS_VERSION, bump_version, bump_catalog_version
+from .response_cache import invalidate_responses, list_scope, PRODUCT_SCOPE
+
+# Synthetic data for load testing and benchmarks (see the generate_catalog and bom_benchmark commands).
+# Everything is named with a prefix so it's easy to tell apart from (and delete without touching) real data.
+
+SYNTHETIC_PREFIX = "SYN"
+
+# Questions every synthetic pattern asks. 8 * 49 * 2 * 3 = 2,352 combinations of answers
+SYNTHETIC_QUESTIONS = textwrap.dedent("""
+questions:
+- name: racks
+  type: integer
+  min: 1
+  max: 8
+  prompt: "How many racks?"
+  default: 2
+- name: hosts
+  type: integer
+  min: 0
+  max: 48
+  prompt: "How many hosts per rack?"
+  default: 16
+- name: redundant
+  type: boolean
+  prompt: "Redundant uplinks?"
+  default: true
+- name: support_years
+  type: enum
+  choices: [1, 3, 5]
+  prompt: "Years of support?"
+  default: 3
+""")
+
+# Answers that exercise most of the rules in a synthetic pattern
+SYNTHETIC_ANSWERS = {"racks": 8, "hosts": 48, "redundant": True, "support_years": 5}
+
+# (condition, quantity) templates for the rules. {n} is replaced with a small number
+RULE_TEMPLATES = [
+    (None, "1"),
+    (None, "racks * {n}"),
+    ("racks > {n}", "racks - {n}"),
+    ("redundant", "racks * 2"),
+    ("hosts > {n}", "hosts // {n} + 1"),
+    ("support_years in [3, 5] and racks >= {n}", "racks"),
+    ("not redundant or hosts > 24", "max(1, hosts // 8)"),
+    (None, "0 if not redundant else racks * {n}"),
+]
+
+def synthetic_pattern_yaml(parts: list, rules: int, rng: random.Random) -> str:
+    """A pattern with the synthetic questions and the given number of rules, each adding one of the parts"""
+    lines = [SYNTHETIC_QUESTIONS.strip(), "products:"]
+    for index in range(rules):
+        # A raw row now and then, like a section heading
+        if index % 50 == 0:
+            lines.append(f"- add:\n    raw: [\"Section {index // 50 + 1}\"]")
+            continue
+        condition, quantity = rng.choice(RULE_TEMPLATES)
+        n = rng.randint(1, 4)
+        if condition:
+            lines.append(f"- condition: \"{condition.format(n=n)}\"")
+            lines.append("  add:")
+        else:
+            lines.append("- add:")
+        lines.append(f"    product: \"{rng.choice(parts)}\"")
+        lines.append(f"    quantity: \"{quantity.format(n=n)}\"")
+    return "\n".join(lines) + "\n"
+
+@transaction.atomic
+def generate_catalog(products: int = 1000, pattern_groups: int = 10, versions: int = 5, rules: int = 200, seed: int = 0) -> dict:
+    """
+    Creates (or tops up) a synthetic catalog: manufacturers, classifications, device roles, products,
+    and pattern groups with several versions of patterns using those products.
+    Returns how many of each were created.
+    """
+    rng = random.Random(seed)
+    manufacturers = [Manufacturer(name=f"{SYNTHETIC_PREFIX} Manufacturer {index}") for index in range(max(1, products // 500))]
+    classifications = [Classification(name=f"{SYNTHETIC_PREFIX} Classification {index}") for index in range(10)]
+    roles = [DeviceRole(name=f"{SYNTHETIC_PREFIX} Role {index}") for index in range(10)]
+    for model, objects in ((Manufacturer, manufacturers), (Classification, classifications), (DeviceRole, roles)):
+        model.objects.bulk_create(objects, ignore_conflicts=True)
+        invalidate_responses(list_scope(model))
+
+    # Products are bulk inserted (no save() or signals), in batches to keep memory flat
+    now = timezone.now()
+    existing = set(Product.objects.filter(part__startswith=f"{SYNTHETIC_PREFIX}-").values_list("part", flat=True))
+    new_products = []
+    created_products = 0
+    for index in range(products):
+        part = f"{SYNTHETIC_PREFIX}-{index:06d}"
+        if part in existing:
+            continue
+        new_products.append(Product(
+            part=part,
+            description=f"Synthetic product {index} " + "with a longer description " * rng.randint(0, 3),
+            manufacturer=rng.choice(manufacturers),
+            classification=rng.choice(classifications),
+            device_role=rng.choice(roles) if rng.random() < 0.8 else None,
+            end_of_support=now + timedelta(days=rng.randint(-365, 5 * 365)) if rng.random() < 0.5 else None,
+            list_price=round(rng.uniform(5, 50000), 2),
+            discount=round(rng.choice([0, 0.05, 0.1, 0.25, 0.4]), 2),
+        ))
+        if len(new_products) >= 5000:
+            created_products += len(Product.objects.bulk_create(new_products))
+            new_products = []
+    created_products += len(Product.objects.bulk_create(new_products))
+    # bulk_create skips the signals that normally throw away cached products and BOMs
+    bump_catalog_version()
+    bump_version(BOM_RESULTS_VERSION)
+
+    # Patterns go through save() so they're validated (and get their questions) like real ones
+    parts = [f"{SYNTHETIC_PREFIX}-{index:06d}" for index in range(products)]
+    created_patterns = 0
+    for group_index in range(pattern_groups):
+        group, _ = PatternGroup.objects.get_or_create(
+            name=f"{SYNTHETIC_PREFIX.lower()}.pattern-{group_index}",
+            defaults={"description": f"Synthetic pattern {group_index}"},
+        )
+        for version in range(1, versions + 1):
+            if Pattern.objects.filter(group=group, version=version).exists():
+                continue
+            Pattern.objects.create(group=group, version=version, yaml=synthetic_pattern_yaml(parts, rules, rng))
+            created_patterns += 1
+    return {"products": created_products, "patterns": created_patterns}
+
+@transaction.atomic
+def delete_catalog() -> dict:
+    """Deletes everything generate_catalog created"""
+    patterns, _ = PatternGroup.objects.filter(name__startswith=f"{SYNTHETIC_PREFIX.lower()}.pattern-").delete()
+    # A plain DELETE: going through delete() would load every product to send its signals (one version bump each)
+    products_query = Product.objects.filter(part__startswith=f"{SYNTHETIC_PREFIX}-")
+    parts = list(products_query.values_list("part", flat=True))
+    products = products_query._raw_delete(products_query.db)
+    invalidate_responses(*[PRODUCT_SCOPE.format(pk=part) for part in parts])
+    for model in (Manufacturer, Classification, DeviceRole):
+        model.objects.filter(name__startswith=f"{SYNTHETIC_PREFIX} ").delete()
+    bump_catalog_version()
+    bump_version(BOM_RESULTS_VERSION)
+    return {"patterns": patterns, "products": products}
@@ -1,3 +1,1096 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import json
+import os
+import re
+import tempfile
+import textwrap
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from unittest import skipIf
+from decimal import Decimal
+from openpyxl import Workbook, load_workbook
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import connection
+from django.test import AsyncClient, LiveServerTestCase, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from django.contrib.auth.models import User
+from django.urls import include, path
+from rest_framework_simplejwt.tokens import AccessToken
+from .models import *
+from . import analytics, async_views, metrics, views
+from .analytics import price_envelope
+from .benchmarks import run_benchmarks, compare, load_test
+from .cache import pattern_cache, bom_result_cache, analytics_cache, cache_products, ResultCache
+from .expressions import compile_expression, ExpressionError
+from .jobs import claim_job, run_job, renew_lease, requeue_expired_jobs
+from .outbox import claim_emails, deliver_pending, queue_email
+from .product_import import import_products
+from .response_cache import get_cached_response, set_cached_response
+from .synthetic import generate_catalog
+from .utils import build_bom, build_boms, format_currency, generate_bom_from_yaml, get_compiled_pattern, get_products, render_bom_pdfs
+from .utils import run_render, get_render_pool, shutdown_render_pool, RenderUnavailable, layout_bom_pages, BOM_HEADERS
+from .utils import render_bom_pdf_file, temporary_file_path
 
-# Create your tests here.
+BOM_YAML = textwrap.dedent("""
+questions:
+- name: num_racks
+  type: integer
+  min: 0
+  max: 4
+  prompt: "How many racks?"
+  default: 2
+products:
+- add:
+    product: "switch"
+    quantity: 1
+- condition: "num_racks > 1"
+  add:
+    product: "cable"
+    quantity: "num_racks * 2"
+""")
+
+class BOMTestCase(TestCase):
+    def setUp(self):
+        pattern_cache.clear()
+        analytics_cache.clear()
+        # Cached responses from other tests' (rolled back) rows
+        cache.clear()
+        manufacturer = Manufacturer.objects.create(name="Acme")
+        classification = Classification.objects.create(name="Network")
+        role = DeviceRole.objects.create(name="Leaf")
+        Product.objects.create(part="switch", manufacturer=manufacturer, classification=classification,
+                               device_role=role, list_price=1000, discount=0.25)
+        Product.objects.create(part="cable", manufacturer=manufacturer, classification=classification,
+                               list_price=10, discount=0)
+        self.group = PatternGroup.objects.create(name="test.pattern", description="Test")
+        self.pattern = Pattern.objects.create(group=self.group, yaml=BOM_YAML)
+
+class CompiledPatternCacheTests(BOMTestCase):
+    def test_compiled_pattern_is_reused(self):
+        first = get_compiled_pattern(BOM_YAML, self.pattern.id)
+        self.assertIs(get_compiled_pattern(BOM_YAML, self.pattern.id), first)
+
+    def test_saving_pattern_invalidates_cache(self):
+        get_compiled_pattern(BOM_YAML, self.pattern.id)
+        self.pattern.description = "Changed"
+        self.pattern.save()
+        self.assertEqual(len(pattern_cache), 0)
+
+    def test_bom_uses_compiled_expressions(self):
+        pdf = generate_bom_from_yaml("test", BOM_YAML, {"num_racks": 3}, True, pattern_id=self.pattern.id)
+        self.assertTrue(pdf.startswith(b"%PDF"))
+        with self.assertRaisesMessage(TypeError, "must be <= 4"):
+            generate_bom_from_yaml("test", BOM_YAML, {"num_racks": 5}, True, pattern_id=self.pattern.id)
+
+class PatternValidationTests(BOMTestCase):
+    def test_clean_only_checks_products_exist(self):
+        # Nothing is rendered, the only query is the product existence check
+        with self.assertNumQueries(1):
+            self.pattern.clean()
+        self.assertEqual(self.pattern.questions[0]["name"], "num_racks")
+
+    def test_products_behind_false_conditions_are_checked(self):
+        yaml_text = BOM_YAML + '- condition: "num_racks > 3"\n  add:\n    product: "nope"\n    quantity: 1\n'
+        with self.assertRaisesMessage(ValidationError, "Product 'nope' does not exist"):
+            Pattern.objects.create(group=self.group, version=2, yaml=yaml_text)
+
+    def test_raw_rows_wider_than_the_bom_are_rejected(self):
+        with self.assertRaisesMessage(ValidationError, "'raw' list has too many entries"):
+            Pattern.objects.create(group=self.group, version=2, yaml="products:\n- add: {raw: [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]}\n")
+
+class AnswerTableTests(BOMTestCase):
+    def test_table_built_on_save(self):
+        # num_racks is 0-4
+        self.assertEqual(len(self.pattern.answer_table["parts"]), 5)
+        self.assertEqual(self.pattern.answer_table["parts"]["[3]"], [["switch", 1], ["cable", 6]])
+
+    def test_bom_is_a_lookup(self):
+        table = self.pattern.answer_table
+        table["parts"]["[3]"] = [["switch", 7]]
+        rows = build_bom(BOM_YAML, {"num_racks": 3}, True, self.pattern.id, answer_table=table)
+        self.assertEqual([row[0] for row in rows[2:-2]], ["switch"])
+        self.assertEqual(rows[2][4], 7)
+
+    def test_answers_outside_table_are_evaluated(self):
+        with self.assertRaisesMessage(TypeError, "must be <= 4"):
+            build_bom(BOM_YAML, {"num_racks": 5}, True, self.pattern.id, answer_table=self.pattern.answer_table)
+
+    def test_stale_table_is_ignored(self):
+        yaml_text = BOM_YAML.replace("num_racks * 2", "num_racks * 3")
+        Pattern.objects.filter(id=self.pattern.id).update(yaml=yaml_text)
+        rows = build_bom(yaml_text, {"num_racks": 3}, True, self.pattern.id, answer_table=self.pattern.answer_table)
+        self.assertEqual(rows[3][4], 9)
+
+    @override_settings(BOM_ANSWER_TABLE_MAX_SIZE=4)
+    def test_large_answer_spaces_are_not_tabled(self):
+        self.pattern.save()
+        self.assertIsNone(self.pattern.answer_table)
+
+class ProductResolutionTests(BOMTestCase):
+    def test_products_resolved_in_one_query(self):
+        get_compiled_pattern(BOM_YAML, self.pattern.id)
+        with self.assertNumQueries(1):
+            generate_bom_from_yaml("test", BOM_YAML, {"num_racks": 3}, True, pattern_id=self.pattern.id)
+
+    def test_all_missing_products_reported(self):
+        with self.assertRaisesMessage(ValueError, "Products 'nope', 'gone' do not exist"):
+            get_products(["switch", "nope", "gone"])
+
+    @override_settings(BOM_PRODUCT_CACHE="default")
+    def test_product_cache_invalidated_on_save(self):
+        get_products(["switch"])
+        with self.assertNumQueries(0):
+            get_products(["switch"])
+        Product.objects.filter(part="switch").update(list_price=2000)
+        Product.objects.get(part="switch").save()
+        self.assertEqual(get_products(["switch"])["switch"]["list_price"], 2000)
+
+    @override_settings(BOM_PRODUCT_CACHE="default")
+    def test_product_cache_invalidated_on_commit(self):
+        stale = get_products(["switch"])
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(part="switch").update(list_price=2000)
+            Product.objects.get(part="switch").save()
+            # Another request reads the row before the save is committed, and caches it again
+            cache_products(stale)
+        self.assertEqual(get_products(["switch"])["switch"]["list_price"], 2000)
+
+class PatternEndpointTests(BOMTestCase):
+    def test_pattern_list_query_count_is_constant(self):
+        for version in range(2, 6):
+            Pattern.objects.create(group=self.group, version=version, yaml=BOM_YAML)
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/pattern")
+        self.assertEqual(len(response.json()), 5)
+        self.assertEqual(response.json()[0]["pattern_group"], {"name": "test.pattern", "description": "Test"})
+
+    def test_new_versions_use_group_counter(self):
+        admin = User.objects.create_superuser("admin", password="admin")
+        client = APIClient()
+        client.force_authenticate(admin)
+        # A deleted version's number isn't given out again
+        Pattern.objects.create(group=self.group, version=2, yaml=BOM_YAML).delete()
+        # Locking the group, creating the pattern and updating the pointer, no aggregate over the group's versions
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post("/api/pattern", {"name": "test.pattern", "description": "v3"}, format="json")
+        self.assertEqual(response.json()["version"], 3)
+        self.assertFalse(any("MAX(" in query["sql"].upper() for query in queries))
+
+    def test_latest_version_pointer(self):
+        second = Pattern.objects.create(group=self.group, version=2, yaml=BOM_YAML)
+        self.group.refresh_from_db()
+        self.assertEqual((self.group.latest_id, self.group.last_version), (second.id, 2))
+        second.deprecated = True
+        second.save()
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.latest_id, self.pattern.id)
+        response = self.client.get("/api/pattern?latest=true")
+        self.assertEqual([pattern["id"] for pattern in response.json()], [self.pattern.id])
+        self.pattern.delete()
+        self.group.refresh_from_db()
+        self.assertIsNone(self.group.latest_id)
+
+    def test_backfill_pattern_groups(self):
+        second = Pattern.objects.create(group=self.group, version=2, yaml=BOM_YAML)
+        # Like a group from before the counter and pointer existed
+        PatternGroup.objects.update(last_version=0, latest=None)
+        call_command("migrate", verbosity=0)
+        self.group.refresh_from_db()
+        self.assertEqual((self.group.latest_id, self.group.last_version), (second.id, 2))
+
+        # Deleting the top version and migrating again doesn't give its number out again
+        Pattern.objects.create(group=self.group, version=3, yaml=BOM_YAML).delete()
+        call_command("migrate", verbosity=0)
+        self.group.refresh_from_db()
+        self.assertEqual((self.group.latest_id, self.group.last_version), (second.id, 3))
+        self.assertEqual(self.group.next_version(), 4)
+
+    def test_pattern_detail_serves_stored_questions(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(f"/api/pattern/{self.pattern.id}")
+        self.assertEqual(response.json()["questions"][0]["name"], "num_racks")
+
+class ProductListTests(BOMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser("admin", "admin@example.com", "admin"))
+
+    def test_unpaginated_list_is_unchanged(self):
+        response = self.client.get("/api/product")
+        self.assertEqual([product["part"] for product in response.json()], ["cable", "switch"])
+
+    def test_cursor_pagination_with_filters(self):
+        response = self.client.get("/api/product?page_size=1&manufacturer=Acme&ordering=-part")
+        self.assertEqual([product["part"] for product in response.json()["results"]], ["switch"])
+        response = self.client.get(response.json()["next"])
+        self.assertEqual([product["part"] for product in response.json()["results"]], ["cable"])
+        self.assertIsNone(response.json()["next"])
+
+    def test_cursor_pages_through_shared_values(self):
+        # More rows sharing the ordering value than DRF's CursorPagination would OFFSET past (offset_cutoff=1000)
+        manufacturer, classification = Manufacturer.objects.get(), Classification.objects.get()
+        Product.objects.bulk_create([Product(part=f"part-{i:04}", manufacturer=manufacturer, classification=classification)
+                                     for i in range(1300)])
+        for ordering in ("manufacturer", "-customer_price"):
+            parts, url = [], f"/api/product?page_size=100&ordering={ordering}"
+            # Bounded, so a cursor that never ends fails rather than hangs
+            while url and len(parts) <= 1302:
+                page = self.client.get(url).json()
+                parts += [product["part"] for product in page["results"]]
+                url = page["next"]
+            self.assertEqual(len(parts), 1302)
+            self.assertEqual(len(set(parts)), 1302)
+            # And back again
+            previous = []
+            while page["previous"]:
+                page = self.client.get(page["previous"]).json()
+                previous = [product["part"] for product in page["results"]] + previous
+            self.assertEqual(previous, parts[:len(previous)])
+            self.assertEqual(len(previous), 1300)
+
+    def test_invalid_cursor_rejected(self):
+        self.assertEqual(self.client.get("/api/product?cursor=bm90LWEtY3Vyc29y").status_code, 404)
+
+    def test_invalid_ordering_rejected(self):
+        self.assertEqual(self.client.get("/api/product?ordering=description").status_code, 400)
+
+    def test_customer_price_ordering_and_range(self):
+        response = self.client.get("/api/product?ordering=-customer_price")
+        self.assertEqual([(product["part"], product["customer_price"]) for product in response.json()], [("switch", "750.00"), ("cable", "10.00")])
+        response = self.client.get("/api/product?customer_price_min=10&customer_price_max=749.99")
+        self.assertEqual([product["part"] for product in response.json()], ["cable"])
+        self.assertEqual(self.client.get("/api/product?customer_price_min=cheap").status_code, 400)
+
+    def test_bom_uses_exact_customer_price(self):
+        # 144.10 * 0.75 = 108.075, which floats round down to 108.07
+        Product.objects.filter(part="switch").update(list_price=Decimal("144.10"))
+        rows = build_bom(BOM_YAML, {"num_racks": 2}, True)
+        self.assertEqual(rows[2][7:], [Decimal("108.08"), Decimal("108.08")])
+        self.assertEqual([str(price) for price in rows[2][7:]], ["$108.08", "$108.08"])
+        self.assertEqual(str(rows[-2][-1]), "$148.08")
+
+# A BOM with raw rows (of every type), products and a skipped empty row, and what the original renderer (an openpyxl
+# workbook converted by excel_to_pdf) drew for it: the page size and each string's (x, y, text)
+LAYOUT_YAML = textwrap.dedent("""
+questions:
+- name: num_racks
+  type: integer
+  min: 0
+  max: 4
+  prompt: "How many racks?"
+products:
+- add:
+    raw: ["Network", null, null, null, 2, true, 1.5]
+- add:
+    product: "switch"
+    quantity: 1
+- condition: "num_racks > 1"
+  add:
+    product: "cable"
+    quantity: "num_racks * 2"
+- add:
+    raw: ["Notes", "Labels 2024-01-02"]
+""")
+LAYOUT_PAGE_SIZE = (1872.0, 320.0)
+LAYOUT_TEXT = [
+    (55.6, 292.5, "Manufacturer Part #"), (361.1, 292.5, "Manufacturer"), (646.0, 292.5, "Description"), (882.1, 292.5, "Device Role"), (1064.4, 292.5, "Qty"), (1176.9, 292.5, "List Price"), (1347.1, 292.5, "Discount"), (1509.1, 292.5, "Customer Price"), (1739.2, 292.5, "Ext. Price"),
+    (107.3, 212.5, "Network"), (1074.4, 212.5, "2"), (1190.8, 212.5, "TRUE"), (1372.1, 212.5, "1.5"),
+    (116.2, 172.5, "switch"), (394.4, 172.5, "Acme"), (615.4, 172.5, "48 port leaf switch"), (916.5, 172.5, "Leaf"), (1074.4, 172.5, "1"), (1173.5, 172.5, "$1,000.00"), (1357.7, 172.5, "25.0%"), (1541.9, 172.5, "$750.00"), (1745.9, 172.5, "$750.00"),
+    (120.1, 132.5, "cable"), (394.4, 132.5, "Acme"), (674.9, 132.5, "DAC"), (919.3, 132.5, "N/A"), (1074.4, 132.5, "6"), (1187.4, 132.5, "$10.00"), (1363.2, 132.5, "0.0%"), (1547.4, 132.5, "$10.00"), (1751.4, 132.5, "$60.00"),
+    (117.9, 92.5, "Notes"), (336.6, 92.5, "Labels 2024-01-02"),
+    (1538.5, 52.5, "Subtotal:"), (1745.9, 52.5, "$810.00"),
+    (10.0, 12.5, "*Prices listed are estimates and may vary"),
+]
+
+def pdf_page_texts(pdf: bytes) -> list:
+    """Each page's size and the strings drawn on it, as (x, y, text) rounded to 0.1pt"""
+    pages = []
+    boxes = re.findall(rb"/MediaBox \[ 0 0 ([\d.]+) ([\d.]+) \]", pdf)
+    streams = re.findall(rb"stream\r?\n(.*?)endstream", pdf, re.S)
+    for box, stream in zip(boxes, streams):
+        # ASCII85 then Flate encoded (reportlab's default)
+        content = zlib.decompress(base64.a85decode(stream.strip().removesuffix(b"~>"))).decode("latin-1")
+        texts = [(round(float(x), 1), round(float(y), 1), text) for x, y, text in
+                 re.findall(r"1 0 0 1 ([\d.]+) ([\d.]+) Tm (?:/F\d+ \d+ Tf \d+ TL )?\((.*?)\) Tj", content)]
+        pages.append(((round(float(box[0]), 1), round(float(box[1]), 1)), texts))
+    return pages
+
+class BOMDownloadTests(BOMTestCase):
+    def test_xlsx_download_is_streamed(self):
+        response = self.client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 2}, "format": "xlsx"},
+                                    content_type="application/json")
+        self.assertTrue(response.streaming)
+        sheet = load_workbook(io.BytesIO(b"".join(response))).active
+        self.assertEqual([row[0] for row in sheet.iter_rows(values_only=True)][2:4], ["switch", "cable"])
+        # Prices and discounts are numbers, formatted like in the PDF
+        switch = sheet[3]
+        self.assertEqual([cell.value for cell in switch[5:]], [1000, 0.25, 750, 750])
+        self.assertEqual([cell.number_format for cell in switch[5:]], ['"$"#,##0.00', '0.0#%', '"$"#,##0.00', '"$"#,##0.00'])
+        self.assertEqual((sheet["H5"].value, sheet["I5"].value), ("Subtotal:", 790))
+
+    @override_settings(BOM_PDF_ROWS_PER_PAGE=4, BOM_RENDER_PROCESSES=0)
+    def test_long_pdf_is_paginated_and_streamed(self):
+        # Header, spacer, switch, cable, subtotal, spacer: the header is repeated and the subtotal is on the last page
+        _, pages = layout_bom_pages(build_bom(BOM_YAML, {"num_racks": 3}, True))
+        self.assertEqual([[index for index, _ in page_rows] for _, page_rows in pages], [[0, 1, 2, 3], [0, 4, 5]])
+        response = self.client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 3}}, content_type="application/json")
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertEqual(b"".join(response).count(b"/Type /Page\n"), 2)
+
+    @override_settings(BOM_PDF_ROWS_PER_PAGE=3)
+    def test_subtotal_is_never_alone_on_the_last_page(self):
+        _, pages = layout_bom_pages(build_bom(BOM_YAML, {"num_racks": 3}, True))
+        self.assertEqual([[index for index, _ in page_rows] for _, page_rows in pages], [[0, 1, 2], [0, 3], [0, 4, 5]])
+
+    def test_unknown_format_rejected(self):
+        response = self.client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 2}, "format": "doc"},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+class PDFLayoutTests(BOMTestCase):
+    def setUp(self):
+        super().setUp()
+        Product.objects.filter(part="switch").update(description="48 port leaf switch")
+        Product.objects.filter(part="cable").update(description="DAC")
+
+    def test_pdf_matches_original_renderer(self):
+        pdf = generate_bom_from_yaml("test", LAYOUT_YAML, {"num_racks": 3}, True)
+        self.assertEqual(pdf_page_texts(pdf), [(LAYOUT_PAGE_SIZE, LAYOUT_TEXT)])
+
+    @override_settings(BOM_PDF_ROWS_PER_PAGE=4, BOM_RENDER_PROCESSES=0)
+    def test_pages_split_the_same_rows(self):
+        pages = pdf_page_texts(generate_bom_from_yaml("test", LAYOUT_YAML, {"num_racks": 3}, True))
+        self.assertEqual(len(pages), 3)
+        header = [text for _, _, text in LAYOUT_TEXT[:len(BOM_HEADERS)]]
+        # Same strings in the same columns, with the header repeated on every page
+        for _, texts in pages:
+            self.assertEqual([text for _, _, text in texts[:len(header)]], header)
+        body = [(x, text) for _, texts in pages for x, _, text in texts[len(header):]]
+        self.assertEqual(body, [(x, text) for x, _, text in LAYOUT_TEXT[len(header):]])
+
+class BatchBOMTests(BOMTestCase):
+    def post_batch(self, **data):
+        return self.client.post(f"/api/pattern/{self.pattern.id}/bom/batch", data, content_type="application/json")
+
+    def test_zip_of_pdfs_with_one_product_query(self):
+        answer_sets = [{"num_racks": n} for n in range(5)]
+        get_compiled_pattern(BOM_YAML, self.pattern.id)
+        # Pattern + every product in the batch
+        with self.assertNumQueries(2):
+            response = self.post_batch(answers=answer_sets, names=["a", "b", "c", "d", "e"])
+        archive = zipfile.ZipFile(io.BytesIO(response.content))
+        self.assertEqual(archive.namelist(), [f"test.pattern-bom-{name}.pdf" for name in "abcde"])
+        self.assertTrue(all(archive.read(name).startswith(b"%PDF") for name in archive.namelist()))
+
+    def test_single_pdf_has_a_page_per_answer_set(self):
+        response = self.post_batch(answers=[{"num_racks": 1}, {"num_racks": 3}], output="pdf")
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertEqual(response.content.count(b"/Type /Page\n"), 2)
+
+    def test_rendering_in_process_pool(self):
+        boms = build_boms(BOM_YAML, [{"num_racks": n} for n in range(4)])
+        with override_settings(BOM_RENDER_PROCESSES=2):
+            shutdown_render_pool()
+            pdfs = render_bom_pdfs(boms)
+        shutdown_render_pool()
+        self.assertEqual(len(pdfs), 4)
+        self.assertTrue(all(pdf.startswith(b"%PDF") for pdf in pdfs))
+        # Same PDFs as rendering right here (apart from their IDs and timestamps)
+        with override_settings(BOM_RENDER_PROCESSES=0):
+            self.assertEqual([len(pdf) for pdf in pdfs], [len(pdf) for pdf in render_bom_pdfs(boms)])
+
+    def test_variants_render_in_parallel(self):
+        with override_settings(BOM_RENDER_PROCESSES=4):
+            shutdown_render_pool()
+            self.addCleanup(shutdown_render_pool)
+            run_render(time.sleep, [(0,)] * 4)
+            # Four half-second "variants" on four processes take about half a second, not two
+            started = time.perf_counter()
+            run_render(time.sleep, [(0.5,)] * 4)
+            self.assertLess(time.perf_counter() - started, 1.5)
+
+    def test_failing_answer_set_is_identified(self):
+        response = self.post_batch(answers=[{"num_racks": 1}, {"num_racks": 9}])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Answer set #2", response.json()["error"])
+
+@override_settings(BOM_RENDER_PROCESSES=1, BOM_RENDER_QUEUE_SIZE=0)
+class RenderPoolTests(BOMTestCase):
+    def setUp(self):
+        super().setUp()
+        bom_result_cache.clear()
+        shutdown_render_pool()
+        self.addCleanup(shutdown_render_pool)
+
+    def test_full_queue_is_rejected_with_retry_after(self):
+        # Takes up the only process (and there's no queue)
+        busy = threading.Thread(target=run_render, args=(time.sleep, [(0.5,)]))
+        busy.start()
+        time.sleep(0.05)
+        response = self.client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 3}}, content_type="application/json")
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response["Retry-After"]), 1)
+        response = self.client.post(f"/api/pattern/{self.pattern.id}/bom/batch", {"answers": [{"num_racks": 3}]}, content_type="application/json")
+        self.assertEqual(response.status_code, 503)
+        busy.join()
+        # Free again
+        response = self.client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 3}}, content_type="application/json")
+        self.assertTrue(response.content.startswith(b"%PDF"))
+
+    @override_settings(BOM_RENDER_QUEUE_SIZE=2)
+    def test_batch_takes_a_slot_per_pdf(self):
+        # 3 slots, one of them taken: room for two more PDFs, but not for a batch of three
+        slots = get_render_pool()[1]
+        slots.acquire()
+        post = lambda count: self.client.post(f"/api/pattern/{self.pattern.id}/bom/batch", {"answers": [{"num_racks": 3}] * count},
+                                              content_type="application/json")
+        self.assertEqual(post(3).status_code, 503)
+        self.assertEqual(post(2).status_code, 200)
+        slots.release()
+        # The pool gives the batch's slots back right after its results
+        while slots.used:
+            time.sleep(0.01)
+        # Bigger than the whole queue, so it runs once the queue is empty
+        self.assertEqual(post(4).status_code, 200)
+
+    @override_settings(BOM_RENDER_TIMEOUT=0.05)
+    def test_timeout(self):
+        with self.assertRaisesMessage(RenderUnavailable, "longer than 0.05s"):
+            run_render(time.sleep, [(0.5,)])
+
+    def test_timed_out_long_bom_leaves_no_file(self):
+        # Started first, since multiprocessing keeps files in the temporary directory too
+        run_render(time.sleep, [(0,)])
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        original, tempfile.tempdir = tempfile.tempdir, directory.name
+        self.addCleanup(setattr, tempfile, "tempdir", original)
+        pattern = Pattern.objects.select_related('group').get(id=self.pattern.id)
+        with override_settings(BOM_RENDER_TIMEOUT=0), self.assertRaises(RenderUnavailable):
+            views.render_bom_response(pattern, {"num_racks": 3}, "pdf")
+        slots = get_render_pool()[1]
+        while slots.used:
+            time.sleep(0.01)
+        self.assertEqual(os.listdir(directory.name), [])
+        # A render that only gets going after the request gave up on it doesn't bring the file back
+        with temporary_file_path(".pdf") as path:
+            pass
+        with self.assertRaises(FileNotFoundError):
+            render_bom_pdf_file(build_bom(BOM_YAML, {"num_racks": 3}, True), path)
+        self.assertFalse(os.path.exists(path))
+
+class BomJobTests(BOMTestCase):
+    def test_job_lifecycle(self):
+        response = self.client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 2}, "async": True},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["id"]
+        self.assertEqual(self.client.get(f"/api/bom/job/{job_id}/download").status_code, 409)
+
+        job = claim_job()
+        self.assertEqual(str(job.id), job_id)
+        self.assertIsNone(claim_job())
+        run_job(job)
+
+        self.assertEqual(self.client.get(f"/api/bom/job/{job_id}").json()["status"], "done")
+        self.assertTrue(self.client.get(f"/api/bom/job/{job_id}/download").content.startswith(b"%PDF"))
+
+    def test_failed_job_records_error(self):
+        job = BomJob.objects.create(pattern=self.pattern, answers={"num_racks": 9})
+        run_job(claim_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.assertIn("must be <= 4", job.error)
+
+    @override_settings(BOM_JOB_MAX_ATTEMPTS=2)
+    def test_abandoned_job_is_queued_again_then_failed(self):
+        job = BomJob.objects.create(pattern=self.pattern, answers={"num_racks": 2})
+        claimed = claim_job()
+        self.assertEqual(claimed.attempts, 1)
+        self.assertGreater(claimed.lease_expires_at, timezone.now())
+        # Still leased
+        self.assertEqual(requeue_expired_jobs(), (0, 0))
+
+        # Its worker died
+        BomJob.objects.update(lease_expires_at=timezone.now())
+        self.assertEqual(requeue_expired_jobs(), (1, 0))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.lease_expires_at), ("pending", None))
+        # The first worker lost it, so it neither renews it nor stores its result over the new attempt
+        stale = claimed
+        claimed = claim_job()
+        self.assertEqual(claimed.attempts, 2)
+        self.assertFalse(renew_lease(stale))
+        run_job(stale)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "running")
+
+        BomJob.objects.update(lease_expires_at=timezone.now())
+        self.assertEqual(requeue_expired_jobs(), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+
+class BrokenEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise ConnectionError("Mail relay is down")
+
+class OutboxTests(BOMTestCase):
+    def test_emailed_bom_is_queued_then_delivered(self):
+        response = self.client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 2}, "email": "pl@example.com"},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(deliver_pending(), 1)
+        self.assertEqual(mail.outbox[0].to, ["pl@example.com"])
+        self.assertEqual(mail.outbox[0].attachments[0][0], "test.pattern-bom.pdf")
+        self.assertEqual(OutboxEmail.objects.get().status, "sent")
+
+    @override_settings(EMAIL_BACKEND="api.tests.BrokenEmailBackend", EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_failed_delivery_backs_off_then_gives_up(self):
+        email = queue_email(["pl@example.com"], "Subject", "Body")
+        deliver_pending()
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), ("pending", 1))
+        self.assertGreater(email.next_attempt_at, timezone.now())
+
+        # Not due yet
+        self.assertEqual(deliver_pending(), 0)
+        OutboxEmail.objects.update(next_attempt_at=timezone.now())
+        deliver_pending()
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.last_error), ("failed", "Mail relay is down"))
+
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_claimed_emails_are_sent_again_if_their_worker_dies(self):
+        email = queue_email(["pl@example.com"], "Subject", "Body")
+        # A worker claims it, then dies before sending it
+        self.assertEqual([claimed.id for claimed in claim_emails(10)], [email.id])
+        self.assertEqual(claim_emails(10), [])
+        self.assertEqual(deliver_pending(), 0)
+        # Once its lease runs out
+        OutboxEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(deliver_pending(), 1)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts, len(mail.outbox)), ("sent", 2, 1))
+        # Given up on once its worker died on its last attempt too
+        email = queue_email(["pl@example.com"], "Subject", "Body")
+        for _ in range(2):
+            self.assertEqual(len(claim_emails(10)), 1)
+            OutboxEmail.objects.filter(id=email.id).update(next_attempt_at=timezone.now())
+        self.assertEqual(deliver_pending(), 0)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.last_error, len(mail.outbox)), ("failed", "The worker sending it stopped", 1))
+
+class ProductImportExportTests(BOMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser("admin", "admin@example.com", "admin"))
+
+    def test_csv_import_upserts_and_reports_bad_rows(self):
+        csv_file = io.BytesIO(textwrap.dedent("""\
+            Part,Manufacturer,Classification,Device Role,List Price,End of Support
+            switch,Acme,Network,Leaf,2000.00,2030-01-31
+            router,NewCo,Network,,500.50,
+            broken,Acme,Network,Leaf,12.345,someday
+            switch,Acme,Network,Spine,2100.00,
+            """).encode())
+        csv_file.name = "prices.csv"
+        response = self.client.post("/api/product/import", {"file": csv_file}, format="multipart")
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual((report["rows"], report["created"], report["updated"]), (4, 1, 1))
+        self.assertEqual(report["errors"][0]["row"], 4)
+        self.assertEqual(set(report["errors"][0]["errors"]), {"list_price", "end_of_support"})
+        # The last row for a part wins, and columns that weren't in the file are left alone
+        switch = Product.objects.get(part="switch")
+        self.assertEqual((switch.list_price, switch.discount, switch.device_role_id, switch.end_of_support), (2100, Decimal("0.25"), "Spine", None))
+        self.assertEqual(Product.objects.get(part="router").manufacturer_id, "NewCo")
+        # Rendered BOMs are thrown away like for any other product change
+        self.assertEqual(str(build_bom(BOM_YAML, {"num_racks": 0}, True)[2][5]), format_currency(2100))
+
+    def test_xlsx_import_in_batches_and_dry_run(self):
+        workbook = Workbook()
+        workbook.active.append(["part", "manufacturer", "classification", "discount"])
+        for index in range(5):
+            workbook.active.append([f"part-{index}", "Acme", "Network", 0.1])
+        xlsx_file = io.BytesIO()
+        workbook.save(xlsx_file)
+        xlsx_file.seek(0)
+        report = import_products(xlsx_file, "xlsx", batch_size=2, dry_run=True)
+        self.assertEqual((report["created"], report["errors"]), (5, []))
+        self.assertFalse(Product.objects.filter(part__startswith="part-").exists())
+        xlsx_file.seek(0)
+        import_products(xlsx_file, "xlsx", batch_size=2)
+        self.assertEqual(Product.objects.filter(part__startswith="part-", discount=Decimal("0.1")).count(), 5)
+
+    def test_export_round_trips_through_import(self):
+        response = self.client.get("/api/product/export?type=csv")
+        self.assertTrue(response.streaming)
+        exported = b"".join(response)
+        self.assertEqual(exported.decode().splitlines()[1], "cable,,Acme,Network,,,10.00,0.0000,10.00")
+        csv_file = io.BytesIO(exported)
+        csv_file.name = "products.csv"
+        report = self.client.post("/api/product/import", {"file": csv_file}, format="multipart").json()
+        self.assertEqual((report["created"], report["updated"], report["errors"]), (0, 2, []))
+
+    def test_ndjson_export_is_filtered(self):
+        response = self.client.get("/api/product/export?type=ndjson&device_role=Leaf")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{
+            "part": "switch", "description": "", "manufacturer": "Acme", "classification": "Network", "device_role": "Leaf",
+            "end_of_support": None, "list_price": "1000.00", "discount": "0.2500", "customer_price": "750.00",
+        }])
+
+    def test_missing_columns_rejected(self):
+        csv_file = io.BytesIO(b"part,description\nswitch,Switch\n")
+        csv_file.name = "prices.csv"
+        response = self.client.post("/api/product/import", {"file": csv_file}, format="multipart")
+        self.assertEqual(response.json(), {"error": "Missing column(s): manufacturer, classification"})
+
+class BOMResultCacheTests(BOMTestCase):
+    def setUp(self):
+        super().setUp()
+        bom_result_cache.clear()
+
+    def post_bom(self):
+        return self.client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 2}}, content_type="application/json")
+
+    def test_identical_requests_render_once(self):
+        first = self.post_bom().content
+        # Just the pattern lookup (the catalog version was read moments ago), nothing is rendered
+        with self.assertNumQueries(1):
+            self.assertEqual(self.post_bom().content, first)
+
+    def test_product_change_invalidates_results(self):
+        self.post_bom()
+        Product.objects.get(part="switch").save()
+        with self.assertNumQueries(3):
+            self.post_bom()
+
+    def test_catalog_version_is_read_once_per_ttl(self):
+        self.post_bom()
+        # Bumped by another worker: this one keeps serving what it has until its copy of the version runs out
+        CacheVersion.objects.update(version=99)
+        with self.assertNumQueries(1):
+            self.post_bom()
+        with override_settings(BOM_VERSION_CACHE_TTL=0), self.assertNumQueries(3):
+            self.post_bom()
+
+    def test_pattern_change_only_drops_its_own_results(self):
+        other = Pattern.objects.create(group=self.group, version=2, yaml=BOM_YAML)
+        post = lambda pattern: self.client.post(f"/api/pattern/{pattern.id}/bom", {"answers": {"num_racks": 2}}, content_type="application/json").content
+        first, other_first = post(self.pattern), post(other)
+        other.yaml = BOM_YAML.replace("num_racks * 2", "num_racks * 3")
+        other.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(post(self.pattern), first)
+        self.assertNotEqual(post(other), other_first)
+
+    def test_concurrent_requests_are_coalesced(self):
+        cache = ResultCache(10, 1024)
+        renders = []
+        def render():
+            renders.append(1)
+            time.sleep(0.1)
+            return b"pdf"
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda _: cache.get_or_render("key", render), range(8)))
+        self.assertEqual(results, [b"pdf"] * 8)
+        self.assertEqual(len(renders), 1)
+
+# Concurrent requests each need their own database connection, which only sees committed rows
+class CoalescedBOMTests(TransactionTestCase):
+    setUp = BOMTestCase.setUp
+
+    @override_settings(BOM_RENDER_PROCESSES=0)
+    def test_concurrent_requests_build_once(self):
+        bom_result_cache.clear()
+        pattern = Pattern.objects.select_related('group').get(id=self.pattern.id)
+        builds = lambda: metrics.PHASE_DURATION.dump().get('["products"]', [0])[-1]
+        before = builds()
+        def request(_):
+            try:
+                return views.render_bom_response(pattern, {"num_racks": 2}, "pdf").content
+            finally:
+                connection.close()
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(request, range(8)))
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(builds() - before, 1)
+
+    @override_settings(BOM_PDF_ROWS_PER_PAGE=4, BOM_RENDER_PROCESSES=0)
+    def test_long_boms_are_streamed_and_not_cached(self):
+        bom_result_cache.clear()
+        pattern = Pattern.objects.select_related('group').get(id=self.pattern.id)
+        response = views.render_bom_response(pattern, {"num_racks": 3}, "pdf")
+        self.assertTrue(response.streaming)
+        self.assertEqual(b"".join(response).count(b"/Type /Page\n"), 2)
+        self.assertEqual(len(bom_result_cache), 0)
+
+class ResponseCacheTests(BOMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser("admin", "admin@example.com", "admin"))
+
+    def test_product_responses_are_cached_until_the_product_changes(self):
+        self.assertEqual(self.client.get("/api/product/switch").json()["list_price"], "1000.00")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get("/api/product/switch").json()["list_price"], "1000.00")
+        # Other products don't matter
+        Product.objects.filter(part="cable").get().save()
+        with self.assertNumQueries(0):
+            self.client.get("/api/product/switch")
+        self.client.patch("/api/product/switch", {**self.client.get("/api/product/switch").json(), "list_price": "1200.00"}, format="json")
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get("/api/product/switch").json()["list_price"], "1200.00")
+        with override_settings(API_RESPONSE_CACHE=None), self.assertNumQueries(1):
+            self.client.get("/api/product/switch")
+
+    def test_pattern_change_drops_its_group_and_the_list(self):
+        other_group = PatternGroup.objects.create(name="other.pattern", description="Other")
+        other = Pattern.objects.create(group=other_group, yaml=BOM_YAML)
+        urls = ["/api/pattern", f"/api/pattern/{self.pattern.id}", f"/api/pattern/{other.id}"]
+        for url in urls:
+            self.client.get(url)
+        # A new version moves the group's latest pointer, which every version shows
+        new = Pattern.objects.create(group=self.group, version=2, yaml=BOM_YAML)
+        with self.assertNumQueries(2):
+            self.assertEqual(len(self.client.get("/api/pattern").json()), 3)
+            self.assertEqual(self.client.get(f"/api/pattern/{self.pattern.id}").json()["pattern_group"]["latest"], new.id)
+        with self.assertNumQueries(0):
+            self.client.get(f"/api/pattern/{other.id}")
+
+    def test_property_lists_and_imports(self):
+        self.assertEqual(self.client.get("/api/manufacturer").json(), [{"name": "Acme"}])
+        Manufacturer.objects.create(name="Globex")
+        self.assertEqual(len(self.client.get("/api/manufacturer").json()), 2)
+        self.client.get("/api/device-role")
+        self.client.get("/api/product/switch")
+        # Imports skip the signals, but still drop what they change
+        csv_file = io.BytesIO(b"Part,Manufacturer,Classification,Device Role,List Price\nswitch,Acme,Network,Spine,2000.00\n")
+        csv_file.name = "prices.csv"
+        self.client.post("/api/product/import", {"file": csv_file}, format="multipart")
+        self.assertEqual(self.client.get("/api/product/switch").json()["list_price"], "2000.00")
+        self.assertEqual(self.client.get("/api/device-role").json(), [{"name": "Leaf"}, {"name": "Spine"}])
+
+    def test_hit_miss_and_eviction_counters(self):
+        request = RequestFactory().get("/api/product/switch")
+        counts = lambda: [counter.dump().get('["test"]', [0])[0] for counter in metrics.COUNTERS]
+        before = counts()
+        entry, data = get_cached_response(request, "test", ["test:scope"])
+        set_cached_response(entry, {"part": "switch"})
+        self.assertEqual(get_cached_response(request, "test", ["test:scope"]), (entry, {"part": "switch"}))
+        # Dropped by the backend, rather than invalidated
+        cache.delete(entry[0])
+        get_cached_response(request, "test", ["test:scope"])
+        self.assertEqual([after - count for after, count in zip(counts(), before)], [1, 2, 1])
+        self.assertIn('bom_response_cache_hits_total{endpoint="test"}', metrics.render_prometheus())
+
+@skipIf(analytics.np is None, "NumPy isn't installed")
+class MetricsTests(BOMTestCase):
+    def setUp(self):
+        super().setUp()
+        bom_result_cache.clear()
+        for histogram in metrics.HISTOGRAMS:
+            histogram.clear()
+
+    @override_settings(BOM_SERVER_TIMING=True)
+    def test_server_timing_header(self):
+        response = self.client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 3}}, content_type="application/json")
+        # Served from the answer table, so there is no separate validate phase
+        timings = [entry.split(";")[0] for entry in response["Server-Timing"].split(", ")]
+        self.assertEqual(timings, ["yaml", "compile", "rules", "products", "pdf", "db", "total"])
+        self.assertIn('desc="3 queries"', response["Server-Timing"])
+
+    def test_server_timing_is_opt_in(self):
+        response = self.client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 3}}, content_type="application/json")
+        self.assertFalse(response.has_header("Server-Timing"))
+
+    def test_metrics_endpoint_needs_token(self):
+        self.assertEqual(self.client.get("/api/metrics").status_code, 403)
+        with override_settings(BOM_METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get("/api/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+            self.assertEqual(self.client.get("/api/metrics", HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+
+    @override_settings(BOM_METRICS_TOKEN="secret")
+    def test_metrics_endpoint_adds_up_workers(self):
+        self.client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 3}}, content_type="application/json")
+        with tempfile.TemporaryDirectory() as directory, override_settings(BOM_METRICS_DIR=directory):
+            # Another worker's histograms
+            other = {"bom_phase_duration_seconds": {'["pdf"]': [1] + [0] * len(metrics.DURATION_BUCKETS) + [0.0005, 1]}}
+            with open(os.path.join(directory, "metrics-1.json"), "w") as f:
+                json.dump(other, f)
+            response = self.client.get("/api/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        text = response.content.decode()
+        self.assertIn("# TYPE bom_phase_duration_seconds histogram", text)
+        self.assertIn('bom_phase_duration_seconds_count{phase="pdf"} 2', text)
+        self.assertIn('bom_phase_duration_seconds_bucket{phase="pdf",le="+Inf"} 2', text)
+        self.assertIn('bom_request_db_queries_bucket{route="api/pattern/<str:id>/bom",le="5"} 1', text)
+
+    def test_exited_workers_are_kept_in_totals(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(BOM_METRICS_DIR=directory):
+            other = {"bom_response_cache_hits_total": {'["test"]': [3]}}
+            total = lambda: metrics.collect()["bom_response_cache_hits_total"]['["test"]'][0]
+            for _ in range(2):
+                # A worker with PID 1 exits, then another one gets the same PID
+                with open(os.path.join(directory, "metrics-1.json"), "w") as f:
+                    json.dump(other, f)
+                metrics.retire(directory, 1)
+                self.assertFalse(os.path.exists(os.path.join(directory, "metrics-1.json")))
+            self.assertEqual(total(), 6)
+
+class AsyncUrls:
+    """The API with the async views routed (like BOM_ASYNC_VIEWS=True, which is off in tests)"""
+    urlpatterns = [
+        path("api/pattern/<str:id>/bom", async_views.download_bom),
+        path("api/pattern", async_views.pattern_list_create),
+        path("api/pattern/<str:id>", async_views.get_edit_pattern),
+        path("api/product", async_views.product_list_create),
+        path("api/product/export", async_views.product_export),
+        path("api/product/<str:pk>", async_views.single_product),
+        path("api/", include("api.urls")),
+    ]
+
+@override_settings(ROOT_URLCONF=AsyncUrls)
+class AsyncViewTests(BOMTestCase):
+    def setUp(self):
+        super().setUp()
+        bom_result_cache.clear()
+        admin = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.async_client = AsyncClient()
+        self.auth = {"Authorization": f"Bearer {AccessToken.for_user(admin)}"}
+        self.sync_client = APIClient()
+        self.sync_client.force_authenticate(admin)
+
+    @override_settings(BOM_SERVER_TIMING=True)
+    async def test_bom(self):
+        response = await self.async_client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 3}}, content_type="application/json")
+        self.assertTrue(response.content.startswith(b"%PDF"))
+        # Phases and queries run on other threads still make it into the header
+        timings = [entry.split(";")[0] for entry in response["Server-Timing"].split(", ")]
+        self.assertEqual(timings, ["yaml", "compile", "rules", "products", "pdf", "db", "total"])
+        self.assertIn('desc="3 queries"', response["Server-Timing"])
+
+        response = await self.async_client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 9}}, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("must be <= 4", response.json()["error"])
+        response = await self.async_client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {}, "async": True}, content_type="application/json")
+        self.assertEqual((response.status_code, response.json()["status"]), (202, "pending"))
+        self.assertEqual((await self.async_client.post("/api/pattern/999/bom", {}, content_type="application/json")).status_code, 404)
+
+    @override_settings(BOM_PDF_ROWS_PER_PAGE=4, BOM_RENDER_PROCESSES=0)
+    async def test_long_pdf_is_streamed(self):
+        response = await self.async_client.post(f"/api/pattern/{self.pattern.id}/bom", {"answers": {"num_racks": 3}}, content_type="application/json")
+        self.assertTrue(response.is_async)
+        pdf = b"".join([block async for block in response])
+        self.assertEqual(pdf.count(b"/Type /Page\n"), 2)
+
+    async def test_export_is_streamed(self):
+        for url in ["/api/product/export", "/api/product/export?type=ndjson&ordering=-part"]:
+            response = await self.async_client.get(url, headers=self.auth)
+            # Fetched chunk by chunk as it's sent, rather than read into a list first
+            self.assertTrue(response.is_async)
+            content = b"".join([chunk async for chunk in response])
+            expected = await sync_to_async(lambda: b"".join(self.sync_client.get(url)))()
+            self.assertEqual(content, expected, url)
+
+    async def test_reads_match_sync_views(self):
+        for url in ["/api/pattern", "/api/pattern?page_size=1&ordering=-id", f"/api/pattern/{self.pattern.id}",
+                    "/api/product?ordering=-customer_price", "/api/product?page_size=1&manufacturer=Acme", "/api/product/switch"]:
+            response = await self.async_client.get(url, headers=self.auth)
+            expected = await sync_to_async(self.sync_client.get)(url)
+            self.assertEqual((response.status_code, response.json()), (200, expected.json()), url)
+
+    async def test_errors_match_sync_views(self):
+        response = await self.async_client.get("/api/pattern/999")
+        self.assertEqual((response.status_code, response.json()), (404, {"detail": "Pattern not found"}))
+        self.assertEqual((await self.async_client.get("/api/product/nope")).status_code, 404)
+        response = await self.async_client.get("/api/product?ordering=description", headers=self.auth)
+        self.assertEqual((response.status_code, list(response.json())), (400, ["ordering"]))
+        response = await AsyncClient().get("/api/product")
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(response.has_header("WWW-Authenticate"))
+        # Writes go to the sync views
+        response = await AsyncClient().patch(f"/api/pattern/{self.pattern.id}", {"yaml": BOM_YAML}, content_type="application/json")
+        self.assertEqual(response.status_code, 401)
+
+    def test_rendering_is_bounded(self):
+        running, most = [], 0
+        def render():
+            nonlocal most
+            running.append(1)
+            most = max(most, len(running))
+            time.sleep(0.02)
+            running.pop()
+        async def request():
+            # Each request gets its own thread under ASGI
+            async with ThreadSensitiveContext():
+                await async_views.run_blocking(render)
+        async def main():
+            await asyncio.gather(*[request() for _ in range(6)])
+        with override_settings(BOM_ASYNC_RENDER_THREADS=2):
+            # An event loop in its own thread, like an ASGI server's (in the test's thread, sync code all runs on it)
+            thread = threading.Thread(target=asyncio.run, args=(main(),))
+            thread.start()
+            thread.join()
+        self.assertEqual(most, 2)
+
+class PriceEnvelopeTests(BOMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser("admin", "admin@example.com", "admin"))
+
+    def test_envelope_endpoint(self):
+        # 1 switch at $750, plus 2 cables at $10 per rack past the first
+        envelope = self.client.get(f"/api/pattern/{self.pattern.id}/analytics").json()
+        self.assertEqual((envelope["combinations"], envelope["valid"]), (5, 5))
+        self.assertEqual(envelope["min"], {"subtotal": 750.0, "answers": {"num_racks": 0}})
+        self.assertEqual(envelope["max"], {"subtotal": 830.0, "answers": {"num_racks": 4}})
+        self.assertEqual(envelope["mean"], 786.0)
+
+    def test_staff_only(self):
+        self.assertEqual(APIClient().get(f"/api/pattern/{self.pattern.id}/analytics").status_code, 401)
+
+    def test_envelope_cached_until_prices_change(self):
+        url = f"/api/pattern/{self.pattern.id}/analytics"
+        self.client.get(url)
+        # Just the pattern (the catalog version was read moments ago)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url).json()["max"]["subtotal"], 830.0)
+        Product.objects.get(part="cable").delete()
+        Product.objects.create(part="cable", manufacturer_id="Acme", classification_id="Network", list_price=20, discount=0)
+        self.assertEqual(self.client.get(url).json()["max"]["subtotal"], 910.0)
+
+    @override_settings(BOM_RENDER_PROCESSES=1, BOM_RENDER_QUEUE_SIZE=0)
+    def test_full_render_queue_is_rejected(self):
+        shutdown_render_pool()
+        self.addCleanup(shutdown_render_pool)
+        slots = get_render_pool()[1]
+        slots.acquire()
+        self.addCleanup(slots.release)
+        response = self.client.get(f"/api/pattern/{self.pattern.id}/analytics")
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+
+    def test_matches_building_every_bom(self):
+        yaml_text = BOM_YAML.replace("num_racks * 2", "num_racks // (num_racks - 2) if num_racks != 3 else True")
+        expected = []
+        for num_racks in range(5):
+            try:
+                expected.append(build_bom(yaml_text, {"num_racks": num_racks}, True)[-2][-1])
+            except ValueError:
+                pass
+        envelope = price_envelope(yaml_text)
+        self.assertEqual(envelope["valid"], len(expected))
+        self.assertEqual(format_currency(envelope["max"]["subtotal"]), str(max(expected)))
+
+    @override_settings(BOM_RENDER_PROCESSES=1)
+    def test_worked_out_in_cents_in_the_render_pool(self):
+        shutdown_render_pool()
+        self.addCleanup(shutdown_render_pool)
+        Product.objects.create(part="clip", manufacturer_id="Acme", classification_id="Network", list_price="0.01", discount=0)
+        yaml_text = textwrap.dedent("""
+        questions:
+        - {name: clips, type: integer, min: 1, max: 2}
+        products:
+        - add: {product: clip, quantity: clips}
+        """)
+        # 1.5 cents rounds half up, like Decimal would (a float mean of 0.015 rounds down)
+        envelope = price_envelope(yaml_text)
+        self.assertEqual((envelope["min"]["subtotal"], envelope["max"]["subtotal"]), (0.01, 0.02))
+        self.assertEqual((envelope["mean"], envelope["median"]), (0.02, 0.02))
+        # Settings are passed to the pool's processes
+        with override_settings(BOM_ANALYTICS_MAX_COMBINATIONS=1), self.assertRaisesMessage(ValueError, "max: 1"):
+            price_envelope(yaml_text)
+
+    def test_open_ended_questions_rejected(self):
+        self.pattern.yaml = BOM_YAML.replace("  max: 4\n", "")
+        self.pattern.save()
+        response = self.client.get(f"/api/pattern/{self.pattern.id}/analytics")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("doesn't have a fixed set of answers", response.json()["error"])
+
+    def test_command(self):
+        output = io.StringIO()
+        call_command("pattern_analytics", self.pattern.id, stdout=output)
+        self.assertIn("5 combinations of answers, 5 valid", output.getvalue())
+
+class BenchmarkTests(TestCase):
+    def test_synthetic_catalog(self):
+        self.assertEqual(generate_catalog(products=50, pattern_groups=2, versions=2, rules=20), {"products": 50, "patterns": 4})
+        # Tops up rather than duplicating
+        self.assertEqual(generate_catalog(products=60, pattern_groups=2, versions=2, rules=20), {"products": 10, "patterns": 0})
+        self.assertEqual(Pattern.objects.filter(group__name="syn.pattern-1").count(), 2)
+
+    def test_benchmark_results_and_regressions(self):
+        generate_catalog(products=50, pattern_groups=1, versions=1, rules=20)
+        results = run_benchmarks(repeat=1, only="engine.build_bom")
+        self.assertEqual(list(results["results"]), ["engine.build_bom.warm"])
+        self.assertEqual(results["results"]["engine.build_bom.warm"]["queries"], 1)
+
+        baseline = {"results": {"engine.build_bom.warm": {"wall_ms": 1000, "peak_kib": 1, "queries": 0}}}
+        regressions = compare(results, baseline)
+        self.assertEqual([(name, metric) for name, metric, *_ in regressions],
+                         [("engine.build_bom.warm", "peak_kib"), ("engine.build_bom.warm", "queries")])
+
+class LoadTestTests(LiveServerTestCase):
+    def test_load_test(self):
+        results = load_test(f"{self.live_server_url}/api/pattern", requests=6, concurrency=3)
+        self.assertEqual((results["requests"], results["errors"]), (6, 0))
+        self.assertLessEqual(results["p50_ms"], results["p95_ms"])
+        self.assertLessEqual(results["p99_ms"], results["max_ms"])
+        # Error responses are counted
+        self.assertEqual(load_test(f"{self.live_server_url}/api/pattern/missing", requests=2, concurrency=2)["errors"], 2)
+
+class ExpressionTests(TestCase):
+    def evaluate(self, source, **context):
+        return compile_expression(source)(context)
+
+    def test_matches_python(self):
+        context = {"num_racks": 3, "power_cables": True, "support_years": 5}
+        for source in ["num_racks > 2", "power_cables == True", "num_racks * 2", "0 if not power_cables else num_racks * 2",
+                       "support_years in [3, 5] and num_racks", "1 < num_racks <= 3", "max(1, num_racks // 2) + num_racks % 2",
+                       "-num_racks ** 2", "not (num_racks != 3 or power_cables)"]:
+            self.assertEqual(self.evaluate(source, **context), eval(source, {}, context), source)
+
+    def test_unknown_name(self):
+        with self.assertRaisesMessage(NameError, "name 'racks' is not defined"):
+            self.evaluate("racks * 2", num_racks=1)
+
+    def test_rejects_anything_outside_grammar(self):
+        for source in ["__import__('os').system('ls')", "num_racks.real", "[x for x in range(3)]", "open('f')", "lambda: 1", "2 ** 1000"]:
+            with self.assertRaises((ExpressionError, ValueError), msg=source):
+                self.evaluate(source, num_racks=1)
+
+    def test_bounds_what_expressions_can_build(self):
+        for source in ["(((10 ** 99) ** 99) ** 99) ** 99", "((10 ** 30) * 10 ** 30) * 10 ** 30", "(2.0 ** 100) ** 100",
+                       "'a' * 10 ** 9", "10 ** 9 * 'a'", "[0] * 10 ** 9", "('a' * 100) * 1000", "10 ** 50"]:
+            with self.assertRaises((ExpressionError, ValueError), msg=source):
+                self.evaluate(source, num_racks=1)
+        # Sizes anything real needs still work
+        self.assertEqual(self.evaluate("(num_racks * 10 ** 9) ** 2", num_racks=2), 4 * 10 ** 18)
+        self.assertEqual(self.evaluate("len('-' * num_racks * 10)", num_racks=3), 30)
+
+    def test_pattern_with_invalid_expression_is_not_saved(self):
+        group = PatternGroup.objects.create(name="bad", description="Bad")
+        with self.assertRaisesMessage(ValidationError, "Attribute is not allowed"):
+            Pattern.objects.create(group=group, yaml="products:\n- condition: \"x.y\"\n  add: {product: a, quantity: 1}\n")
@@ -1,10 +1,20 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 from .views import *
 
+# Async (ASGI) versions of the busiest read endpoints, see async_views.py
+if settings.BOM_ASYNC_VIEWS:
+    from .async_views import download_bom, pattern_list_create, get_edit_pattern, product_list_create, single_product, product_export
+
 urlpatterns = [
     # BOM
     path("pattern/<str:id>/bom", download_bom),
+    path("pattern/<str:id>/bom/batch", download_bom_batch),
+    path("pattern/<str:id>/analytics", pattern_analytics),
+    path("bom/job/<uuid:id>", bom_job_status),
+    path("bom/job/<uuid:id>/download", bom_job_download),
+    path("metrics", prometheus_metrics),
     # Patterns
     path("pattern", pattern_list_create),
     path("pattern/create", pattern_list_create),
@@ -13,6 +23,8 @@ urlpatterns = [
     # Products
     path("product", product_list_create),
     path("product/create", product_list_create),
+    path("product/import", product_import),
+    path("product/export", product_export),
     path("product/<str:pk>", single_product),
     path("product/delete/<str:pk>", single_product),
     # Product fields
@@ -1,6 +1,22 @@
 import yaml
 import io
+import functools
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+import zipfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from time import perf_counter as timer
+from django.conf import settings
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import *
 from openpyxl.utils import *
 from reportlab.lib.pagesizes import *
@@ -9,34 +25,37 @@ from reportlab.lib.colors import Color, black, white
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.platypus import SimpleDocTemplate, Paragraph
 from reportlab.pdfgen import canvas
+from reportlab.pdfbase import pdfmetrics
+from datetime import date, time
+from decimal import Decimal
+from .expressions import compile_expression, ExpressionError
+from .cache import pattern_cache, get_cached_products, cache_products
+from .metrics import phase
 
-def generate_bom_from_yaml(filename: str, yaml_text: str, inputs: dict, generate_pdf: bool) -> bytes:
-    """
-    Parses the YAML (which defines questions and BOM rules),
-    validates the inputs, builds the BOM by looking up each product from the database,
-    and writes the BOM out to an Excel workbook.
-    """
-    # Parse the YAML text.
-    try:
-        schema = yaml.safe_load(yaml_text)
-    except yaml.YAMLError as e:
-        raise ValueError(f"Invalid YAML: {e}")
+class CompiledRule:
+    """A single entry of the 'products' section, with its expressions already compiled"""
+    def __init__(self, index: int, part: str = None, condition=None, quantity=None, raw: list = None):
+        self.index = index
+        self.part = part
+        self.condition = condition # callable(context) or None
+        self.quantity = quantity # int, callable(context), or anything else (rejected on evaluation)
+        self.raw = raw
 
-    # Ensure the YAML structure has the required keys.
-    if not isinstance(schema, dict) or 'products' not in schema:
-        raise ValueError("YAML must contain a 'products' key")
+class CompiledPattern:
+    """The parsed schema of a pattern along with its question validators and compiled rules"""
+    def __init__(self, schema: dict, validators: list, rules: list, size: int):
+        self.schema = schema
+        self.validators = validators # list of (name, expected_type, validate(user_input))
+        self.rules = rules
+        self.size = size # approximate memory footprint, used for cache eviction
 
-    context = dict(inputs)
-    
-    # Validate each question and input.
-    for question in schema.get("questions", []):
-        name = question.get("name")
-        expected_type = question.get("type")
-        user_input = inputs.get(name)
-        if user_input is None:
-            raise ValueError(f"Missing input for {name}. Expected type: {expected_type}")
+def _compile_question(question: dict):
+    """Builds a validator for the answer to a single question"""
+    name = question.get("name")
+    expected_type = question.get("type")
 
-        if expected_type == "integer":
+    if expected_type == "integer":
+        def validate(user_input):
             if not isinstance(user_input, int):
                 raise TypeError(f"Input for {name} must be an integer, got {type(user_input).__name__} instead")
             min_val = question.get("min", user_input)
@@ -45,209 +64,732 @@ def generate_bom_from_yaml(filename: str, yaml_text: str, inputs: dict, generate
                 raise TypeError(f"Input for {name} must be >= {min_val} (got {user_input})")
             if int(user_input) > int(max_val):
                 raise TypeError(f"Input for {name} must be <= {max_val} (got {user_input})")
-        elif expected_type == "boolean":
+    elif expected_type == "boolean":
+        def validate(user_input):
             if not isinstance(user_input, bool):
                 raise TypeError(f"Input for {name} must be a boolean, got {type(user_input).__name__} instead")
-        elif expected_type == "enum":
-            choices = question.get("choices")
+    elif expected_type == "enum":
+        choices = question.get("choices")
+        def validate(user_input):
             if not choices:
                 raise ValueError(f"Missing choices for enum input {name}")
             if user_input not in choices:
                 raise ValueError(f"Input for {name} must be one of {choices}, got {user_input}")
-        else:
+    else:
+        def validate(user_input):
             raise ValueError(f"Unknown expected type: {expected_type} for input {name}")
+    return (name, expected_type, validate)
 
-    # Initialize the Excel workbook.
-    wb = Workbook()
-    ws = wb.active
-    ws.title = f"Bill of Materials for {filename}"
-    
-    # Set up header row corresponding to the sample format.
-    headers = [
-        "Manufacturer Part #",
-        "Manufacturer",
-        "Description",
-        "Device Role",
-        "Qty",
-        "List Price",
-        "Discount",
-        "Customer Price",
-        "Ext. Price",
-    ]
-    
-    # Write header row
-    ws.append(headers)
-    
-    # Extra empty row (just for looks)
-    ws.append([""] * len(headers))
-    
-    # First collect all products and their quantities that are going to be in the BOM
-    collective_parts = {}
+# libyaml's loader is several times faster than the pure Python one. PyYAML's wheels ship with it, but fall back just in case
+YAMLLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+@phase("yaml")
+def load_yaml(yaml_text: str):
+    """Same as yaml.safe_load, just faster"""
+    return yaml.load(yaml_text, Loader=YAMLLoader)
+
+def compile_pattern(yaml_text: str) -> CompiledPattern:
+    """
+    Parses the YAML and precompiles everything that doesn't depend on the answers:
+    the question validators and the condition / quantity expressions of each rule.
+    """
+    # Parse the YAML text.
+    try:
+        schema = load_yaml(yaml_text)
+    except yaml.YAMLError as e:
+        raise ValueError(f"Invalid YAML: {e}")
+    return compile_schema(schema, len(yaml_text.encode()))
+
+@phase("compile")
+def compile_schema(schema, size: int = 0) -> CompiledPattern:
+    """Compiles an already parsed pattern (see compile_pattern). size is only used to weigh it in the cache"""
+    # Ensure the YAML structure has the required keys.
+    if not isinstance(schema, dict) or 'products' not in schema:
+        raise ValueError("YAML must contain a 'products' key")
+
+    validators = [_compile_question(question) for question in schema.get("questions", [])]
+
+    rules = []
     for i, rule in enumerate(schema.get("products")):
         add = rule.get("add")
-        
+
         # If it's raw, add it directly
         raw = add.get("raw")
         if raw:
-            collective_parts[f"raw_{i}"] = {"raw": raw}
-        else:
-            # It's a product
-            cond = rule.get("condition")  # condition string is optional
-            if not add or not isinstance(add, dict):
-                raise ValueError(f"Rule #{i + 1} must have an 'add' dict")
-            part = add.get("product")
-            # Skip rules meant as examples
-            if part == "example":
+            # Ensure it won't overflow
+            if len(raw) > len(BOM_HEADERS):
+                raise ValueError(f"'raw' list has too many entries (max: {len(BOM_HEADERS)})")
+            rules.append(CompiledRule(i, raw=raw))
+            continue
+        # It's a product
+        if not add or not isinstance(add, dict):
+            raise ValueError(f"Rule #{i + 1} must have an 'add' dict")
+        part = add.get("product")
+        # Skip rules meant as examples
+        if part == "example":
+            continue
+        cond = rule.get("condition") # condition string is optional
+        quantity_val = add.get("quantity")
+        try:
+            rules.append(CompiledRule(
+                i,
+                part=part,
+                condition=compile_expression(cond) if cond else None,
+                quantity=compile_expression(quantity_val) if isinstance(quantity_val, str) else quantity_val,
+            ))
+        except ExpressionError as e:
+            raise ValueError(f"Error in product section #{i + 1}: {e}")
+
+    return CompiledPattern(schema, validators, rules, size)
+
+def get_compiled_pattern(yaml_text: str, pattern_id=None) -> CompiledPattern:
+    """
+    Returns the compiled form of a pattern, using the per-worker cache when the pattern ID is known.
+    The key includes a hash of the YAML so an edited pattern can never be served from a stale entry.
+    """
+    if pattern_id is None:
+        return compile_pattern(yaml_text)
+    key = (pattern_id, hashlib.sha256(yaml_text.encode()).hexdigest())
+    compiled = pattern_cache.get(key)
+    if compiled is None:
+        compiled = compile_pattern(yaml_text)
+        pattern_cache.set(key, compiled, compiled.size)
+    return compiled
+
+def validate_pattern(yaml_text: str, answers: dict, schema=None) -> CompiledPattern:
+    """
+    Checks that a pattern works without generating anything: compiles it, evaluates every rule against
+    the answers (normally the questions' defaults) and makes sure every product it references exists.
+    Pass the schema if the YAML has already been parsed.
+    """
+    compiled = compile_pattern(yaml_text) if schema is None else compile_schema(schema, len(yaml_text.encode()))
+    collect_parts(compiled, answers, False)
+    check_products_exist(list(dict.fromkeys(rule.part for rule in compiled.rules if not rule.raw)))
+    return compiled
+
+def check_products_exist(parts: list):
+    """Raises one error listing every part that doesn't exist. Only costs a single (index only) query"""
+    if not parts:
+        return
+    from .models import Product
+    found = set(Product.objects.filter(part__in=parts).values_list("part", flat=True))
+    _raise_missing_products([part for part in parts if part not in found])
+
+def _raise_missing_products(not_found: list):
+    if len(not_found) == 1:
+        raise ValueError(f"Product '{not_found[0]}' does not exist")
+    elif not_found:
+        raise ValueError(f"Products {', '.join(f"'{part}'" for part in not_found)} do not exist")
+
+@phase("products")
+def get_products(parts: list) -> dict:
+    """
+    Resolves every part number to its product details in a single query (or straight from the
+    product cache when one is configured). Raises one error listing every part that doesn't exist.
+    """
+    products = get_cached_products(parts)
+    missing = [part for part in parts if part not in products]
+    if missing:
+        from .models import Product
+        # Manufacturers and device roles are keyed by name, so their FK columns already hold everything we display
+        fetched = {
+            row["part"]: row for row in Product.objects.filter(part__in=missing).values(
+                "part", "description", "manufacturer", "device_role", "list_price", "discount", "customer_price"
+            )
+        }
+        cache_products(fetched)
+        products.update(fetched)
+    
+    _raise_missing_products([part for part in parts if part not in products])
+    return products
+
+# Content types of the formats a BOM can be generated in
+BOM_CONTENT_TYPES = {
+    "pdf": "application/pdf",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+# Header row of every BOM
+BOM_HEADERS = [
+    "Manufacturer Part #",
+    "Manufacturer",
+    "Description",
+    "Device Role",
+    "Qty",
+    "List Price",
+    "Discount",
+    "Customer Price",
+    "Ext. Price",
+]
+
+def generate_bom_from_yaml(filename: str, yaml_text: str, inputs: dict, generate_pdf: bool, pattern_id=None, answer_table=None) -> bytes:
+    """
+    Parses the YAML (which defines questions and BOM rules),
+    validates the inputs, builds the BOM by looking up each product from the database,
+    and renders the BOM to a PDF.
+    Pass the pattern's ID to reuse its compiled form across requests, and its answer table (if it has one) to skip evaluating it.
+    """
+    return run_render(render_bom_pdf, [(build_bom(yaml_text, inputs, generate_pdf, pattern_id, answer_table),)])[0]
+
+def build_bom(yaml_text: str, inputs: dict, generate_pdf: bool, pattern_id=None, answer_table=None) -> list:
+    """
+    Builds the BOM as a list of rows, each row being a list of cell values (left to right).
+    The first row is the header, followed by a spacer, the products, the subtotal and another spacer.
+    """
+    compiled = get_compiled_pattern(yaml_text, pattern_id)
+    collective_parts = lookup_parts(answer_table, yaml_text, compiled, inputs, generate_pdf)
+    if collective_parts is None:
+        collective_parts = collect_parts(compiled, inputs, generate_pdf)
+    # Look up every product in the BOM at once
+    products = get_products([part for part in collective_parts if "raw" not in collective_parts[part]])
+    return bom_rows(collective_parts, products)
+
+def build_boms(yaml_text: str, answer_sets: list, pattern_id=None, answer_table=None) -> list:
+    """
+    Builds one BOM (see build_bom) per answer set. The pattern is compiled once and every product
+    used by any of the BOMs is fetched in a single query.
+    """
+    compiled = get_compiled_pattern(yaml_text, pattern_id)
+    parts_per_set = []
+    for index, inputs in enumerate(answer_sets):
+        try:
+            collective_parts = lookup_parts(answer_table, yaml_text, compiled, inputs, True)
+            parts_per_set.append(collective_parts if collective_parts is not None else collect_parts(compiled, inputs, True))
+        except Exception as e:
+            raise ValueError(f"Answer set #{index + 1}: {e}")
+    # dict.fromkeys keeps the order (and drops duplicates)
+    parts = dict.fromkeys(part for collective_parts in parts_per_set for part in collective_parts if "raw" not in collective_parts[part])
+    products = get_products(list(parts))
+    return [bom_rows(collective_parts, products) for collective_parts in parts_per_set]
+
+def collect_parts(compiled: CompiledPattern, inputs: dict, generate_pdf: bool) -> dict:
+    """
+    Validates the inputs and evaluates every product section against them.
+    Returns the parts in the BOM (in order) mapped to {"quantity": ...}, or {"raw": [...]} for raw rows.
+    """
+    with phase("validate"):
+        _validate_inputs(compiled, inputs)
+    with phase("rules"):
+        return _evaluate_rules(compiled, inputs, generate_pdf)
+
+# collect_parts without the phase timings, for callers evaluating many answer sets (see build_answer_table)
+def _validate_inputs(compiled: CompiledPattern, inputs: dict):
+    # Validate each question and input.
+    for name, expected_type, validate in compiled.validators:
+        user_input = inputs.get(name)
+        if user_input is None:
+            raise ValueError(f"Missing input for {name}. Expected type: {expected_type}")
+        validate(user_input)
+
+def _evaluate_rules(compiled: CompiledPattern, inputs: dict, generate_pdf: bool) -> dict:
+    context = dict(inputs)
+    
+    # First collect all products and their quantities that are going to be in the BOM
+    collective_parts = {}
+    for rule in compiled.rules:
+        # If it's raw, add it directly
+        if rule.raw:
+            collective_parts[f"raw_{rule.index}"] = {"raw": rule.raw}
+            continue
+        # It's a product
+        part = rule.part
+        try:
+            # Evaluate the optional condition.
+            if rule.condition and not rule.condition(context):
                 continue
             
-            try:
-                # Evaluate the optional condition.
-                if cond and not eval(cond, {}, context):
-                    continue
-                
-                # Evaluate the quantity: if it is a string, evaluate it as a Python expression.
-                quantity_val = add.get("quantity")
-                if isinstance(quantity_val, str):
-                    quantity = eval(quantity_val, {}, context)
-                elif isinstance(quantity_val, int):
-                    quantity = quantity_val
-                else:
-                    raise ValueError(f"Invalid quantity type for product '{part}'")
-                
-                # Ensure it's an int. Cause you can't have half of a router
-                if type(quantity) is not int:
-                    raise ValueError(f"Quantities must be integers (got {type(quantity)} for value {quantity})")
-            except Exception as e:
-                raise ValueError(f"Error evaluating quantity for product section #{i + 1}: {e}")
-            
-            # Check if we already inserted this product into a row
-            if part in collective_parts:
-                collective_parts[part]["quantity"] += quantity
+            # Evaluate the quantity: if it is a string, it's an expression
+            if callable(rule.quantity):
+                quantity = rule.quantity(context)
+            elif isinstance(rule.quantity, int):
+                quantity = rule.quantity
             else:
-                collective_parts[part] = {"quantity": quantity}
+                raise ValueError(f"Invalid quantity type for product '{part}'")
+            
+            # Ensure it's an int. Cause you can't have half of a router
+            if type(quantity) is not int:
+                raise ValueError(f"Quantities must be integers (got {type(quantity)} for value {quantity})")
+        except Exception as e:
+            raise ValueError(f"Error evaluating quantity for product section #{rule.index + 1}: {e}")
+        
+        # Check if we already inserted this product into a row
+        if part in collective_parts:
+            collective_parts[part]["quantity"] += quantity
+        else:
+            collective_parts[part] = {"quantity": quantity}
     
     # If there's no parts to add and this is NOT a save action (meaning someone's trying to generate a PDF)
     if generate_pdf and not collective_parts:
         # Don't bother generating a PDF, just return early
         raise ValueError("BOM is empty")
+    return collective_parts
+
+# Answer tables
+# When every question has a small, fixed set of possible answers (booleans, enums and integers with a min and max),
+# the parts for every combination of answers are worked out when the pattern is saved. BOMs are then just a lookup.
+def question_domain(question: dict):
+    """Every possible answer to a question, or None if it's open ended (or invalid, which collect_parts will complain about)"""
+    expected_type = question.get("type")
+    if expected_type == "boolean":
+        return [False, True]
+    elif expected_type == "enum" and isinstance(question.get("choices"), list) and question["choices"]:
+        return question["choices"]
+    elif expected_type == "integer" and question.get("min") is not None and question.get("max") is not None:
+        # A range, so a huge one doesn't take up any memory before its size is checked
+        return range(int(question["min"]), int(question["max"]) + 1)
+    return None
+
+def answer_domains(questions: list, max_size: int):
+    """Returns (name, every possible answer) for each question, or None if there are too many combinations"""
+    domains = []
+    size = 1
+    for question in questions:
+        values = question_domain(question)
+        if values is None:
+            return None
+        size *= len(values)
+        if size > max_size or size == 0:
+            return None
+        domains.append((question.get("name"), list(values)))
+    # Duplicate names would make some combinations impossible to tell apart
+    if len({name for name, _ in domains}) != len(domains):
+        return None
+    return domains
+
+def answer_key(values: list) -> str:
+    # JSON tells True and 1 apart, unlike a tuple of the values would
+    return json.dumps(values, separators=(",", ":"))
+
+@phase("answer_table")
+def build_answer_table(compiled: CompiledPattern, yaml_text: str):
+    """
+    Evaluates the pattern against every possible combination of answers.
+    Returns None if it has an open ended question or more than BOM_ANSWER_TABLE_MAX_SIZE combinations.
+    """
+    max_size = getattr(settings, "BOM_ANSWER_TABLE_MAX_SIZE", 1000)
+    domains = answer_domains(compiled.schema.get("questions") or [], max_size)
+    if domains is None:
+        return None
+    names = [name for name, _ in domains]
+    parts = {}
+    for values in itertools.product(*(values for _, values in domains)):
+        try:
+            inputs = dict(zip(names, values))
+            _validate_inputs(compiled, inputs)
+            collective_parts = _evaluate_rules(compiled, inputs, False)
+            # As a list since Postgres doesn't keep the order of JSON object keys
+            # (raw rows only store their key, their values might not be JSON serializable)
+            parts[answer_key(values)] = [[part, entry.get("quantity")] for part, entry in collective_parts.items()]
+        except Exception as e:
+            # Same error, just without evaluating anything
+            parts[answer_key(values)] = str(e)
+    return {
+        "sha256": hashlib.sha256(yaml_text.encode()).hexdigest(),
+        "questions": names,
+        "parts": parts,
+    }
+
+@phase("rules")
+def lookup_parts(answer_table, yaml_text: str, compiled: CompiledPattern, inputs: dict, generate_pdf: bool):
+    """Returns the collected parts (see collect_parts) from the answer table, or None if the table doesn't cover these answers"""
+    if not answer_table or answer_table.get("sha256") != hashlib.sha256(yaml_text.encode()).hexdigest():
+        return None
+    names = answer_table["questions"]
+    # Extra answers could be used by an expression
+    if len(inputs) != len(names) or any(name not in inputs for name in names):
+        return None
+    # Answers that aren't in the table are invalid, so evaluating them normally raises the right error
+    entries = answer_table["parts"].get(answer_key([inputs[name] for name in names]))
+    if entries is None:
+        return None
+    if isinstance(entries, str):
+        raise ValueError(entries)
+    if generate_pdf and not entries:
+        raise ValueError("BOM is empty")
+    raw_rows = {f"raw_{rule.index}": rule.raw for rule in compiled.rules if rule.raw}
+    return {part: {"raw": raw_rows[part]} if quantity is None else {"quantity": quantity} for part, quantity in entries}
+
+def bom_rows(collective_parts: dict, products: dict) -> list:
+    """Turns the collected parts (see collect_parts) and their products (see get_products) into the BOM rows"""
+    headers = BOM_HEADERS
+    
+    # Header row, then an extra empty row (just for looks)
+    rows = [headers, [""] * len(headers)]
     
     # Now that we've gathered all of the collective parts, let's assign one row to each product
-    subtotal_price = 0.0
+    # Prices are Decimals (the customer price comes from the database, see Product.customer_price), so they add up exactly
+    subtotal_price = Decimal(0)
     for part in collective_parts:
         # If it's a raw part
         raw = collective_parts[part].get("raw")
         if raw:
-            # Ensure it won't overflow
-            if len(raw) > len(headers):
-                raise ValueError(f"'raw' list has too many entries (max: {len(headers)})")
-            ws.append(raw)
+            # (compile_schema already made sure it fits)
+            rows.append(raw)
             continue
         # Otherwise, it's a product
-        # Retrieve the product object to extract metadata
-        try:
-            from .models import Product
-            # Look up the product by its part number using the DB
-            product = Product.objects.get(part=part)
-        except Product.DoesNotExist:
-            raise ValueError(f"Product '{part}' does not exist")
+        product = products[part]
         
         # Retrieve product details
         quantity = collective_parts[part]["quantity"]
-        cust_discount = float(product.discount)
-        cust_price = round_currency(float(product.list_price) * (1 - cust_discount))
-        ext_price = round_currency(cust_price * quantity)
+        cust_price = product["customer_price"]
+        ext_price = cust_price * quantity
         # Gets added at the bottom
         subtotal_price += ext_price
         
         # Each value in this array is one cell (left to right) in a new row
-        ws.append([
+        rows.append([
             part, # Manufacturer part #
-            product.manufacturer.name, # Manufacturer
-            product.description, # Description
-            (product.device_role and product.device_role.name) or "N/A", # Device role (optional)
+            product["manufacturer"], # Manufacturer
+            product["description"], # Description
+            product["device_role"] or "N/A", # Device role (optional)
             quantity,
-            format_currency(float(product.list_price)),
-            format_percentage(cust_discount),
-            format_currency(cust_price),
-            format_currency(ext_price),
+            Currency(product["list_price"] or 0),
+            Percentage(product["discount"] or 0),
+            Currency(cust_price),
+            Currency(ext_price),
         ])
     
     # Append the subtotal row
     subtotal_row = [''] * len(headers)
-    subtotal_row[ws.max_column - 2] = "Subtotal:"
-    subtotal_row[ws.max_column - 1] = format_currency(subtotal_price)
-    ws.append(subtotal_row)
+    subtotal_row[len(headers) - 2] = "Subtotal:"
+    subtotal_row[len(headers) - 1] = Currency(subtotal_price)
+    rows.append(subtotal_row)
     
     # Extra empty row (just for looks, again)
-    ws.append([""] * len(headers))
-    
-    # Auto-fit column widths
-    for col in range(1, len(headers) + 1):
-        max_length = 0
-        column = ws.cell(row=1, column=col).column_letter
-        for cell in ws[column]:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        # The widths of the columns are used in the PDF generation too
-        adjusted_width = max_length + 2 # add some padding
-        ws.column_dimensions[column].width = adjusted_width
-    
-    # Save as PDF
-    return excel_to_pdf(wb)
+    rows.append([""] * len(headers))
+    return rows
 
 # Font used in the PDF
 bom_font = Font("Helvetica", size=20, color="FFFFFF")
 
+# Layout shared by every BOM PDF. Only the column widths and the number of rows change between documents
+padding_scale = 1.5
+row_height = bom_font.size * padding_scale * 1.33333
+# Where the disclaimer sits at the bottom of the page
+disclaimer_text = "*Prices listed are estimates and may vary"
+disclaimer_origin = (bom_font.size / 2, ((bom_font.size * padding_scale * 1.33333) - bom_font.size) / 2 + (bom_font.size / 8))
+
+@functools.lru_cache(maxsize=8192)
+def text_width(text: str) -> float:
+    """Width of the text in the BOM font. Cached since the same prices, roles, manufacturers, etc. show up constantly"""
+    return pdfmetrics.stringWidth(text, "Helvetica", bom_font.size)
+
+def cell_text(value) -> str:
+    """How a cell value is printed in the PDF"""
+    if value is None:
+        return ""
+    elif isinstance(value, str):
+        return value
+    elif isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    elif isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    elif isinstance(value, time):
+        return value.strftime("%H:%M:%S")
+    else:
+        return str(value)
+
 # Heavily modified from https://github.com/rameshvoodi/excel-to-pdf-python/blob/main/main.py
-# Only the width properties are used from the excel sheet, the height is managed here
-def excel_to_pdf(workbook):
+def write_bom_pdf(rows: list, output):
+    """
+    Draws the BOM rows (see build_bom) onto PDF pages of at most BOM_PDF_ROWS_PER_PAGE rows (see layout_bom_pages)
+    and writes the PDF to output (a path or a binary file).
+    The first row is the black header (repeated on every page), the 2nd and last rows are grey spacers and the 2nd to last (the subtotal) is bold.
+    """
+    column_widths, pages = layout_bom_pages(rows)
+    c = canvas.Canvas(output, pagesize=pages[0][0])
+    draw_bom_pages(c, column_widths, pages, len(rows))
+    # Save and export the PDF
+    c.save()
+
+@phase("pdf")
+def render_bom_pdf(rows: list) -> bytes:
+    """Renders the BOM rows (see build_bom) to a PDF, see write_bom_pdf"""
     pdf_output = io.BytesIO()
+    write_bom_pdf(rows, pdf_output)
+    return pdf_output.getvalue()
+
+@phase("pdf")
+@contextmanager
+def temporary_file_path(suffix: str = ""):
+    """
+    Creates an empty temporary file and yields its path, for render_bom_pdf_file to write into.
+    The file is deleted on the way out, unless open_temporary_file already took it.
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        yield path
+    finally:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def render_bom_pdf_file(rows: list, path: str):
+    """
+    Renders the BOM rows to a PDF like render_bom_pdf, but into the file at path (made by temporary_file_path),
+    so the document never has to be sent back from the render pool or held by the web worker.
+    The file is owned (and deleted) by the caller. It's opened without creating it, so a render still running after
+    the caller gave up on it (a timeout can't stop it) finds it gone, or writes to a deleted file, and leaves nothing behind.
+    """
+    with open(path, "r+b") as output:
+        output.truncate()
+        write_bom_pdf(rows, output)
+
+def open_temporary_file(path: str):
+    """Opens a file written by render_bom_pdf_file for reading. It's deleted right away, so it's gone once closed"""
+    file = open(path, "rb")
+    os.unlink(path)
+    return file
+
+@phase("pdf")
+def render_bom_pdf_sections(sections: list) -> bytes:
+    """
+    Draws several BOMs into one PDF, each starting on a new page with an outline entry.
+    Takes a list of (title, rows) pairs.
+    """
+    pdf_output = io.BytesIO()
+    layouts = [layout_bom_pages(rows) for _, rows in sections]
+    c = canvas.Canvas(pdf_output, pagesize=layouts[0][1][0][0])
+    for index, ((title, rows), (column_widths, pages)) in enumerate(zip(sections, layouts)):
+        draw_bom_pages(c, column_widths, pages, len(rows), (title, f"bom-{index}"))
+    c.save()
+    return pdf_output.getvalue()
+
+class RenderUnavailable(Exception):
+    """A render couldn't be done right now (the render queue is full, or it took too long). Clients should retry after retry_after seconds"""
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class RenderSlots:
+    """
+    Renders running in or waiting for the render pool, up to size at once. Each PDF (or section of a merged one)
+    takes a slot, so the bound is on the work queued up rather than on the requests.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def charge(self, count: int) -> int:
+        """Slots a render of count PDFs takes. One bigger than the whole queue takes all of it (so it runs alone)"""
+        return min(count, self.size)
+
+    def acquire(self, count: int = 1) -> bool:
+        """Takes count slots (see charge) if they're free"""
+        with self._lock:
+            if self.used + count > self.size:
+                return False
+            self.used += count
+            return True
+
+    def release(self, count: int = 1):
+        with self._lock:
+            self.used -= count
+
+    def available(self, count: int = 1) -> bool:
+        return self.used + self.charge(count) <= self.size
+
+# Process pool renders run in (see run_render), created the first time it's needed (one per worker process),
+# and the slots of its bounded queue: one per process plus BOM_RENDER_QUEUE_SIZE
+_render_pool = None
+_render_slots = None
+_render_pool_lock = threading.Lock()
+# Moving average of how long renders take in the pool, to tell clients when to come back
+_render_seconds = 0.5
+
+def get_render_pool() -> tuple:
+    """Returns the render pool and its queue's slots"""
+    global _render_pool, _render_slots
+    with _render_pool_lock:
+        if _render_pool is None:
+            processes = getattr(settings, "BOM_RENDER_PROCESSES", 1)
+            # Forking a threaded worker could leave the child holding locks another thread had (logging, the database
+            # driver, ...), so processes are forked from a clean server process instead, with reportlab already
+            # loaded. They're started as renders need them, up to BOM_RENDER_PROCESSES
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload([__name__])
+            _render_pool = ProcessPoolExecutor(processes, mp_context=context)
+            _render_slots = RenderSlots(processes + getattr(settings, "BOM_RENDER_QUEUE_SIZE", 16))
+        return _render_pool, _render_slots
+
+def shutdown_render_pool():
+    """Stops the render pool (without waiting for renders in progress). The next render starts a new one"""
+    global _render_pool, _render_slots
+    with _render_pool_lock:
+        if _render_pool is not None:
+            _render_pool.shutdown(wait=False, cancel_futures=True)
+        _render_pool = _render_slots = None
+
+def _timed(function, args):
+    """Runs in the pool. Returns the result and how long it took"""
+    started = timer()
+    result = function(*args)
+    return result, timer() - started
+
+def _retry_after() -> int:
+    """Seconds until the queue has likely drained"""
+    waiting = getattr(settings, "BOM_RENDER_QUEUE_SIZE", 16) + 1
+    return max(1, math.ceil(_render_seconds * waiting / max(1, getattr(settings, "BOM_RENDER_PROCESSES", 1))))
+
+RENDER_QUEUE_FULL = "Too many BOMs are being rendered, try again shortly"
+
+def check_render_capacity(count: int = 1):
+    """
+    Raises RenderUnavailable if the render queue has no room for count PDFs, so requests can be turned away before
+    building BOMs that run_render would refuse anyway.
+    """
+    if getattr(settings, "BOM_RENDER_PROCESSES", 1) > 0 and not get_render_pool()[1].available(count):
+        raise RenderUnavailable(RENDER_QUEUE_FULL, _retry_after())
+
+def run_render(function, argument_lists: list, count: int = None) -> list:
+    """
+    Calls function once per tuple of arguments and returns the results, as a single render of count PDFs
+    (by default one per call, pass the number of sections when a call draws several).
+    reportlab is pure Python and holds the GIL, so with BOM_RENDER_PROCESSES set the calls run in the render pool
+    while the request waits (at most BOM_RENDER_TIMEOUT seconds). Otherwise they run right here.
+    Raises RenderUnavailable when the queue (BOM_RENDER_QUEUE_SIZE PDFs waiting for a process) has no room for it,
+    instead of adding to the pile, or on a timeout.
+    """
+    global _render_seconds
+    if getattr(settings, "BOM_RENDER_PROCESSES", 1) <= 0 or not argument_lists:
+        return [function(*args) for args in argument_lists]
+    pool, slots = get_render_pool()
+    charged = slots.charge(len(argument_lists) if count is None else count)
+    if not slots.acquire(charged):
+        raise RenderUnavailable(RENDER_QUEUE_FULL, _retry_after())
+    # Slots are given back as the calls finish (even after a timeout, since the process is still busy),
+    # the last one giving back whatever is left
+    remaining = [len(argument_lists), charged]
+    remaining_lock = threading.Lock()
+    def done(_):
+        with remaining_lock:
+            remaining[0] -= 1
+            released = remaining[1] - remaining[0] * charged // len(argument_lists)
+            remaining[1] -= released
+        if released:
+            slots.release(released)
     
-    # Only one worksheet to process
-    sheet = workbook.worksheets[0]
-    
-    # Get number of columns and rows
-    num_columns = sheet.max_column
-    # Initialize column widths
-    column_widths = [0] * num_columns
+    # Phases timed in the pool's processes never make it back here, so time the whole render
+    with phase("pdf"):
+        try:
+            futures = [pool.submit(_timed, function, args) for args in argument_lists]
+        except BrokenProcessPool:
+            slots.release(charged)
+            shutdown_render_pool()
+            raise RenderUnavailable("The renderer restarted, try again", 1)
+        for future in futures:
+            future.add_done_callback(done)
+        deadline = timer() + getattr(settings, "BOM_RENDER_TIMEOUT", 60)
+        results = []
+        try:
+            for future in futures:
+                result, seconds = future.result(timeout=max(0, deadline - timer()))
+                _render_seconds = 0.8 * _render_seconds + 0.2 * seconds
+                results.append(result)
+        except FuturesTimeoutError:
+            for future in futures:
+                future.cancel()
+            raise RenderUnavailable(f"The BOM took longer than {getattr(settings, 'BOM_RENDER_TIMEOUT', 60):g}s to render", _retry_after())
+        except BrokenProcessPool:
+            # A render process died (e.g. out of memory)
+            shutdown_render_pool()
+            raise RenderUnavailable("The renderer restarted, try again", 1)
+    return results
+
+def render_bom_pdfs(sections: list) -> list:
+    """Renders a PDF for each set of BOM rows, spread over the render pool (see run_render)"""
+    return run_render(render_bom_pdf, [(rows,) for rows in sections])
+
+def zip_files(files: list) -> bytes:
+    """Zips up a list of (filename, bytes) pairs"""
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+        for filename, data in files:
+            archive.writestr(filename, data)
+    return output.getvalue()
+
+def bom_page_count(rows: list) -> int:
+    """How many pages a BOM's PDF takes (see layout_bom_pages)"""
+    rows_per_page = max(3, getattr(settings, "BOM_PDF_ROWS_PER_PAGE", 50))
+    # The header row is repeated on every page
+    return max(1, math.ceil((len(rows) - 1) / (rows_per_page - 1)))
+
+def layout_bom_pages(rows: list) -> tuple:
+    """
+    Works out the column widths and cell text for a BOM and splits it into pages (see bom_page_count) of at most
+    BOM_PDF_ROWS_PER_PAGE rows. The header row is repeated at the top of every page and the subtotal always ends up
+    on the last one. Every page is as wide as the BOM, and as tall as its rows.
+    Returns (column_widths, pages), each page being (page_size, [(row index, texts)]).
+    """
+    num_columns = max(len(row) for row in rows)
     
-    # Calculate column widths based on the maximum length of cells in each column
-    for col_index in range(1, num_columns + 1):
-        max_length = 0
-        for row in range(1, sheet.max_row + 1):
-            cell_value = sheet.cell(row=row, column=col_index).value
-            if cell_value is not None:
-                max_length = max(max_length, len(str(cell_value)))
-        # Calculate width (x10 for the scale factor, might want to play with this) with some padding
-        column_widths[col_index - 1] = ((max_length + 5) * (bom_font.size * 0.6))
+    # Single pass over every cell: convert it to text once and track the longest value in each column
+    max_lengths = [0] * num_columns
+    texts = []
+    for row in rows:
+        # Rows without any values aren't drawn (but still take up space)
+        if all(value is None for value in row):
+            texts.append(None)
+            continue
+        for column_index, value in enumerate(row):
+            if value is not None:
+                max_lengths[column_index] = max(max_lengths[column_index], len(value if isinstance(value, str) else str(value)))
+        texts.append([cell_text(value) for value in row] + [""] * (num_columns - len(row)))
+    # Calculate width (x10 for the scale factor, might want to play with this) with some padding
+    column_widths = [((max_length + 5) * (bom_font.size * 0.6)) for max_length in max_lengths]
     # Calculate total width
     total_width = sum(column_widths)
-    # Calculate total height based on row heights
-    padding_scale = 1.5
-    total_height = (bom_font.size * padding_scale * sheet.max_row) * 1.33333
-    
-    # Set the page size to match the total width
-    page_size = (total_width, total_height)
     
-    c = canvas.Canvas(pdf_output, pagesize=page_size)
+    # Everything below the header, in pages with room for the header
+    body = list(enumerate(texts))[1:]
+    per_page = max(3, getattr(settings, "BOM_PDF_ROWS_PER_PAGE", 50)) - 1
+    chunks = [body[start:start + per_page] for start in range(0, len(body), per_page)] or [[]]
+    # Keep the subtotal on the last page, with the closing spacer
+    if len(chunks) > 1 and len(chunks[-1]) < 2:
+        chunks[-1].insert(0, chunks[-2].pop())
     
+    pages = []
+    for chunk in chunks:
+        page_rows = [(0, texts[0])] + chunk
+        # Calculate the page's height based on row heights
+        total_height = (bom_font.size * padding_scale * len(page_rows)) * 1.33333
+        pages.append(((total_width, total_height), page_rows))
+    return column_widths, pages
+
+def draw_bom_pages(c, column_widths: list, pages: list, num_rows: int, outline: tuple = None):
+    """
+    Draws a BOM laid out by layout_bom_pages onto the canvas, a page at a time. Each page is finished (and compressed)
+    before the next one is drawn, so only the finished pages are kept until the PDF is saved.
+    outline is an optional (title, key) for an outline entry pointing at the first page.
+    """
+    for page_number, (page_size, page_rows) in enumerate(pages):
+        c.setPageSize(page_size)
+        if outline and page_number == 0:
+            c.bookmarkPage(outline[1])
+            c.addOutlineEntry(*outline)
+        draw_bom_page(c, page_size, column_widths, page_rows, num_rows, disclaimer=page_number == len(pages) - 1)
+        c.showPage()
+
+def draw_bom_page(c, page_size: tuple, column_widths: list, page_rows: list, num_rows: int, disclaimer: bool = True):
+    """Draws one page of a BOM (see layout_bom_pages) onto the canvas' current page. num_rows is the whole BOM's"""
     # This is like the drawY. Init to top of page
     y = page_size[1]
     
-    for index, row in enumerate(list(sheet.iter_rows())):
-        if all(cell.value is None for cell in row):
+    for index, row in page_rows:
+        if row is None:
             continue
         
         x = 0
-        row_height = bom_font.size * padding_scale * 1.33333
+        # Bold the first row and the 2nd to last one (the subtotal line)
+        font = f"Helvetica{"-Bold" if index == 0 or index == num_rows - 2 else ""}"
+        # Raise it a lil
+        text_y = y - row_height + (row_height - bom_font.size) / 2 + (bom_font.size / 8)
         
-        for column_index, cell in enumerate(row):
+        for column_index, text in enumerate(row):
             cell_width = column_widths[column_index]
-            # Raise it a lil
-            text_y = y - row_height + (row_height - bom_font.size) / 2 + (bom_font.size / 8)
             
             # Handle cell background color on the first row
             if index == 0:
@@ -256,7 +798,7 @@ def excel_to_pdf(workbook):
                 c.rect(x, y - row_height, cell_width, row_height, fill=1)
                 # Set the text color to white
                 c.setFillColor(white)
-            elif index == 1 or index == sheet.max_row - 1:
+            elif index == 1 or index == num_rows - 1:
                 grey = 0.75
                 c.setFillColorRGB(grey, grey, grey)
                 c.setStrokeColorRGB(grey, grey, grey)
@@ -266,36 +808,76 @@ def excel_to_pdf(workbook):
             else:
                 c.setFillColor(black)
             
-            # Bold + center text
+            # Center text
             text_object = c.beginText()
-            text = get_cell_value(cell)
-            text_width = c.stringWidth(text, "Helvetica", bom_font.size)
-            text_object.setTextOrigin(x + (cell_width - text_width) / 2, text_y)
-            # Bold the first row and the 2nd to last one (the subtotal line)
-            text_object.setFont(f"Helvetica{"-Bold" if index == 0 or index == sheet.max_row - 2 else ""}", bom_font.size)
-            
-            if index == 0:
-                text_object.textLine(get_cell_value(cell))
-            else:
-                text_object.textLine(get_cell_value(cell))
-            
+            text_object.setTextOrigin(x + (cell_width - text_width(text)) / 2, text_y)
+            text_object.setFont(font, bom_font.size)
+            text_object.textLine(text)
             c.drawText(text_object)
             x += cell_width
 
         y -= row_height
     
-    # Add a disclaimer
-    text_object = c.beginText()
-    text = "*Prices listed are estimates and may vary"
-    text_object.setTextOrigin(bom_font.size / 2, ((bom_font.size * padding_scale * 1.33333) - bom_font.size) / 2 + (bom_font.size / 8))
-    text_object.textLine(text)
-    c.setFillColor(black)
-    c.drawText(text_object)
+    # Add a disclaimer (on the last page, at the bottom)
+    if disclaimer:
+        text_object = c.beginText()
+        text_object.setTextOrigin(*disclaimer_origin)
+        text_object.textLine(disclaimer_text)
+        c.setFillColor(black)
+        c.drawText(text_object)
+
+def excel_to_pdf(workbook) -> bytes:
+    """Renders the first sheet of a workbook the same way as a BOM"""
+    sheet = workbook.worksheets[0]
+    return render_bom_pdf([[cell.value for cell in row] for row in sheet.iter_rows()])
+
+@phase("xlsx")
+def render_bom_xlsx(filename: str, rows: list):
+    """
+    Writes the BOM rows (see build_bom) to an Excel workbook using openpyxl's write-only mode,
+    so rows are flushed to disk as they're written instead of building the whole sheet in memory.
+    Returns a temporary file positioned at the start, which is deleted once closed.
+    """
+    wb = Workbook(write_only=True)
+    # Sheet titles are capped at 31 characters
+    ws = wb.create_sheet(title=f"BOM {filename}"[:31])
+    
+    # Auto-fit column widths (these have to be set before any rows are written)
+    num_columns = max(len(row) for row in rows)
+    max_lengths = [0] * num_columns
+    for row in rows:
+        for column_index, value in enumerate(row):
+            if value is not None:
+                max_lengths[column_index] = max(max_lengths[column_index], len(str(value)))
+    for column_index, max_length in enumerate(max_lengths):
+        ws.column_dimensions[get_column_letter(column_index + 1)].width = max_length + 2 # add some padding
     
-    # Save and export the PDF
-    c.save()
-    pdf_output.seek(0)
-    return pdf_output.getvalue()
+    # Bold header
+    header = []
+    for value in rows[0]:
+        cell = WriteOnlyCell(ws, value=value)
+        cell.font = Font(bold=True)
+        header.append(cell)
+    ws.append(header)
+    for row in rows[1:]:
+        ws.append([xlsx_cell(ws, value) for value in row])
+    
+    output = tempfile.TemporaryFile()
+    wb.save(output)
+    output.seek(0)
+    return output
+
+def xlsx_cell(ws, value):
+    """Prices and discounts go in as numbers (shown like in the PDF), so they can be added up and sorted"""
+    if isinstance(value, Currency):
+        cell = WriteOnlyCell(ws, value=Decimal(value))
+        cell.number_format = CURRENCY_FORMAT
+        return cell
+    if isinstance(value, Percentage):
+        cell = WriteOnlyCell(ws, value=float(value))
+        cell.number_format = PERCENTAGE_FORMAT
+        return cell
+    return value
 
 def round_currency(value):
     """Rounds float to 2 decimal places (for currency calculations)"""
@@ -313,20 +895,20 @@ def format_percentage(value):
         return "0%"
     return f"{value * 100}%"
 
-def get_cell_value(cell):
-    if cell.value is None:
-        return ""
-    elif cell.data_type == "n":
-        return str(cell.value)
-    elif cell.data_type == "s":
-        return cell.value
-    elif cell.data_type == "b":
-        return "TRUE" if cell.value else "FALSE"
-    elif cell.data_type == "d":
-        return cell.value.strftime("%Y-%m-%d")
-    elif cell.data_type == "e":
-        return f"ERROR: {cell.value}"
-    elif cell.data_type == "t":
-        return cell.value.strftime("%H:%M:%S")
-    else:
-        return str(cell.value)
+# Spreadsheet number formats matching format_currency and format_percentage (discounts have up to 4 decimals)
+CURRENCY_FORMAT = '"$"#,##0.00'
+PERCENTAGE_FORMAT = '0.0#%'
+
+class Currency(Decimal):
+    """A price in the BOM rows: a number, printed (in the PDF) like format_currency"""
+    __slots__ = ()
+
+    def __str__(self):
+        return format_currency(self)
+
+class Percentage(float):
+    """A discount in the BOM rows: a fraction, printed (in the PDF) like format_percentage"""
+    __slots__ = ()
+
+    def __str__(self):
+        return format_percentage(float(self))
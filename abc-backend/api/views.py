@@ -1,59 +1,239 @@
-from django.core.mail import EmailMessage
 from django.contrib.auth.models import User
-from django.db.models import Max
+from django.db import transaction
 from rest_framework import generics, status
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny, SAFE_METHODS
 from rest_framework.exceptions import NotFound
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.response import Response
 from .models import *
 from .serializers import *
-from .permissions import ReadOnlyOrAdmin
+from .permissions import ReadOnlyOrAdmin, HasMetricsToken
+from .filters import *
+from .pagination import paginated_response
+from .outbox import queue_email
+from .cache import bom_result_cache, bom_result_key, analytics_cache, analytics_key
+from .response_cache import cache_response, CachedListMixin, PATTERN_LIST_SCOPE, PATTERN_SCOPE, PRODUCT_SCOPE
+from .analytics import price_envelope
+from .metrics import phase, render_prometheus
+from .product_import import import_products, format_from_filename
+from .product_export import stream_products, EXPORT_FORMATS
 
 from .utils import *
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.utils.text import get_valid_filename
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Generate BOM
 @api_view(["POST"])
 @permission_classes([AllowAny])
 def download_bom(request, id):
-    pattern = get_object_or_404(Pattern, id=id)
+    pattern = get_object_or_404(Pattern.objects.select_related('group'), id=id)
     answers = request.data.get("answers", {})
     
     # EMAIL
     email = request.data.get("email", None)
+    # PDF (default) or XLSX
+    bom_format = request.data.get("format", "pdf")
     
     if not isinstance(answers, dict):
         return Response({"error": "Missing or invalid answers"}, status=400)
-    try:
-        pdf_bytes = generate_bom_from_yaml(pattern.group.name, pattern.yaml, answers, True) # True indicates we're building a PDF, so we should throw an error if it's empty
-        
-        # If email is present
+    if bom_format not in BOM_CONTENT_TYPES:
+        return Response({"error": f"Format must be one of {', '.join(BOM_CONTENT_TYPES)}"}, status=400)
+    
+    # Job mode: queue it up for the BOM worker and let the client poll for the result
+    if request.data.get("async"):
         if email:
-            email_subject = "Your BOM PDF"
-            email_body = f"Attached is the BOM you requested."
-            email_message = EmailMessage(email_subject, email_body, to=[email])
-            email_message.attach(f"{pattern.group.name}-bom.pdf", pdf_bytes, "application/pdf")
-            email_message.send()
-            return Response({"message": "Email sent successfully."}, status=200)
-        
-        response = HttpResponse(
-            pdf_bytes,
-            content_type=f"attachment; filename=\"{pattern.group.name}-bom.pdf\"",
-        )
-        return response
+            return Response({"error": "Emailed BOMs can't be generated asynchronously"}, status=400)
+        job = BomJob.objects.create(pattern=pattern, answers=answers, format=bom_format)
+        return Response(BomJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+    
+    try:
+        response = render_bom_response(pattern, answers, bom_format, email)
+    except RenderUnavailable as e:
+        return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         print(f"Failed during download BOM: {e}")
         return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    if response is None:
+        return Response({"message": "Email queued for delivery."}, status=status.HTTP_202_ACCEPTED)
+    return response
+
+class LongBom(Exception):
+    """A BOM too long to render in one piece (see render_bom_response). Requests waiting on the same BOM get its rows"""
+    def __init__(self, rows: list):
+        super().__init__("BOM is longer than a page")
+        self.rows = rows
+
+def render_bom_response(pattern, answers: dict, bom_format: str, email: str = None):
+    """
+    Renders a pattern's BOM (shared with identical requests, see bom_result_cache) and returns the response
+    to download it, streamed from a temporary file for PDFs longer than a page. If email is given, hands the BOM
+    to the outbox worker instead and returns None.
+    Shared by the sync and async (see async_views.py) BOM views.
+    """
+    filename = f"{pattern.group.name}-bom.{bom_format}"
+    if bom_format == "xlsx":
+        rows = build_bom(pattern.yaml, answers, True, pattern_id=pattern.id, answer_table=pattern.answer_table)
+        xlsx_file = render_bom_xlsx(pattern.group.name, rows)
+        if not email:
+            # Streams the file back in chunks, and closes (deletes) it when done
+            return FileResponse(xlsx_file, as_attachment=True, filename=filename, content_type=BOM_CONTENT_TYPES["xlsx"])
+        with xlsx_file:
+            bom_bytes = xlsx_file.read()
+    else:
+        key = bom_result_key(pattern, answers, bom_format)
+        bom_bytes = bom_result_cache.get(key)
+        if bom_bytes is None:
+            # Turned away before building the BOM if it can't be rendered right now
+            check_render_capacity()
+            def build_and_render():
+                # True indicates we're building a PDF, so we should throw an error if it's empty
+                rows = build_bom(pattern.yaml, answers, True, pattern_id=pattern.id, answer_table=pattern.answer_table)
+                if bom_page_count(rows) > 1:
+                    raise LongBom(rows)
+                return run_render(render_bom_pdf, [(rows,)])[0]
+            try:
+                # Identical requests (even concurrent ones) share one build and render
+                bom_bytes = bom_result_cache.get_or_render(key, build_and_render)
+            except LongBom as long_bom:
+                if email:
+                    bom_bytes = run_render(render_bom_pdf, [(long_bom.rows,)])[0]
+                else:
+                    # Long BOMs are rendered to a temporary file and streamed from there (and not cached), so they're
+                    # never held in memory here. It's deleted once the response is done with it, or right away if the
+                    # render fails or times out
+                    with temporary_file_path(".pdf") as path:
+                        run_render(render_bom_pdf_file, [(long_bom.rows, path)])
+                        pdf_file = open_temporary_file(path)
+                    return FileResponse(pdf_file, as_attachment=True, filename=filename, content_type=BOM_CONTENT_TYPES["pdf"])
+    
+    # If email is present, hand it to the outbox worker instead of waiting on the mail server
+    if email:
+        email_subject = f"Your BOM {bom_format.upper()}"
+        email_body = f"Attached is the BOM you requested."
+        with phase("email"):
+            queue_email([email], email_subject, email_body, filename, bom_bytes, BOM_CONTENT_TYPES[bom_format])
+        return None
+    
+    response = HttpResponse(
+        bom_bytes,
+        content_type=f"attachment; filename=\"{filename}\"",
+    )
+    return response
+
+# Generate one BOM per answer set (e.g. every site variant of a quote) in a single call
+@api_view(["POST"])
+@permission_classes([AllowAny])
+def download_bom_batch(request, id):
+    pattern = get_object_or_404(Pattern.objects.select_related('group'), id=id)
+    answer_sets = request.data.get("answers")
+    # Optional label for each answer set, used in the file / section names
+    names = request.data.get("names")
+    # zip (default): one PDF per answer set. pdf: a single PDF, each answer set starting on a new page
+    output = request.data.get("output", "zip")
+    max_size = getattr(settings, "BOM_BATCH_MAX_SIZE", 100)
+    
+    if not isinstance(answer_sets, list) or not answer_sets or not all(isinstance(answers, dict) for answers in answer_sets):
+        return Response({"error": "Answers must be a non-empty list of answer sets"}, status=400)
+    if len(answer_sets) > max_size:
+        return Response({"error": f"Too many answer sets (max: {max_size})"}, status=400)
+    if names is None:
+        names = [str(index + 1) for index in range(len(answer_sets))]
+    elif not isinstance(names, list) or len(names) != len(answer_sets) or not all(isinstance(name, str) and name for name in names):
+        return Response({"error": "Names must be a list of strings, one per answer set"}, status=400)
+    if output not in ("zip", "pdf"):
+        return Response({"error": "Output must be one of zip, pdf"}, status=400)
+    
+    try:
+        check_render_capacity(len(answer_sets))
+        # Compiles the pattern and fetches the products once for the whole batch
+        boms = build_boms(pattern.yaml, answer_sets, pattern_id=pattern.id, answer_table=pattern.answer_table)
+        if output == "pdf":
+            sections = [(f"{pattern.group.name} - {name}", rows) for name, rows in zip(names, boms)]
+            # Drawn onto one canvas, but it's still a PDF's worth of work per section
+            content = run_render(render_bom_pdf_sections, [(sections,)], len(sections))[0]
+            content_type = BOM_CONTENT_TYPES["pdf"]
+        else:
+            pdfs = render_bom_pdfs(boms)
+            content = zip_files([(get_valid_filename(f"{pattern.group.name}-bom-{name}.pdf"), pdf) for name, pdf in zip(names, pdfs)])
+            content_type = "application/zip"
+    except RenderUnavailable as e:
+        return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        logger.warning("Failed during batch BOM: %s", e)
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    return HttpResponse(
+        content,
+        content_type=content_type,
+        headers={"Content-Disposition": f"attachment; filename=\"{pattern.group.name}-boms.{output}\""},
+    )
+
+# Cost of a pattern's BOM across every valid combination of answers
+# Staff only: it evaluates every combination of answers, so it's cached and worked out in the render pool
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def pattern_analytics(request, id):
+    pattern = get_object_or_404(Pattern.objects.defer('answer_table'), id=id)
+    try:
+        bins = int(request.query_params.get("bins", 10))
+    except ValueError:
+        return Response({"error": "bins must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+    if not 1 <= bins <= 100:
+        return Response({"error": "bins must be between 1 and 100"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        # Identical requests (even concurrent ones) share one envelope
+        envelope = analytics_cache.get_or_render(analytics_key(pattern, bins), lambda: price_envelope(pattern.yaml, pattern_id=pattern.id, bins=bins))
+        return Response(envelope, status=status.HTTP_200_OK)
+    except RenderUnavailable as e:
+        return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": str(e.retry_after)})
+    except ImportError as e:
+        return Response({"error": str(e)}, status=status.HTTP_501_NOT_IMPLEMENTED)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+# Request / BOM engine metrics in the Prometheus text format, added up across workers (see metrics.py).
+# The token isn't a JWT, so the usual authentication is skipped
+@api_view(["GET"])
+@authentication_classes([])
+@permission_classes([HasMetricsToken])
+def prometheus_metrics(request):
+    return HttpResponse(render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Status of a queued BOM
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def bom_job_status(request, id):
+    job = get_object_or_404(BomJob.objects.defer('result'), id=id)
+    return Response(BomJobSerializer(job).data, status=status.HTTP_200_OK)
+
+# Download a finished BOM
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def bom_job_download(request, id):
+    job = get_object_or_404(BomJob.objects.select_related('pattern__group'), id=id)
+    if job.status != BomJob.Status.DONE:
+        return Response(BomJobSerializer(job).data, status=status.HTTP_409_CONFLICT)
+    return HttpResponse(
+        bytes(job.result),
+        content_type=BOM_CONTENT_TYPES[job.format],
+        headers={"Content-Disposition": f"attachment; filename=\"{job.pattern.group.name}-bom.{job.format}\""},
+    )
 
 @api_view(["GET", "POST", "PATCH"])
 @permission_classes([AllowAny])
+@cache_response("pattern-list", PATTERN_LIST_SCOPE)
 def pattern_list_create(request):
     if request.method == "GET":
-        patterns = Pattern.objects.all()
-        serializer = PatternSummarySerializer(patterns, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        # Fetch the groups in the same query, and skip the (potentially large) YAML we won't send back
+        patterns = Pattern.objects.select_related('group').defer('yaml', 'questions', 'answer_table')
+        patterns = filter_patterns(patterns, request.query_params)
+        ordering = get_ordering(request.query_params, PATTERN_ORDERING_FIELDS, 'id')
+        return paginated_response(request, patterns, PatternSummarySerializer, ordering)
     
     elif request.method == "POST":
         # If editing data, ALWAYS check if it's a superuser
@@ -80,16 +260,13 @@ def pattern_list_create(request):
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         # If it was not created (it already exists), you have the existing pattern_group to use
-        # Find the maximum version number for the PatternGroup
-        max_version = Pattern.objects.filter(group=pattern_group).aggregate(Max('version'))['version__max']
-        new_version = (max_version or 0) + 1  # Increment max version or start with 1
-        
-        # Create a new Pattern with the auto-incremented version
-        pattern = Pattern.objects.create(
-            group=pattern_group,
-            description=description if not created else "", # use the provided description ONLY IF the group wasn't created. No need to set the version description too
-            version=new_version  # Use the new version
-        )
+        # Create a new Pattern with the next version number (the group's counter, locked until the pattern exists)
+        with transaction.atomic():
+            pattern = Pattern.objects.create(
+                group=pattern_group,
+                description=description if not created else "", # use the provided description ONLY IF the group wasn't created. No need to set the version description too
+                version=pattern_group.next_version()
+            )
         return Response(PatternSerializer(pattern).data, status=status.HTTP_201_CREATED)
     
     elif request.method == "PATCH":
@@ -112,9 +289,10 @@ def pattern_list_create(request):
 
 @api_view(["GET", "PATCH"])
 @permission_classes([AllowAny])
+@cache_response("pattern", PATTERN_SCOPE)
 def get_edit_pattern(request, id):
     try: 
-        pattern = Pattern.objects.get(id=id)
+        pattern = Pattern.objects.select_related('group').defer('answer_table').get(id=id)
         if request.method == "GET":
             serializer = PatternSerializer(pattern)
             return Response(serializer.data, status=status.HTTP_200_OK)
@@ -163,9 +341,9 @@ def pattern_group_delete(request, pk):
 @permission_classes([IsAdminUser])
 def product_list_create(request):
     if request.method == "GET":
-        products = Product.objects.all()
-        serializer = ProductSerializer(products, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        products = filter_products(Product.objects.all(), request.query_params)
+        ordering = get_ordering(request.query_params, PRODUCT_ORDERING_FIELDS, 'part')
+        return paginated_response(request, products, ProductSerializer, ordering)
 
     elif request.method == "POST":
         serializer = ProductSerializer(data=request.data)
@@ -174,8 +352,42 @@ def product_list_create(request):
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+# The whole catalog (or a filtered part of it) as CSV or NDJSON, streamed as it's read from the database
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def product_export(request):
+    # Not "format", DRF uses that one to pick a renderer
+    export_format = request.query_params.get("type", "csv")
+    if export_format not in EXPORT_FORMATS:
+        return Response({"error": f"Type must be one of {', '.join(EXPORT_FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+    products = filter_products(Product.objects.all(), request.query_params)
+    ordering = get_ordering(request.query_params, PRODUCT_ORDERING_FIELDS, 'part')
+    return StreamingHttpResponse(
+        stream_products(products.order_by(*ordering), export_format),
+        content_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment; filename=\"products.{export_format}\""},
+    )
+
+# Create / update products in bulk from a CSV or XLSX file (multipart, as "file")
+@api_view(["POST"])
+@permission_classes([IsAdminUser])
+def product_import(request):
+    upload = request.FILES.get("file")
+    if upload is None:
+        return Response({"error": "Missing file"}, status=status.HTTP_400_BAD_REQUEST)
+    # Worked out from the file name unless given
+    file_format = request.data.get("format") or format_from_filename(upload.name)
+    dry_run = str(request.data.get("dry_run", "")).lower() in ("true", "1")
+    try:
+        report = import_products(upload, file_format, dry_run=dry_run)
+    except Exception as e:
+        # Problems with the file as a whole (bad rows are in the report instead)
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(report, status=status.HTTP_200_OK)
+
 @api_view(["GET", "PATCH", "DELETE"])
 @permission_classes([AllowAny])
+@cache_response("product", PRODUCT_SCOPE)
 def single_product(request, pk):
     try:
         product = Product.objects.get(pk=pk)
@@ -214,8 +426,9 @@ def get_classification(request):
 
 
 # Product fields
+# The lists are cached until one of their rows changes (see response_cache.py)
 # View for Manufacturer
-class ManufacturerListCreateAPIView(generics.ListCreateAPIView):
+class ManufacturerListCreateAPIView(CachedListMixin, generics.ListCreateAPIView):
     queryset = Manufacturer.objects.all()
     serializer_class = ManufacturerSerializer
 
@@ -224,7 +437,7 @@ class ManufacturerRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPI
     serializer_class = ManufacturerSerializer
 
 # View for DeviceRole
-class DeviceRoleListCreateAPIView(generics.ListCreateAPIView):
+class DeviceRoleListCreateAPIView(CachedListMixin, generics.ListCreateAPIView):
     queryset = DeviceRole.objects.all()
     serializer_class = DeviceRoleSerializer
 
@@ -233,7 +446,7 @@ class DeviceRoleRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPIVi
     serializer_class = DeviceRoleSerializer
 
 # View for Classification
-class ClassificationListCreateAPIView(generics.ListCreateAPIView):
+class ClassificationListCreateAPIView(CachedListMixin, generics.ListCreateAPIView):
     queryset = Classification.objects.all()
     serializer_class = ClassificationSerializer
 
@@ -61,6 +61,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover everything else
+    "api.metrics.ServerTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -103,8 +105,25 @@ if os.getenv('POSTGRES_DB'):
             'PASSWORD': os.getenv('POSTGRES_PASSWORD'),
             'HOST': os.getenv('POSTGRES_HOST', 'db'),
             'PORT': os.getenv('POSTGRES_PORT', '5432'),
+            # Seconds a connection is reused for before it's closed (0: a new connection for every request, like
+            # before. "None": forever). Connections are checked before being reused, so a dropped one is replaced
+            'CONN_MAX_AGE': None if os.getenv('DB_CONN_MAX_AGE') == 'None' else int(os.getenv('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
         }
     }
+    # Connection pool shared by every thread of a worker (psycopg's pool, installed with the psycopg "pool" extra).
+    # Replaces persistent connections, the two can't be combined
+    if os.getenv('DB_POOL', False) == 'True':
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS'] = {
+            'pool': {
+                'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 1)),
+                # One connection per gunicorn thread is enough
+                'max_size': int(os.getenv('DB_POOL_MAX_SIZE', os.getenv('GUNICORN_THREADS', 4))),
+                # Seconds a request waits for a free connection before failing
+                'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+            },
+        }
 else:
     # Use a file instead for testing
     DATABASES = {
@@ -115,6 +134,31 @@ else:
     }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# CACHE_BACKEND picks where the default cache (API responses, BOM_PRODUCT_CACHE) lives:
+#   locmem (default): in each worker process's memory, so every worker has its own copy
+#   file: a directory (CACHE_LOCATION) shared by the workers on a node
+#   db: a table (CACHE_LOCATION) in the database, shared by every node. start.sh creates it (createcachetable)
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', ''),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', '/tmp/abc-backend-cache'),
+    'db': ('django.core.cache.backends.db.DatabaseCache', 'api_cache'),
+}
+CACHE_BACKEND, CACHE_DEFAULT_LOCATION = CACHE_BACKENDS[os.getenv('CACHE_BACKEND', 'locmem')]
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.getenv('CACHE_LOCATION', CACHE_DEFAULT_LOCATION),
+        # Seconds entries are kept by default
+        'TIMEOUT': int(os.getenv('CACHE_TIMEOUT', 300)),
+        'OPTIONS': {
+            # Past this many entries the backend culls a third of them (least recently used first for locmem)
+            'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 10000)),
+        },
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -161,6 +205,97 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'bstatic')
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# BOM engine
+# Compiled patterns are cached per worker. Entries are evicted (least recently used first) once either limit is hit
+BOM_PATTERN_CACHE_MAX_ENTRIES = int(os.getenv('BOM_PATTERN_CACHE_MAX_ENTRIES', 128))
+BOM_PATTERN_CACHE_MAX_BYTES = int(os.getenv('BOM_PATTERN_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+# Patterns whose questions have at most this many combinations of answers (booleans, enums, integers with a min and max)
+# get every combination's parts worked out when they're saved, so BOMs skip evaluating the rules. 0 turns it off
+BOM_ANSWER_TABLE_MAX_SIZE = int(os.getenv('BOM_ANSWER_TABLE_MAX_SIZE', 1000))
+# Optional read-through product cache for BOM generation. Set to the alias of a configured cache (e.g. "default")
+# to enable it. Use a backend shared by every worker so save / delete invalidations reach all of them
+BOM_PRODUCT_CACHE = os.getenv('BOM_PRODUCT_CACHE') or None
+BOM_PRODUCT_CACHE_TIMEOUT = int(os.getenv('BOM_PRODUCT_CACHE_TIMEOUT', 300))
+# Rendered BOMs are cached per worker, keyed by pattern (and its YAML), answers and a catalog version that's bumped on any
+# product change. Set either limit to 0 to turn it off
+BOM_RESULT_CACHE_MAX_ENTRIES = int(os.getenv('BOM_RESULT_CACHE_MAX_ENTRIES', 256))
+BOM_RESULT_CACHE_MAX_BYTES = int(os.getenv('BOM_RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Seconds each worker reuses the catalog version it read. Other workers may serve BOMs priced before a product change
+# for this long
+BOM_VERSION_CACHE_TTL = float(os.getenv('BOM_VERSION_CACHE_TTL', 2))
+# Responses of the pattern list / detail, product detail and manufacturer, device role and classification list endpoints
+# are cached in this cache (see api/response_cache.py) until the data they show changes. Empty turns it off
+API_RESPONSE_CACHE = os.getenv('API_RESPONSE_CACHE', 'default') or None
+# Seconds they're kept at most (in case something changes the database behind the app's back)
+API_RESPONSE_CACHE_TIMEOUT = int(os.getenv('API_RESPONSE_CACHE_TIMEOUT', 60 * 60))
+# Batch BOMs (POST /api/pattern/<id>/bom/batch): most answer sets per request
+BOM_BATCH_MAX_SIZE = int(os.getenv('BOM_BATCH_MAX_SIZE', 100))
+# PDF rendering is pure Python, so BOM requests render in a pool of processes rather than holding up the web worker.
+# Every web worker (WEB_CONCURRENCY of them, see gunicorn.conf.py) has its own pool, so the node's CPUs are split
+# between them: WEB_CONCURRENCY times this is how many renders (and render processes) a node runs at once. With the
+# default CPUs + 1 workers that's one each; fewer workers get bigger pools, spreading a batch over more CPUs.
+# 0 renders in the worker
+_cpus = os.cpu_count() or 1
+_web_workers = max(1, int(os.getenv('WEB_CONCURRENCY', _cpus + 1)))
+BOM_RENDER_PROCESSES = int(os.getenv('BOM_RENDER_PROCESSES', max(1, _cpus // _web_workers)))
+# PDFs (or sections of a merged one) that can wait for a free process, per web worker: 16 per node by default, split
+# the same way. Past that, BOM requests get a 503 with a Retry-After header. A batch bigger than the whole queue only
+# runs once it's empty
+BOM_RENDER_QUEUE_SIZE = int(os.getenv('BOM_RENDER_QUEUE_SIZE', max(1, 16 // _web_workers)))
+# Seconds a request waits for its render before giving up (with a 503 too)
+BOM_RENDER_TIMEOUT = float(os.getenv('BOM_RENDER_TIMEOUT', 60))
+# Most rows on a BOM PDF page (the header row is repeated on every page, the subtotal is on the last one). BOMs that
+# take more than a page are written to a temporary file and streamed from there rather than kept in memory (or cached)
+BOM_PDF_ROWS_PER_PAGE = int(os.getenv('BOM_PDF_ROWS_PER_PAGE', 50))
+# Async versions of the BOM, pattern and product read endpoints (see api/async_views.py). On by default when gunicorn
+# runs the ASGI app (uvicorn workers, see gunicorn.conf.py). Under WSGI each request would need its own event loop
+BOM_ASYNC_VIEWS = (os.getenv('BOM_ASYNC_VIEWS', str('uvicorn' in os.getenv('GUNICORN_WORKER_CLASS', ''))) == 'True')
+# How many async BOM requests (per worker) render at once. The others wait without holding a thread
+BOM_ASYNC_RENDER_THREADS = int(os.getenv('BOM_ASYNC_RENDER_THREADS', 4))
+# Price envelopes (GET /api/pattern/<id>/analytics, needs NumPy): most combinations of answers evaluated at once,
+# worked out in a render process
+BOM_ANALYTICS_MAX_COMBINATIONS = int(os.getenv('BOM_ANALYTICS_MAX_COMBINATIONS', 100_000))
+# Price envelopes kept per worker (by pattern YAML, histogram bins and catalog version)
+BOM_ANALYTICS_CACHE_MAX_ENTRIES = int(os.getenv('BOM_ANALYTICS_CACHE_MAX_ENTRIES', 64))
+# Metrics (GET /api/metrics). Only served to requests with an "Authorization: Bearer <BOM_METRICS_TOKEN>" header
+# (Prometheus' authorization setting), and to nobody while it's unset
+BOM_METRICS_TOKEN = os.getenv('BOM_METRICS_TOKEN') or None
+# Gives every response a Server-Timing header with the time spent in each phase of BOM generation and in the database.
+# Browsers show it to anyone, so only turn it on where the clients are trusted (e.g. to profile in development)
+BOM_SERVER_TIMING = (os.getenv('BOM_SERVER_TIMING', 'False') == 'True')
+# Directory shared by every worker (and the bom_worker / send_outbox commands) so /api/metrics covers all of them.
+# Unset, it only shows the worker that happened to handle the scrape. Clear it out when the app is (re)deployed
+BOM_METRICS_DIR = os.getenv('BOM_METRICS_DIR') or None
+# Seconds between writes of a worker's metrics to that directory
+BOM_METRICS_FLUSH_INTERVAL = float(os.getenv('BOM_METRICS_FLUSH_INTERVAL', 1))
+
+# Bulk product imports (POST /api/product/import, python manage.py import_products): rows upserted per query
+PRODUCT_IMPORT_BATCH_SIZE = int(os.getenv('PRODUCT_IMPORT_BATCH_SIZE', 1000))
+# Product exports (GET /api/product/export): rows fetched from the database (and sent) at a time
+PRODUCT_EXPORT_CHUNK_SIZE = int(os.getenv('PRODUCT_EXPORT_CHUNK_SIZE', 2000))
+
+# Background BOM jobs (python manage.py bom_worker)
+# How many jobs each bom_worker renders at once (each in a process of its own)
+BOM_WORKER_CONCURRENCY = int(os.getenv('BOM_WORKER_CONCURRENCY', 2))
+# Seconds a worker waits before checking an empty queue again
+BOM_WORKER_POLL_INTERVAL = float(os.getenv('BOM_WORKER_POLL_INTERVAL', 1))
+# Seconds a finished job (and its file) is kept around for download
+BOM_JOB_TTL = int(os.getenv('BOM_JOB_TTL', 60 * 60))
+# Seconds a worker holds a job for without renewing it (it renews every third of that while rendering). A running job
+# whose lease runs out (its worker crashed or was killed) is queued again, up to BOM_JOB_MAX_ATTEMPTS times in all
+BOM_JOB_LEASE = int(os.getenv('BOM_JOB_LEASE', 60))
+BOM_JOB_MAX_ATTEMPTS = int(os.getenv('BOM_JOB_MAX_ATTEMPTS', 3))
+# Email outbox (python manage.py send_outbox)
+# Emails sent per SMTP connection
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv('EMAIL_OUTBOX_BATCH_SIZE', 50))
+# Seconds the worker waits before checking for due emails again
+EMAIL_OUTBOX_POLL_INTERVAL = float(os.getenv('EMAIL_OUTBOX_POLL_INTERVAL', 2))
+# Attempts before an email is marked as failed. The delay (seconds) doubles after each failed attempt
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', 5))
+EMAIL_OUTBOX_RETRY_DELAY = int(os.getenv('EMAIL_OUTBOX_RETRY_DELAY', 30))
+# Seconds a worker holds the emails it claimed (a whole batch) before they're due again, in case it died sending them
+EMAIL_OUTBOX_LEASE = int(os.getenv('EMAIL_OUTBOX_LEASE', 300))
+
 CORS_ALLOW_ALL_ORIGINS = True
 CORS_ALLOWED_CREDENTIALS = True
 
@@ -0,0 +1,43 @@
+# Gunicorn server profile. Gunicorn picks this file up automatically when started from this directory (see start.sh).
+# Every setting can be overridden with an environment variable, see "Server profile" in the README.
+# https://docs.gunicorn.org/en/stable/settings.html
+import multiprocessing
+import os
+
+cpus = multiprocessing.cpu_count()
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+
+# gthread (default): each worker process serves requests on a pool of threads, so requests waiting on the database
+# (or on the mail server, the render pool, etc.) don't hold up a whole process. sync: one request per process.
+# uvicorn_worker.UvicornWorker: runs the ASGI app instead
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+asgi = "uvicorn" in worker_class
+wsgi_app = "backend.asgi:application" if asgi else "backend.wsgi:application"
+
+# Rendering BOMs is CPU bound and holds the GIL, so processes are what give more throughput: one per CPU plus one
+# to cover a worker that's blocked. Threads only add concurrency for I/O
+workers = int(os.getenv("WEB_CONCURRENCY", cpus + 1))
+threads = int(os.getenv("GUNICORN_THREADS", 4 if worker_class == "gthread" else 1))
+
+# Seconds a request may take before its worker is killed and restarted. Large batch BOMs take a while
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+# Seconds an idle keep-alive connection (from nginx) is held open
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Restart workers after this many requests (plus up to 10% jitter, so they don't all restart at once) to cap
+# slow memory growth (caches, fragmentation). 0 turns it off
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = max_requests // 10
+
+# "-" logs to stdout, empty turns it off
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-") or None
+
+def child_exit(server, worker):
+    # Keep the metrics of a worker that exited (or was killed on timeout) in the totals of /api/metrics,
+    # see BOM_METRICS_DIR
+    directory = os.getenv("BOM_METRICS_DIR")
+    if directory:
+        from api.metrics import retire
+        retire(directory, worker.pid)
@@ -4,6 +4,9 @@ set -e
 
 python manage.py makemigrations
 python manage.py migrate --run-syncdb
+# Only does anything with CACHE_BACKEND=db
+python manage.py createcachetable
 python create_superuser.py
 python manage.py collectstatic --noinput
-gunicorn --bind 0.0.0.0:8000 backend.wsgi:application
+# Workers, threads, etc. come from gunicorn.conf.py
+gunicorn